@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+
+from hcg import kernels
+from hcg import sampling
+from hcg.archive import HCGArchive
+from hcg.codec import CODECS, decode_delta
+from hcg.encoder import encode_diffs
+from hcg.image import HCGImage, encode_diff_image
+from hcg.packer import HCHPacker, HCGPackImage
+from hcg.ranking import rank_images
+from hcg.server import ArchiveServer
+from hcg.sampling import evaluate_image_diff, split_rect
+from hcg.spool import PayloadStore
+from hcg.utils import BytesIO
+
+from corpus import make_corpus, make_base, make_variants, DEFAULT_SIZES, DEFAULT_MODES
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+# Usage sample:
+#
+# python benchmarks/bench.py -o before.json
+# python benchmarks/bench.py -o after.json --compare before.json
+# python benchmarks/bench.py --quick -k compress
+#
+# Every benchmark is run `repeat` times on a synthetic corpus (see corpus.py),
+# results are written as JSON with min/mean/max seconds of each benchmark.
+
+class Bench(object):
+    def __init__(self, repeat=5, pattern=None):
+        self.repeat = repeat
+        self.pattern = pattern
+        self.results = []
+    
+    def run(self, name, fn, repeat=None, setup=None, **params):
+        # Time fn(setup()) or fn(), setup is not timed
+        if self.pattern and self.pattern not in name:
+            return
+        
+        times = []
+        for i in range(repeat or self.repeat):
+            arg = setup() if setup else None
+            
+            t = timer()
+            if setup:
+                fn(arg)
+            else:
+                fn()
+            times.append(timer() - t)
+        
+        result = {
+            "name": name,
+            "params": params,
+            "repeat": len(times),
+            "min": min(times),
+            "mean": sum(times) / len(times),
+            "max": max(times),
+        }
+        self.results.append(result)
+        
+        print("%-48s %12.3f ms  %s" % (name, result["min"] * 1000,
+                                         " ".join("%s=%s" % i for i in sorted(params.items()))))
+
+
+class SampleImage(HCGImage):
+    # Image with a given sample, to rank many images without decoding them
+    def __init__(self, key, sample):
+        super(SampleImage, self).__init__(key)
+        self.set_sample(sample)
+
+
+def _bands(mode):
+    return {"L": 1, "RGB": 3, "RGBA": 4}[mode]
+
+def _groups(corpus):
+    # {folder: [filename, ...]} with base image first
+    groups = {}
+    for filename in corpus:
+        groups.setdefault(os.path.dirname(filename), []).append(filename)
+    return [sorted(files) for key, files in sorted(groups.items())]
+
+def bench_kernels(bench, corpus, backends):
+    for files in _groups(corpus):
+        img = Image.open(files[0])
+        ref = Image.open(files[1])
+        w, h = img.size
+        bands = _bands(img.mode)
+        data, ref_data = img.tobytes(), ref.tobytes()
+        params = {"mode": img.mode, "size": "%ix%i" % (w, h)}
+        
+        # Pure Python loops take seconds on large images
+        slow_repeat = 1
+        
+        def sampling_bbox_python():
+            buf = bytearray(data)
+            for index, bbox in enumerate(split_rect(w, h)):
+                sampling.sampling_bbox(buf, w, h, bands, bbox, lambda i, r: None, index)
+        bench.run("sampling.bbox.python", sampling_bbox_python, repeat=slow_repeat, **params)
+        
+        if "cython" in backends:
+            from hcg import _sampling
+            
+            def sampling_bbox_cython():
+                for index, bbox in enumerate(split_rect(w, h)):
+                    _sampling.sampling_bbox(data, w, h, bands, bbox, lambda i, r: None, index)
+            bench.run("sampling.bbox.cython", sampling_bbox_cython, **params)
+        
+        for name in backends:
+            k = kernels.get_kernels(name)
+            repeat = name == "python" and slow_repeat or None
+            
+            bench.run("sampling.grid.%s" % name,
+                      lambda: k.sampling_grid(data, w, h, bands),
+                      repeat=repeat, **params)
+            bench.run("compress.diff.%s" % name,
+                      lambda buf: k.diff_data(buf, ref_data),
+                      setup=lambda: bytes(bytearray(data)), repeat=repeat, **params)
+            bench.run("compress.merge.%s" % name,
+                      lambda buf: k.merge_data(buf, ref_data),
+                      setup=lambda: bytes(bytearray(data)), repeat=repeat, **params)
+
+def bench_codec(bench, corpus):
+    # Diff image codecs on the first two images of each group, sizes are in
+    # the params
+    for files in _groups(corpus):
+        img = Image.open(files[1])
+        ref = Image.open(files[0])
+        w, h = img.size
+        data, ref_data = img.tobytes(), ref.tobytes()
+        ref_buffer = (ref.mode, ref.size, ref_data)
+        
+        for threads in (1, 4):
+            for name, codec in sorted(CODECS.items()):
+                if name == "png" and threads > 1:
+                    # zlib of PNG is not split
+                    continue
+                
+                buf = encode_diff_image(img.mode, img.size, bytes(bytearray(data)), ref_data,
+                                        threads, codec)
+                params = {"mode": img.mode, "size": "%ix%i" % (w, h), "threads": threads,
+                          "bytes": len(buf), "raw_bytes": len(data)}
+                
+                bench.run("codec.encode.%s" % name,
+                          lambda arg: encode_diff_image(img.mode, img.size, arg, ref_data,
+                                                        threads, codec),
+                          setup=lambda: bytes(bytearray(data)), **params)
+                
+                if name == "png":
+                    decode = lambda: kernels.kernels.merge_data(
+                        Image.open(BytesIO(buf)).tobytes(), ref_data)
+                else:
+                    decode = lambda: decode_delta(buf, ref_buffer, threads)
+                bench.run("codec.decode.%s" % name, decode, **params)
+
+def bench_ranking(bench, corpus, synthetic):
+    images = [HCGPackImage(f, f) for f in corpus]
+    samples = [img.sample for img in images]
+    
+    def evaluate():
+        for s1 in samples:
+            for s2 in samples:
+                if len(s1) == len(s2):
+                    evaluate_image_diff(SampleImage("a", s1), SampleImage("b", s2))
+    bench.run("evaluate_image_diff", evaluate, pairs=len(samples) ** 2)
+    
+    # Synthetic samples of a single group, ranking cost is about image count
+    rnd = random.Random(0)
+    bases = [[[rnd.randrange(200000) for b in range(3)] for r in range(96)]
+             for i in range(8)]
+    ranked = []
+    for i in range(synthetic):
+        base = bases[i % len(bases)]
+        ranked.append(SampleImage("img%05i.png" % i,
+                                  [[e + rnd.randrange(3000) for e in s] for s in base]))
+    
+    bench.run("rank_images.indexed", lambda: rank_images(ranked), images=len(ranked))
+    bench.run("rank_images.exact", lambda: rank_images(ranked, exact=True),
+              repeat=1, images=len(ranked))
+
+def _pack_images(source, corpus, temp, codec=0):
+    # Pack images of corpus with references, as hcg c does
+    images = [HCGPackImage(os.path.relpath(f, source), f) for f in corpus]
+    
+    images_ref = {}
+    for files in _groups(corpus):
+        group = [img for img in images if os.path.join(source, img.key) in files]
+        for img, (ref, score) in rank_images(group).items():
+            images_ref[img] = ref
+    
+    store = PayloadStore(temp)
+    encode_diffs(images, images_ref, store, jobs=1, codec=codec)
+    return images, store
+
+def bench_archive(bench, source, corpus, temp):
+    images, store = _pack_images(source, corpus, temp)
+    total = sum(img.size for img in images)
+    
+    for version in (1, 2):
+        target = os.path.join(temp, "bench%i.hcg" % version)
+        
+        def write_body():
+            packer = HCHPacker(target, version=version)
+            packer.write_comment_header()
+            packer.write_body(list(images))
+            packer.close()
+        bench.run("packer.write_body.v%i" % version, write_body,
+                  images=len(images), bytes=total)
+        
+        if not os.path.exists(target):
+            # Filtered out, still needed by archive benchmarks
+            write_body()
+        
+        def open_index():
+            archive = HCGArchive(target, cache=False)
+            archive.get_images()
+            archive.close()
+        bench.run("archive.open_index.v%i" % version, open_index, images=len(images))
+        
+        key = images[len(images) // 2].key
+        
+        def get_one():
+            archive = HCGArchive(target, cache=False)
+            archive.get(key).get_data()
+            archive.close()
+        bench.run("archive.get.v%i" % version, get_one)
+    
+    store.close()
+    
+    # Packing and extraction of HCG002 archives with each diff codec
+    for name, codec in sorted(CODECS.items()):
+        target = os.path.join(temp, "codec_%s.hcg" % name)
+        
+        def pack():
+            images, store = _pack_images(source, corpus, temp, codec)
+            packer = HCHPacker(target, version=2)
+            packer.write_comment_header()
+            packer.write_body(images)
+            packer.close()
+            store.close()
+        bench.run("codec.pack.%s" % name, pack, repeat=1)
+        if not os.path.exists(target):
+            pack()
+        
+        def extract():
+            archive = HCGArchive(target)
+            for img in archive.iter_decoded():
+                pass
+            archive.close()
+        bench.run("codec.extract.%s" % name, extract, bytes=os.path.getsize(target))
+
+def bench_region(bench, temp, size=(3840, 2160)):
+    # Crop of a diffed 4K image against full reconstruction, with a warm
+    # reference cache as in a viewer
+    rnd = random.Random(0)
+    base = make_base("RGB", size, rnd)
+    variant = next(make_variants(base, 1, rnd))
+    
+    source = os.path.join(temp, "region")
+    os.mkdir(source)
+    base.save(os.path.join(source, "base.png"))
+    variant.save(os.path.join(source, "variant.png"))
+    
+    bbox = (1600, 900, 2112, 1412)
+    params = {"size": "%ix%i" % size, "region": "%ix%i" % (bbox[2] - bbox[0], bbox[3] - bbox[1])}
+    
+    for name, codec in sorted(CODECS.items()):
+        images = [HCGPackImage(key, os.path.join(source, key))
+                  for key in ("base.png", "variant.png")]
+        store = PayloadStore(temp)
+        images[1].make_ref(images[0], store, threshold=1.0, codec=codec)
+        
+        target = os.path.join(temp, "region_%s.hcg" % name)
+        packer = HCHPacker(target, version=2)
+        packer.write_comment_header()
+        packer.write_body(images)
+        packer.close()
+        store.close()
+        
+        archive = HCGArchive(target)
+        img = archive.get("variant.png")
+        img.get_region(bbox)
+        
+        bench.run("region.full.%s" % name, img.get_origin_image, **params)
+        bench.run("region.crop.%s" % name, lambda: img.get_region(bbox), **params)
+        archive.close()
+
+def bench_serve(bench, temp):
+    # Requests to a local hcg serve, archive is written by bench_archive
+    server = ArchiveServer([os.path.join(temp, "bench1.hcg")], ("127.0.0.1", 0), log=False)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    
+    url = "http://127.0.0.1:%i/bench1/" % server.server_address[1]
+    images = server.archives["bench1"].get_images()
+    stored = [img.key for img in images if not img.has_diff]
+    diffed = [img.key for img in images if img.has_diff]
+    
+    def fetch(keys):
+        for key in keys:
+            response = urlopen(url + key)
+            response.read()
+            response.close()
+    
+    try:
+        bench.run("serve.get.stored", lambda: fetch(stored), images=len(stored))
+        # First run rebuild images, the others are served from the cache
+        bench.run("serve.get.diffed", lambda: fetch(diffed), images=len(diffed))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def bench_cli(bench, source, temp, repeat):
+    hcg = os.path.join(ROOT, "hcg", "bin", "hcg")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    
+    target = os.path.join(temp, "cli.hcg")
+    extract_to = os.path.join(temp, "extract")
+    
+    def hcg_run(*args):
+        with open(os.devnull, "w") as null:
+            subprocess.check_call((sys.executable, hcg) + args, stdout=null, env=env)
+    
+    def clean_extract():
+        if os.path.isdir(extract_to):
+            shutil.rmtree(extract_to)
+    
+    bench.run("cli.c", lambda: hcg_run("c", target, source), repeat=repeat)
+    bench.run("cli.t", lambda: hcg_run("t", target), repeat=repeat)
+    bench.run("cli.x", lambda arg: hcg_run("x", target, extract_to),
+              setup=clean_extract, repeat=repeat)
+
+def git_commit():
+    try:
+        with open(os.devnull, "w") as null:
+            out = subprocess.check_output(("git", "rev-parse", "HEAD"), cwd=ROOT, stderr=null)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = json.load(f)
+    
+    old_results = dict((_result_id(r), r) for r in old["results"])
+    
+    print("\nCompared with %s (%s)" % (filename, old["meta"].get("commit")))
+    for r in results:
+        o = old_results.get(_result_id(r))
+        if o and o["min"]:
+            print("%-48s %8.2fx  %s" % (r["name"], r["min"] / o["min"],
+                                        " ".join("%s=%s" % i for i in sorted(r["params"].items()))))
+
+def _result_id(result):
+    return (result["name"], tuple(sorted(result["params"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description='HCG benchmarks')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='JSON result file (default: bench-<commit>.json)')
+    parser.add_argument('-k', dest='pattern', type=str, default=None,
+                        help='Only run benchmarks whose name contains this')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='Number of runs of each benchmark (default: 5)')
+    parser.add_argument('--quick', dest='quick', action='store_true',
+                        help='Small images and fewer images, for a smoke run')
+    parser.add_argument('--variants', dest='variants', type=int, default=6,
+                        help='Number of variants of each base image (default: 6)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed of the synthetic corpus (default: 0)')
+    parser.add_argument('--compare', dest='compare', type=str, default=None,
+                        help='Print time ratios against a previous JSON result')
+    options = parser.parse_args()
+    
+    sizes = options.quick and ((160, 120), ) or DEFAULT_SIZES
+    synthetic = options.quick and 200 or 2000
+    backends = kernels.available_backends()
+    
+    temp = tempfile.mkdtemp()
+    try:
+        source = os.path.join(temp, "source")
+        corpus = make_corpus(source, sizes=sizes, modes=DEFAULT_MODES,
+                             variants=options.variants, seed=options.seed)
+        
+        bench = Bench(options.repeat, options.pattern)
+        bench_kernels(bench, corpus, backends)
+        bench_codec(bench, corpus)
+        bench_ranking(bench, corpus, synthetic)
+        bench_archive(bench, source, corpus, temp)
+        bench_region(bench, temp)
+        bench_serve(bench, temp)
+        bench_cli(bench, source, temp, max(1, options.repeat // 2))
+    finally:
+        shutil.rmtree(temp)
+    
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count() if hasattr(os, "cpu_count") else None,
+            "backends": backends,
+            "default_backend": kernels.kernels.name,
+            "corpus": {
+                "sizes": ["%ix%i" % s for s in sizes],
+                "modes": list(DEFAULT_MODES),
+                "variants": options.variants,
+                "seed": options.seed,
+                "synthetic_samples": synthetic,
+            },
+        },
+        "results": bench.results,
+    }
+    
+    output = options.output or "bench-%s.json" % (commit and commit[:10] or "unknown")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("\nResults are written to %s" % output)
+    
+    if options.compare:
+        compare(bench.results, options.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+__all__ = ["make_corpus", "make_variants", "DEFAULT_SIZES", "DEFAULT_MODES"]
+
+DEFAULT_SIZES = ((320, 240), (1280, 720))
+DEFAULT_MODES = ("L", "RGB", "RGBA")
+
+# Usage sample:
+#
+# files = make_corpus("/tmp/corpus", sizes=((640, 480), ), variants=8)
+#
+# A corpus is a folder per (mode, size) with a base image and variants of it,
+# like event CGs which only differ by a character expression or an overlay.
+# The same seed always gives the same images.
+
+def _color(rnd, mode):
+    if mode == "L":
+        return rnd.randrange(256)
+    return tuple(rnd.randrange(256) for i in range(len(mode)))
+
+def make_base(mode, size, rnd):
+    img = Image.new(mode, size, _color(rnd, mode))
+    draw = ImageDraw.Draw(img)
+    w, h = size
+    
+    # Large shapes, so the image compresses like a drawing rather than noise
+    for i in range(40):
+        x, y = rnd.randrange(w), rnd.randrange(h)
+        rw, rh = rnd.randrange(w // 8 + 1, w // 2 + 2), rnd.randrange(h // 8 + 1, h // 2 + 2)
+        if i % 2:
+            draw.ellipse((x, y, x + rw, y + rh), fill=_color(rnd, mode))
+        else:
+            draw.rectangle((x, y, x + rw, y + rh), fill=_color(rnd, mode))
+    return img
+
+def make_variants(base, count, rnd):
+    # Variants of base with a small overlay each
+    w, h = base.size
+    for i in range(count):
+        img = base.copy()
+        draw = ImageDraw.Draw(img)
+        
+        for j in range(3):
+            x, y = rnd.randrange(w), rnd.randrange(h)
+            ow, oh = rnd.randrange(4, w // 10 + 5), rnd.randrange(4, h // 10 + 5)
+            draw.ellipse((x, y, x + ow, y + oh), fill=_color(rnd, base.mode))
+        yield img
+
+def make_corpus(path, sizes=DEFAULT_SIZES, modes=DEFAULT_MODES, variants=6, seed=0):
+    # Write the corpus to path, return written file names
+    files = []
+    
+    for mode in modes:
+        for size in sizes:
+            rnd = random.Random("%s:%s:%ix%i" % (seed, mode, size[0], size[1]))
+            folder = os.path.join(path, "%s_%ix%i" % (mode, size[0], size[1]))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            
+            base = make_base(mode, size, rnd)
+            filename = os.path.join(folder, "base.png")
+            base.save(filename)
+            files.append(filename)
+            
+            for i, img in enumerate(make_variants(base, variants, rnd)):
+                filename = os.path.join(folder, "v%02i.png" % i)
+                img.save(filename)
+                files.append(filename)
+    
+    return files
@@ -0,0 +1,105 @@
+
+import asyncio
+
+from hcg.archive import HCGArchive
+from hcg.threading_pool import Executor
+
+__all__ = ["AsyncHCGArchive"]
+
+DEFAULT_WORKERS = 4
+
+# Usage sample:
+#
+# archive = await AsyncHCGArchive.open("cg.hcg", max_workers=8)
+#
+# data = await archive.get_data("bg/001.png")        # stored file data
+# img = await archive.get_origin_image("ev/002.png") # decoded PIL Image
+#
+# await archive.close()
+#
+# Blocking reads and diff reconstruction run on an Executor of max_workers
+# threads (or on the given executor, which can be shared by archives), so
+# the number of threads does not grow with the number of requests.
+# Concurrent requests for the same key wait for the same load, the result
+# is shared between them: copy images before modifying them.
+
+class AsyncHCGArchive(object):
+    def __init__(self, executor=None, max_workers=DEFAULT_WORKERS):
+        # Use AsyncHCGArchive.open to create one
+        self.archive = None
+        self._own_executor = executor is None
+        self.executor = executor or Executor(max_workers, threads_name="AsyncHCGArchive")
+        self._inflight = {} # {(kind, key): asyncio.Future}
+    
+    @classmethod
+    async def open(cls, filename, executor=None, max_workers=DEFAULT_WORKERS,
+                   use_mmap=False, cache=None):
+        # Open the archive and load its index on the executor, use_mmap and
+        # cache are passed to HCGArchive
+        self = cls(executor, max_workers)
+        try:
+            self.archive = await self._run(self._open_archive, filename, use_mmap, cache)
+        except BaseException:
+            self._shutdown()
+            raise
+        return self
+    
+    @staticmethod
+    def _open_archive(filename, use_mmap, cache):
+        archive = HCGArchive(filename, use_mmap=use_mmap, cache=cache)
+        if archive.version != 2:
+            # Version 2 archives find keys without the whole index
+            archive.get_images()
+        return archive
+    
+    def _run(self, fn, *args):
+        return asyncio.wrap_future(self.executor.submit(fn, *args))
+    
+    def _load(self, kind, key, fn):
+        # Return an awaitable of fn(key), calls with the same kind and key
+        # share it until it is done
+        item = (kind, key)
+        future = self._inflight.get(item)
+        if future is None:
+            future = self._run(fn, key)
+            self._inflight[item] = future
+            future.add_done_callback(lambda f: self._inflight.pop(item, None))
+        
+        # A cancelled request does not cancel the load of the others
+        return asyncio.shield(future)
+    
+    async def get_data(self, key):
+        # Return stored data of the image (see HCGArchiveImage.get_data),
+        # raise KeyError if it does not exist
+        return await self._load("data", key, self._get_data)
+    
+    async def get_origin_image(self, key):
+        # Return the decoded PIL Image, diffed images are merged with their
+        # reference. Raise KeyError if it does not exist.
+        return await self._load("image", key, self._get_origin_image)
+    
+    def _get_data(self, key):
+        return self.archive.get(key).get_data()
+    
+    def _get_origin_image(self, key):
+        img = self.archive.get(key).get_origin_image()
+        img.load()
+        return img
+    
+    async def close(self):
+        try:
+            if self.archive is not None:
+                await self._run(self.archive.close)
+        finally:
+            self._shutdown()
+    
+    def _shutdown(self):
+        if self._own_executor:
+            # Workers are daemon threads, don't block the event loop
+            self.executor.shutdown(wait=False)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
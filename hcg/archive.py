@@ -1,14 +1,28 @@
 
 import os
+import mmap
 import struct
 from binascii import crc32
+from hashlib import sha1
+from threading import RLock
 
 from PIL import Image
 
+from hcg import stats
+from hcg.cache import ImageCache
+from hcg.codec import CODECS, CODEC_MASK
 from hcg.image import HCGImage
-from hcg.utils import BytesIO
+from hcg.utils import BufferReader, read_at
 
 PINDEX = struct.Struct("<HQQII")
+PINDEX2_HEADER = struct.Struct("<II")
+PINDEX2 = struct.Struct("<IHHQIII")
+PCRC32 = struct.Struct("<I")
+
+MAGIC_NUMBERS = {
+    b"HCG001\r\n": 1,
+    b"HCG002\r\n": 2,
+}
 
 class HCGArchive(object):
     comments = None
@@ -16,107 +30,517 @@ class HCGArchive(object):
     _images_dict = None
     _filename = None
     _head_index_offset = None
+    _index_offset = None
+    _mmap = None
+    _buffer = None
+    _records = None
+    _entries = None
+    _entries_dict = None
+    _index_length = None
+    _index_checked = False
+    _record_count = None
+    _key_table_offset = None
+    _cache = None
+    _cache_id = None
+    version = None
+    appended = False
     
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=False, cache=None):
+        # If use_mmap is True, the archive is memory-mapped and image data is
+        # returned as memoryview slices of the mapping rather than bytes.
+        # Images can be read from many threads, data is read with positional
+        # reads (os.pread) of the shared file.
+        # Decoded reference images are kept in `cache` (an ImageCache, the
+        # default cache is used if None), set cache to False to disable it.
         self._filename = filename
+        self._index_lock = RLock()
         
         f = self.f = open(self._filename, "rb")
         
+        if cache is None:
+            cache = ImageCache.default_cache()
+        if cache is not False:
+            stat = os.fstat(f.fileno())
+            self._cache = cache
+            self._cache_id = (stat.st_dev, stat.st_ino, stat.st_mtime)
+        
+        if use_mmap:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buffer = memoryview(self._mmap)
+        
         magicnumber = f.read(8)
-        if magicnumber != b"HCG001\r\n":
-            raise RuntimeError("%s is not a HCG archive")
-
+        if magicnumber not in MAGIC_NUMBERS:
+            raise RuntimeError("%s is not a HCG archive" % filename)
+        
+        self.version = MAGIC_NUMBERS[magicnumber]
+        
         comments_length = int(f.read(8).strip(), 16)
         
         self.comments = f.read(comments_length)
         self._head_index_offset = 16 + comments_length
+        self._index_offset = self._locate_index()
+    
+    def _locate_index(self):
+        # Images appended to the archive are only in the tail index, which is
+        # longer than the head index then (see doc/formats).
+        self.f.seek(0, 2)
+        file_size = self.f.tell()
+        
+        self.f.seek(self._head_index_offset)
+        head_length = struct.unpack("<Q", self.f.read(8))[0]
+        self._index_length = head_length
+        
+        self.f.seek(-8, 2)
+        tail_index_pos = struct.unpack("<Q", self.f.read(8))[0]
         
+        if tail_index_pos + 8 > file_size:
+            # Broken trailer, validate_tail_index will tell
+            return self._head_index_offset
+        
+        self.f.seek(tail_index_pos)
+        tail_length = struct.unpack("<Q", self.f.read(8))[0]
+        
+        if tail_length != head_length:
+            self.appended = True
+            self._index_length = tail_length
+            return tail_index_pos
+        return self._head_index_offset
+    
     def _load_images(self):
-        self._load_image_from_head_index()
+        with self._index_lock:
+            if self._images is not None:
+                return
+            
+            entries = self._load_entries()
+            images = [self._entry_image(entry) for entry in entries]
+            
+            self._images_dict = dict((img.key, img) for img in images)
+            self._images = images
     
-    def _load_image_from_head_index(self):
-        images = []
-        images_dict = {}
+    def _read_at(self, position, size):
+        if self._buffer is not None:
+            return self._buffer[position:position + size]
         
-        self.f.seek(self._head_index_offset)
+        buf = read_at(self.f, position, size)
+        stats.incr("archive.bytes_read", len(buf))
+        return buf
+    
+    def _create_image(self, key, index_offset, position, size, data_crc32, flags=0):
+        if self._cache is not None:
+            cache_key = self._cache_id + (index_offset, )
+        else:
+            cache_key = None
+        
+        img = HCGArchiveImage(self.f, key, position, size, data_crc32,
+                              self._buffer, self._cache, cache_key)
+        
+        codec = flags & CODEC_MASK
+        if codec not in CODECS.values():
+            raise RuntimeError("%s is encoded by an unknown codec (%i)" % (key, codec))
+        img.codec = codec
+        return img
+    
+    def _read_index(self):
+        # Read the index with its length and CRC32 in one read, return a
+        # memoryview of image_index after its CRC32 is checked
+        length = self._index_length
+        buf = self._read_at(self._index_offset, 8 + length + 4)
+        if len(buf) != 8 + length + 4:
+            raise RuntimeError("HCG archive is truncated")
+        
+        view = memoryview(buf)[8:8 + length]
+        expected_crc32 = PCRC32.unpack_from(buf, 8 + length)[0]
+        if crc32(view) & 0xffffffff != expected_crc32:
+            if self._index_offset == self._head_index_offset:
+                raise RuntimeError("HCG archive header index broken")
+            raise RuntimeError("HCG archive tail index broken")
         
-        offset = 8
-        header_index_size = struct.unpack("<Q", self.f.read(8))[0]
+        self._index_checked = True
+        return view
+    
+    def _load_entries(self):
+        # Parse the whole index into _IndexEntry, images are created from
+        # entries when they are accessed
+        with self._index_lock:
+            if self._entries is not None:
+                return self._entries
+            
+            with stats.stage("archive.load_index"):
+                view = self._read_index()
+                try:
+                    if self.version == 2:
+                        entries = self._parse_records(view)
+                    else:
+                        entries = self._parse_header_index(view)
+                finally:
+                    view.release()
+            
+            self._entries_dict = dict((entry.key, entry) for entry in entries)
+            self._entries = entries
+            return entries
+    
+    def _parse_header_index(self, view):
+        entries = []
+        entries_offset = {}
+        unpack_from = PINDEX.unpack_from
         
-        index_set = {}
-        index_ref = {}
-        while offset < header_index_size:
-            buf = self.f.read(26)
-            keylen, data_ptr, ref_ptr, img_size, img_crc32 = PINDEX.unpack(buf)
-            key = self.f.read(keylen).decode()
+        # Offsets of entries, which are used by references, count from
+        # image_index_length
+        base = self._index_offset + 8
+        offset, end = 0, len(view)
+        while offset < end:
+            keylen, data_ptr, ref_ptr, img_size, img_crc32 = unpack_from(view, offset)
+            key = view[offset + PINDEX.size:offset + PINDEX.size + keylen].tobytes().decode()
+            
+            entry = _IndexEntry(key, base + offset, data_ptr, ref_ptr, img_size, img_crc32)
+            entries.append(entry)
+            entries_offset[entry.index_offset] = entry
             
-            img = HCGArchiveImage(self.f, key, data_ptr, img_size, img_crc32)
-            images.append(img)
-            images_dict[key] = img
+            offset += PINDEX.size + keylen
+        
+        for entry in entries:
+            if entry.ref:
+                entry.ref = entries_offset[entry.ref]
+            else:
+                entry.ref = None
+        
+        return entries
+    
+    def _parse_records(self, view):
+        count, key_table_length = PINDEX2_HEADER.unpack_from(view, 0)
+        key_table = PINDEX2_HEADER.size + count * PINDEX2.size
+        unpack_from = PINDEX2.unpack_from
+        
+        base = self._records_offset()
+        entries = []
+        for record_id in range(count):
+            offset = PINDEX2_HEADER.size + record_id * PINDEX2.size
+            key_offset, keylen, flags, data_ptr, ref_record, img_size, img_crc32 = \
+                unpack_from(view, offset)
+            key = view[key_table + key_offset:key_table + key_offset + keylen].tobytes().decode()
             
-            index_set[offset + self._head_index_offset] = img
-            if ref_ptr:
-                index_ref[img] = ref_ptr
+            entry = _IndexEntry(key, base + record_id * PINDEX2.size, data_ptr,
+                                ref_record, img_size, img_crc32, flags)
             
-            offset += 26 + keylen
-
-        for img, ref_ptr in index_ref.items():
-            img.set_ref(index_set[ref_ptr])
+            # Images already loaded by binary search are kept
+            if self._records:
+                entry.image = self._records.get(record_id)
+            entries.append(entry)
+        
+        for entry in entries:
+            entry.ref = entry.ref and entries[entry.ref - 1] or None
         
-        self._images = images
-        self._images_dict = images_dict
+        return entries
     
-    def _get_index_crc32(self):
-        index_size = struct.unpack("<Q", self.f.read(8))[0]
-        buf = self.f.read(index_size)
-        expected_crc32 = struct.unpack("<i", self.f.read(4))[0]
-        real_crc32 = crc32(buf)
-        return expected_crc32, real_crc32
+    def _entry_image(self, entry):
+        if entry.image is not None:
+            return entry.image
+        
+        with self._index_lock:
+            if entry.image is None:
+                img = self._create_image(entry.key, entry.index_offset, entry.position,
+                                         entry.size, entry.crc32, entry.flags)
+                if entry.ref is not None:
+                    img.set_ref(self._entry_image(entry.ref))
+                entry.image = img
+        
+        return entry.image
+    
+    def _load_records_header(self):
+        if self._records is not None:
+            return
+        
+        with self._index_lock:
+            if self._records is not None:
+                return
+            
+            # Skip image_index_length, records follow the index header
+            count, key_table_length = PINDEX2_HEADER.unpack(
+                self._read_at(self._index_offset + 8, PINDEX2_HEADER.size))
+            
+            self._record_count = count
+            self._key_table_offset = self._records_offset() + count * PINDEX2.size
+            self._records = {}
+    
+    def _records_offset(self):
+        return self._index_offset + 8 + PINDEX2_HEADER.size
+    
+    def _read_record(self, record_id):
+        buf = self._read_at(self._records_offset() + record_id * PINDEX2.size,
+                            PINDEX2.size)
+        return PINDEX2.unpack(buf)
+    
+    def _read_record_key(self, key_offset, keylen):
+        return bytes(self._read_at(self._key_table_offset + key_offset, keylen))
+    
+    def _find_record(self, key):
+        # Binary search on the sorted records, return record number or None
+        lo, hi = 0, self._record_count
         
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_offset, keylen = self._read_record(mid)[:2]
+            record_key = self._read_record_key(key_offset, keylen)
+            
+            if record_key < key:
+                lo = mid + 1
+            elif record_key > key:
+                hi = mid
+            else:
+                return mid
+        
+        return None
+    
+    def _load_record(self, record_id):
+        img = self._records.get(record_id)
+        if img is not None:
+            return img
+        
+        with self._index_lock:
+            img = self._records.get(record_id)
+            if img is not None:
+                return img
+            
+            key_offset, keylen, flags, data_ptr, ref_record, img_size, img_crc32 = \
+                self._read_record(record_id)
+            key = self._read_record_key(key_offset, keylen).decode()
+            
+            img = self._create_image(
+                key, self._records_offset() + record_id * PINDEX2.size,
+                data_ptr, img_size, img_crc32, flags)
+            if ref_record:
+                img.set_ref(self._load_record(ref_record - 1))
+            
+            self._records[record_id] = img
+            return img
+    
+    def get(self, key):
+        # Return HCGArchiveImage of the key, raise KeyError if it does not
+        # exist. For version 2 archives, only the records on the binary search
+        # path (and the reference chain) are read, and the index CRC32 is not
+        # checked. Version 1 indexes are parsed as a whole, but images are
+        # only created for the key and its reference chain.
+        if self._images_dict is not None:
+            return self._images_dict[key]
+        
+        if self._entries_dict is not None:
+            return self._entry_image(self._entries_dict[key])
+        
+        if self.version == 2:
+            self._load_records_header()
+            
+            record_id = self._find_record(key.encode())
+            if record_id is None:
+                raise KeyError(key)
+            return self._load_record(record_id)
+        else:
+            self._load_entries()
+            return self._entry_image(self._entries_dict[key])
+    
+    def get_region(self, key, bbox):
+        # Return the (x0, y0, x1, y1) region of the image as a PIL Image, see
+        # HCGImage.get_region. Raise KeyError if it does not exist.
+        return self.get(key).get_region(bbox)
+    
+    def _get_index_crc32(self, position):
+        index_size = struct.unpack("<Q", bytes(self._read_at(position, 8)))[0]
+        buf = self._read_at(position + 8, index_size + 4)
+        expected_crc32 = struct.unpack("<I", bytes(buf[index_size:]))[0]
+        real_crc32 = crc32(buf[:index_size]) & 0xffffffff
+        return expected_crc32, real_crc32
+    
     def validate_header_index(self):
-        self.f.seek(self._head_index_offset)
-        expected_crc32, real_crc32 = self._get_index_crc32()
+        if self._index_checked and self._index_offset == self._head_index_offset:
+            # Checked when the index was loaded
+            return
+        
+        expected_crc32, real_crc32 = self._get_index_crc32(self._head_index_offset)
         
         if real_crc32 != expected_crc32:
             raise RuntimeError("HCG archive header index broken")
     
     def validate_tail_index(self):
-        self.f.seek(-8, 2)
-        tail_index_pos = struct.unpack("<Q", self.f.read(8))[0]
+        file_size = os.fstat(self.f.fileno()).st_size
+        tail_index_pos = struct.unpack("<Q", bytes(self._read_at(file_size - 8, 8)))[0]
         
-        self.f.seek(tail_index_pos - 8)
-        buf = self.f.read(8)
+        buf = bytes(self._read_at(tail_index_pos - 8, 8))
         
         if buf != b"\x00\x00\x00\x00\x00\x00\x00\x00":
             raise RuntimeError("HCG archive tail index broken")
-            
-        expected_crc32, real_crc32 = self._get_index_crc32()
+        
+        if self._index_checked and self._index_offset == tail_index_pos:
+            return
+        
+        expected_crc32, real_crc32 = self._get_index_crc32(tail_index_pos)
         
         if real_crc32 != expected_crc32:
             raise RuntimeError("HCG archive tail index broken")
-        
+    
     def get_images(self):
         if not self._images: self._load_images()
         return list(self._images)
+    
+    def iter_images(self, prefix=None):
+        # Yield HCGArchiveImage of keys starting with prefix (all images if
+        # None) in dependency order: a reference image comes before the
+        # images diffed with it, and each reference tree is walked depth
+        # first in sorted order.
+        for img, selected, dependents in self._walk_images(prefix):
+            if selected:
+                yield img
+    
+    def iter_decoded(self, prefix=None, raw=False):
+        # Yield (key, PIL Image) of keys starting with prefix in the order of
+        # iter_images, or (key, (mode, size, data)) if raw is True. Each
+        # reference image is decoded once and kept only until its last
+        # dependent is decoded, so at most one decoded image per level of the
+        # current reference chain is held. References of selected images are
+        # decoded even if their keys do not match prefix.
+        buffers = {}   # {HCGArchiveImage: (mode, size, data)}
+        remaining = {} # {HCGArchiveImage: number of dependents to decode}
+        
+        for img, selected, dependents in self._walk_images(prefix):
+            if img.has_diff:
+                buf = img.merge_buffer(buffers[img.ref])
+                
+                remaining[img.ref] -= 1
+                if not remaining[img.ref]:
+                    del buffers[img.ref]
+                    del remaining[img.ref]
+                
+                decoded = None
+            else:
+                decoded = img.get_image()
+                with stats.stage("decode.image"):
+                    decoded.load()
+                buf = None
+            
+            if dependents:
+                buf = buf or (decoded.mode, decoded.size, decoded.tobytes())
+                buffers[img] = buf
+                remaining[img] = dependents
+            
+            if selected:
+                if raw:
+                    yield img.key, buf or (decoded.mode, decoded.size, decoded.tobytes())
+                else:
+                    yield img.key, decoded or Image.frombytes(*buf)
+    
+    def _walk_images(self, prefix):
+        # Yield (image, selected, number of dependents) of selected images
+        # and their references in dependency order
+        needed = set()
+        selected = set()
+        for img in self.get_images():
+            if prefix and not img.key.startswith(prefix):
+                continue
+            
+            selected.add(img)
+            while img is not None and img not in needed:
+                needed.add(img)
+                img = img.ref
+        
+        children = {}
+        for img in needed:
+            if img.ref:
+                children.setdefault(img.ref, []).append(img)
+        
+        stack = sorted((img for img in needed if not img.ref), reverse=True)
+        while stack:
+            img = stack.pop()
+            dependents = children.get(img, ())
+            
+            yield img, img in selected, len(dependents)
+            stack.extend(sorted(dependents, reverse=True))
+    
+    def close(self):
+        if self._buffer is not None:
+            # Data views still in use keep the mapping alive, it will be
+            # unmapped when the last of them is released.
+            self._buffer.release()
+            self._buffer = None
+            self._mmap = None
+        
+        self.f.close()
+
+class _IndexEntry(object):
+    # An image in the index, ref is the _IndexEntry of its reference and
+    # image its HCGArchiveImage once it is accessed
+    __slots__ = ("key", "index_offset", "position", "ref", "size", "crc32", "flags", "image")
+    
+    def __init__(self, key, index_offset, position, ref, size, crc32, flags=0):
+        self.key = key
+        self.index_offset = index_offset
+        self.position = position
+        self.ref = ref
+        self.size = size
+        self.crc32 = crc32
+        self.flags = flags
+        self.image = None
 
 class HCGArchiveImage(HCGImage):
-    def __init__(self, f, key, position, size, data_crc32):
+    def __init__(self, f, key, position, size, data_crc32, buf=None,
+                 cache=None, cache_key=None):
         super(HCGArchiveImage, self).__init__(key)
         
         self._f = f
+        self._buf = buf
+        self._cache = cache
+        self._cache_key = cache_key
         self._position = position
         self._size = size
         self._crc32 = data_crc32
     
+    @property
+    def position(self):
+        # Return offset of image data in the archive
+        return self._position
+    
+    @property
+    def digest(self):
+        # Data of an image without reference is its source file
+        if self._digest is None and not self.has_diff:
+            self._digest = sha1(self.get_data()).hexdigest()
+        return self._digest
+    
+    def open_data(self):
+        # Return a file object of image data so it can be copied by kernel
+        # when the archive is rewritten
+        if self._buf is not None:
+            return BufferReader(self.get_data())
+        
+        f = open(self._f.name, "rb")
+        f.seek(self._position)
+        return f
+    
     def get_image(self):
-        buf = BytesIO(self.get_data())
-        return Image.open(buf)
+        if self.has_diff:
+            return self.get_diff_image(self.get_data())
+        return Image.open(BufferReader(self.get_data()))
+    
+    def get_image_buffer(self):
+        # Reference images are decoded once for all images diffed with them
+        def loader():
+            img = self.get_image()
+            with stats.stage("decode.image"):
+                data = img.tobytes()
+            return img.mode, img.size, data
         
+        if self._cache is not None:
+            return self._cache.get_or_load(self._cache_key, loader)
+        else:
+            return loader()
+    
     def get_data(self):
-        self._f.seek(self._position)
-        return self._f.read(self._size)
+        # Return bytes, or a memoryview of the mapped archive if the archive
+        # is opened with use_mmap.
+        if self._buf is not None:
+            return self._buf[self._position:self._position + self._size]
+        
+        buf = read_at(self._f, self._position, self._size)
+        stats.incr("archive.bytes_read", len(buf))
+        return buf
     
     def calculate_crc32(self):
         buf = self.get_data()
         return crc32(buf) & 0xffffffff
-    
\ No newline at end of file
@@ -0,0 +1,173 @@
+
+from threading import Lock
+from collections import OrderedDict
+
+from PIL import Image
+
+from hcg import stats
+
+__all__ = ["ImageCache", "ImagePool"]
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_POOL_SIZE = 32
+DEFAULT_POOL_BYTES = 256 * 1024 * 1024
+
+# Usage sample:
+#
+# cache = ImageCache(max_bytes=64 * 1024 * 1024)
+# archive = HCGArchive("cg.hcg", cache=cache)
+#
+# for image in archive.get_images():
+#     image.extract_to("output")
+#
+# print(cache.stats())
+#
+class ImageCache(object):
+    # A thread-safe LRU cache of decoded image buffers, limited by the total
+    # size of the cached buffers. Values are (mode, size, data) tuples as
+    # returned by HCGImage.get_image_buffer.
+    __default_cache = None
+    
+    @classmethod
+    def default_cache(cls):
+        if not cls.__default_cache:
+            cls.__default_cache = cls()
+        return cls.__default_cache
+    
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self._items = OrderedDict()
+        self._lock = Lock()
+    
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            
+            self._items[key] = value
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        nbytes = len(value[2])
+        
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= len(self._items.pop(key)[2])
+            
+            if nbytes > self.max_bytes:
+                # Never fit, don't flush the whole cache for it
+                return
+            
+            self._items[key] = value
+            self.current_bytes += nbytes
+            self._evict()
+    
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.put(key, value)
+        return value
+    
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+    
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            key, value = self._items.popitem(last=False)
+            self.current_bytes -= len(value[2])
+            self.evictions += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "items": len(self._items),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class ImagePool(object):
+    # A thread-safe LRU pool of decoded image files, limited by the number of
+    # images and by their decoded size. Images are fully loaded and their
+    # files are closed when they are opened, so the pool never hold file
+    # descriptors.
+    __default_pool = None
+    
+    @classmethod
+    def default_pool(cls):
+        if cls.__default_pool is None:
+            cls.__default_pool = cls()
+        return cls.__default_pool
+    
+    def __init__(self, max_images=DEFAULT_POOL_SIZE, max_bytes=DEFAULT_POOL_BYTES):
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        
+        self._items = OrderedDict() # {filename: (PIL Image, decoded bytes)}
+        self._lock = Lock()
+    
+    def open(self, filename):
+        with self._lock:
+            item = self._items.pop(filename, None)
+            if item is not None:
+                self._items[filename] = item
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+        
+        img = load_image(filename)
+        nbytes = img.size[0] * img.size[1] * len(img.getbands())
+        
+        with self._lock:
+            if filename in self._items:
+                self.current_bytes -= self._items.pop(filename)[1]
+            
+            if nbytes > self.max_bytes:
+                # Never fit, don't flush the whole pool for it
+                return img
+            
+            self._items[filename] = (img, nbytes)
+            self.current_bytes += nbytes
+            while len(self._items) > self.max_images or self.current_bytes > self.max_bytes:
+                self.current_bytes -= self._items.popitem(last=False)[1][1]
+        
+        return img
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+def load_image(fp):
+    # Open and decode an image from a filename or a file object, the file is
+    # closed when this function returns.
+    if not hasattr(fp, "read"):
+        fp = open(fp, "rb")
+    
+    with fp, stats.stage("decode.image"):
+        img = Image.open(fp)
+        img.load()
+    return img
@@ -0,0 +1,229 @@
+
+import zlib
+import struct
+from multiprocessing import cpu_count
+from threading import Lock
+
+from hcg import stats
+from hcg.kernels import kernels
+from hcg.sampling import split_rect
+from hcg.threading_pool import Executor
+
+__all__ = ["CODEC_PNG", "CODEC_DELTA", "CODEC_TILED", "CODECS", "CODEC_MASK",
+           "encode_delta", "encode_tiles", "decode_delta", "decode_region",
+           "read_delta_header", "crop_data"]
+
+# Diff codecs, stored in image_flags of HCG002 records (see doc/formats)
+CODEC_PNG = 0
+CODEC_DELTA = 1
+CODEC_TILED = 2
+CODECS = {"png": CODEC_PNG, "delta": CODEC_DELTA, "tiled": CODEC_TILED}
+CODEC_MASK = 0x000f
+
+DELTA_MAGIC = b"HCGD"
+TILES_MAGIC = b"HCGT"
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_LEVEL = 6
+
+P_DELTA_HEADER = struct.Struct("<4sB7sIIII")
+P_CHUNK_LENGTH = struct.Struct("<I")
+
+# Usage sample:
+#
+# buf = encode_delta(img.mode, img.size, img.tobytes(), ref.tobytes(), threads=4)
+# mode, size, data = decode_delta(buf, ref_buffer, threads=4)
+# mode, size, diff_data = decode_delta(buf)   # without merging
+#
+# A delta payload is the diff_data output split in chunks of chunk_size
+# bytes, each compressed by zlib on its own. With threads > 1, chunks are
+# compressed and decompressed by a shared thread pool (zlib releases the
+# GIL), each decompressed chunk is merged with its slice of the reference
+# straight into the output buffer.
+#
+# buf = encode_tiles(img.mode, img.size, img.tobytes(), ref.tobytes())
+# mode, size, data = decode_region(buf, (x0, y0, x1, y1), ref_region_buffer)
+#
+# A tiled payload has the same layout, but its chunks are the tiles of the
+# split_rect grid (row by row, rows of a tile are contiguous), so a region
+# is decoded from the tiles it overlaps only. decode_delta decodes both.
+
+_executor = None
+_executor_lock = Lock()
+
+def _get_executor():
+    # Own pool, tasks of the default executor may wait for these. Decoders
+    # run in many threads (verify, server, aio), only one pool is created.
+    global _executor
+    
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor(cpu_count(), threads_name="Codec")
+        return _executor
+
+def _map(fn, items, threads):
+    if threads <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    
+    futures = _get_executor().submit_batch([(fn, (item, ), {}) for item in items])
+    return [f.result() for f in futures]
+
+def encode_delta(mode, size, data, ref_data, threads=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                 level=DEFAULT_LEVEL):
+    # Return delta payload of image data (bytes) and reference image data,
+    # data is modified in place.
+    with stats.stage("kernel.diff"):
+        data = kernels.diff_data(data, ref_data, threads)
+    
+    view = memoryview(data)
+    chunks = [view[i:i + chunk_size] for i in range(0, len(view), chunk_size)]
+    return _pack(DELTA_MAGIC, mode, size, chunk_size, chunks, threads, level)
+
+def encode_tiles(mode, size, data, ref_data, threads=1, level=DEFAULT_LEVEL):
+    # Return tiled delta payload of image data (bytes) and reference image
+    # data, data is modified in place.
+    with stats.stage("kernel.diff"):
+        data = kernels.diff_data(data, ref_data, threads)
+    
+    width, height = size
+    chunks = [crop_data(data, width, height, bbox) for bbox in split_rect(width, height)]
+    return _pack(TILES_MAGIC, mode, size, 0, chunks, threads, level)
+
+def _pack(magic, mode, size, chunk_size, chunks, threads, level):
+    with stats.stage("encode.delta"):
+        chunks = _map(lambda chunk: zlib.compress(chunk, level), chunks, threads)
+    
+    width, height = size
+    mode = mode.encode()
+    buf = b"".join([P_DELTA_HEADER.pack(magic, len(mode), mode, width, height,
+                                        chunk_size, len(chunks))] +
+                   [P_CHUNK_LENGTH.pack(len(chunk)) for chunk in chunks] + chunks)
+    
+    stats.incr("encode.bytes", len(buf))
+    return buf
+
+def crop_data(data, width, height, bbox):
+    # Return bytes of the pixels of bbox in image data, row by row
+    x0, y0, x1, y1 = bbox
+    bands = len(data) // (width * height)
+    row = width * bands
+    
+    view = memoryview(data)
+    return b"".join([view[y * row + x0 * bands:y * row + x1 * bands]
+                     for y in range(y0, y1)])
+
+def read_delta_header(buf):
+    # Return (mode, size, chunk_size, [(offset, length) of chunks in buf]),
+    # chunk_size is 0 for tiled payloads
+    magic, mode_length, mode, width, height, chunk_size, count = \
+        P_DELTA_HEADER.unpack_from(buf, 0)
+    if magic not in (DELTA_MAGIC, TILES_MAGIC):
+        raise RuntimeError("Not a delta payload")
+    if (magic == TILES_MAGIC) != (chunk_size == 0):
+        raise RuntimeError("Delta payload is broken")
+    
+    offset = P_DELTA_HEADER.size + count * P_CHUNK_LENGTH.size
+    chunks = []
+    for i in range(count):
+        length = P_CHUNK_LENGTH.unpack_from(buf, P_DELTA_HEADER.size + i * P_CHUNK_LENGTH.size)[0]
+        chunks.append((offset, length))
+        offset += length
+    
+    if offset > len(buf):
+        raise RuntimeError("Delta payload is truncated")
+    
+    return mode[:mode_length].decode(), (width, height), chunk_size, chunks
+
+def decode_delta(buf, ref_buffer=None, threads=1):
+    # Return (mode, size, data) of a delta payload, merged with ref_buffer
+    # ((mode, size, data) of the reference image) if it is given
+    view = memoryview(buf)
+    mode, size, chunk_size, chunks = read_delta_header(view)
+    if chunk_size == 0:
+        return decode_region(buf, (0, 0) + size, ref_buffer, threads)
+    
+    if ref_buffer is None:
+        with stats.stage("decode.delta"):
+            data = b"".join(_map(lambda chunk: zlib.decompress(view[chunk[0]:chunk[0] + chunk[1]]),
+                                 chunks, threads))
+        return mode, size, data
+    
+    ref_mode, ref_size, ref_data = ref_buffer
+    if (ref_mode, ref_size) != (mode, size) or \
+            not (len(chunks) - 1) * chunk_size < len(ref_data) <= len(chunks) * chunk_size:
+        raise RuntimeError("Reference image does not match delta payload")
+    
+    # Each chunk is merged with its slice of the reference and written to
+    # the output buffer, so no whole diff image is held
+    data = bytearray(len(ref_data))
+    ref_view = memoryview(ref_data)
+    
+    def decode_chunk(item):
+        index, (offset, length) = item
+        position = index * chunk_size
+        chunk = zlib.decompress(view[offset:offset + length])
+        end = position + len(chunk)
+        if len(chunk) != min(chunk_size, len(ref_data) - position):
+            raise RuntimeError("Reference image does not match delta payload")
+        data[position:end] = kernels.merge_data(chunk, bytes(ref_view[position:end]))
+    
+    with stats.stage("decode.delta"):
+        _map(decode_chunk, list(enumerate(chunks)), threads)
+    return mode, size, data
+
+def decode_region(buf, bbox, ref_buffer=None, threads=1):
+    # Return (mode, size, data) of the bbox region of a tiled payload, only
+    # tiles overlapping bbox are decompressed. ref_buffer is the same region
+    # of the reference image.
+    view = memoryview(buf)
+    mode, size, chunk_size, chunks = read_delta_header(view)
+    if chunk_size != 0:
+        raise RuntimeError("Not a tiled delta payload")
+    
+    width, height = size
+    tiles = list(split_rect(width, height))
+    if len(tiles) != len(chunks):
+        raise RuntimeError("Tiles do not match image size")
+    
+    x0, y0, x1, y1 = bbox
+    if not (0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height):
+        raise RuntimeError("Region %r is out of image %ix%i" % (bbox, width, height))
+    
+    needed = [(tile, chunk) for tile, chunk in zip(tiles, chunks)
+              if tile[0] < x1 and x0 < tile[2] and tile[1] < y1 and y0 < tile[3]]
+    
+    with stats.stage("decode.delta"):
+        decoded = _map(lambda item: zlib.decompress(view[item[1][0]:item[1][0] + item[1][1]]),
+                       needed, threads)
+    stats.incr("decode.tiles", len(needed))
+    
+    # Copy rows of the overlapping part of each tile to the region
+    tx0, ty0, tx1, ty1 = needed[0][0]
+    bands = len(decoded[0]) // ((tx1 - tx0) * (ty1 - ty0))
+    row = (x1 - x0) * bands
+    data = bytearray(row * (y1 - y0))
+    for ((tx0, ty0, tx1, ty1), chunk), tile_data in zip(needed, decoded):
+        tile_data = memoryview(tile_data)
+        tile_row = (tx1 - tx0) * bands
+        left, right = max(x0, tx0), min(x1, tx1)
+        top, bottom = max(y0, ty0), min(y1, ty1)
+        length = (right - left) * bands
+        
+        offsets = range((top - ty0) * tile_row + (left - tx0) * bands,
+                        (bottom - ty0) * tile_row, tile_row)
+        positions = range((top - y0) * row + (left - x0) * bands, len(data), row)
+        for offset, position in zip(offsets, positions):
+            data[position:position + length] = tile_data[offset:offset + length]
+    
+    return _merge(mode, (x1 - x0, y1 - y0), data, ref_buffer, threads)
+
+def _merge(mode, size, data, ref_buffer, threads):
+    if ref_buffer is None:
+        return mode, size, data
+    
+    ref_mode, ref_size, ref_data = ref_buffer
+    if (ref_mode, ref_size, len(ref_data)) != (mode, size, len(data)):
+        raise RuntimeError("Reference image does not match delta payload")
+    
+    with stats.stage("kernel.merge"):
+        data = kernels.merge_data(data, ref_data, threads)
+    return mode, size, data
@@ -0,0 +1,161 @@
+
+import json
+import time
+import sqlite3
+from threading import Lock
+
+from hcg.codec import CODEC_PNG
+
+__all__ = ["DiskCache"]
+
+DEFAULT_DISK_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Usage sample:
+#
+# cache = DiskCache("hcg-cache.db", max_bytes=512 * 1024 * 1024)
+#
+# sample = cache.get_sample(image.digest)
+# if sample is None:
+#     cache.put_sample(image.digest, image.sample)
+#
+# cache.put_diff(image.digest, ref.digest, len(buf), buf)
+# length, buf = cache.get_diff(image.digest, ref.digest)
+#
+# cache.close()
+#
+# Entries are keyed by content hashes of source files (HCGImage.digest), so
+# they stay valid when files are moved or renamed. When total size of entries
+# is more than max_bytes, least recently used entries are deleted.
+
+class DiskCache(object):
+    def __init__(self, filename, max_bytes=DEFAULT_DISK_CACHE_SIZE):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self._lock = Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kind TEXT, key TEXT, value BLOB, size INTEGER, used REAL, "
+            "PRIMARY KEY (kind, key))")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        
+        self.current_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    
+    def _get(self, kind, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM entries WHERE kind = ? AND key = ?",
+                (kind, key)).fetchone()
+            
+            if row is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self._db.execute(
+                "UPDATE entries SET used = ? WHERE kind = ? AND key = ?",
+                (time.time(), kind, key))
+            return row[0]
+    
+    def _put(self, kind, key, value):
+        size = len(value)
+        
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size FROM entries WHERE kind = ? AND key = ?",
+                (kind, key)).fetchone()
+            if row is not None:
+                self.current_bytes -= row[0]
+            
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (kind, key, sqlite3.Binary(value), size, time.time()))
+            self.current_bytes += size
+            
+            if self.current_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT kind, key, size FROM entries ORDER BY used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            
+            for kind, key, size in rows:
+                self._db.execute(
+                    "DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+                self.current_bytes -= size
+                self.evictions += 1
+                
+                if self.current_bytes <= self.max_bytes:
+                    break
+    
+    def get_sample(self, digest):
+        value = self._get("sample", digest)
+        if value is None:
+            return None
+        return json.loads(bytes(value).decode())
+    
+    def put_sample(self, digest, sample):
+        self._put("sample", digest, json.dumps(sample).encode())
+    
+    def get_rank(self, exact, key, digest):
+        # Return (run, is base, ref key, ref digest, score) of an image ranked
+        # by rank_images, or None
+        value = self._get("rank", "%i:%s:%s" % (exact and 1 or 0, key, digest))
+        if value is None:
+            return None
+        return tuple(json.loads(bytes(value).decode()))
+    
+    def put_rank(self, exact, key, digest, rank):
+        self._put("rank", "%i:%s:%s" % (exact and 1 or 0, key, digest),
+                  json.dumps(list(rank)).encode())
+    
+    def get_diff(self, digest, ref_digest, codec=CODEC_PNG):
+        # Return (length, diff image) of a diff result, diff image is None if
+        # only its length was stored. Return None if there is no result.
+        value = self._get("diff", _diff_key(digest, ref_digest, codec))
+        if value is None:
+            return None
+        
+        value = bytes(value)
+        length = int(value[:16], 16)
+        return length, value[16:] or None
+    
+    def put_diff(self, digest, ref_digest, length, buf=None, codec=CODEC_PNG):
+        # Store a diff result, rejected diffs can be stored by length only
+        self._put("diff", _diff_key(digest, ref_digest, codec),
+                  ("%016x" % length).encode() + (buf or b""))
+    
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+    
+    def close(self):
+        self.commit()
+        self._db.close()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def _diff_key(digest, ref_digest, codec):
+    # PNG diff images are stored without codec, as before codecs
+    if codec != CODEC_PNG:
+        return "%s:%s:%i" % (digest, ref_digest, codec)
+    return "%s:%s" % (digest, ref_digest)
@@ -0,0 +1,263 @@
+
+from collections import deque
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+
+from hcg.cache import load_image
+from hcg.codec import CODEC_PNG
+from hcg.image import encode_diff_image
+
+__all__ = ["encode_diffs"]
+
+DEFAULT_MEMORY_LIMIT = 1024 * 1024 * 1024
+
+# Usage sample:
+#
+# images_ref = {HCGPackImage: candidate HCGPackImage or None, ...}
+# encode_diffs(images, images_ref, store, jobs=8)
+#
+# Trial diffs are encoded by a process pool. Reference pixels are decoded
+# once in this process and shared with workers through shared memory, workers
+# decode their own image from file.
+#
+# An image is diffed with the root of its candidate (the candidate itself if
+# it has no reference), so its trial starts after the trial of the candidate
+# is done. Results are applied in image order, so the archive is the same as
+# calling image.make_ref(ref, store) one by one. Candidates may be images not
+# in `images` (images of an archive being appended to), their references
+# never change.
+#
+# `memory_limit` bound bytes of pixel buffers (shared reference buffers and
+# images being encoded) in use at the same time.
+#
+# If `cache` (a DiskCache) is given, diff results of (image, reference) pairs
+# found in it are not encoded again, new results are stored to it.
+#
+# `codec` is the codec of diff images (see hcg.codec).
+
+def encode_diffs(images, images_ref, store, jobs=cpu_count(),
+                 memory_limit=DEFAULT_MEMORY_LIMIT, threshold=0.5, cache=None,
+                 codec=CODEC_PNG):
+    if SharedMemory is None or jobs <= 1:
+        _encode_serial(images, images_ref, store, threshold, cache, codec)
+    else:
+        _DiffScheduler(images, images_ref, store, jobs, memory_limit,
+                       threshold, cache, codec).run()
+
+def _encode_serial(images, images_ref, store, threshold, cache, codec):
+    for image in sorted(images):
+        ref = images_ref.get(image)
+        
+        if not ref:
+            # No daddy found
+            continue
+        
+        if ref.ref:
+            # Get root image
+            ref = ref.ref
+        
+        if cache is None:
+            image.make_ref(ref, store, threshold, codec)
+            continue
+        
+        result = _load_diff(cache, image, ref, threshold, codec)
+        if result is None:
+            buf = image.create_diff_image(ref, codec)
+            result = _save_diff(cache, image, ref, len(buf), buf, threshold, codec)
+        
+        if result[1]:
+            image.set_diff(ref, result[1], store, codec)
+
+def _accept(length, image, threshold):
+    return float(length) / image.origin_size < threshold
+
+def _load_diff(cache, image, ref, threshold, codec):
+    # Return (length, diff image or None if rejected), or None if the result
+    # is unknown
+    result = cache.get_diff(image.digest, ref.digest, codec)
+    if result is None:
+        return None
+    
+    length, buf = result
+    if _accept(length, image, threshold):
+        # Stored by length only if it was rejected with a lower threshold
+        return buf and result or None
+    return length, None
+
+def _save_diff(cache, image, ref, length, buf, threshold, codec):
+    # Rejected diff images are large, only their lengths are stored
+    if not (buf and _accept(length, image, threshold)):
+        buf = None
+    
+    cache.put_diff(image.digest, ref.digest, length, buf, codec)
+    return length, buf
+
+def _encode_diff(filename, shm_name, orig_size, threshold, threads, codec):
+    img = load_image(filename)
+    data = img.tobytes()
+    
+    shm = SharedMemory(name=shm_name)
+    try:
+        ref_data = bytes(shm.buf[:len(data)])
+    finally:
+        shm.close()
+    
+    buf = encode_diff_image(img.mode, img.size, data, ref_data, threads, codec)
+    
+    if float(len(buf)) / orig_size < threshold:
+        return len(buf), buf
+    else:
+        # Rejected, don't send it back
+        return len(buf), None
+
+
+class _SharedBuffer(object):
+    def __init__(self, image):
+        data = image.get_image_data()
+        
+        self.size = len(data)
+        self.users = 0
+        self.shm = SharedMemory(create=True, size=max(self.size, 1))
+        self.shm.buf[:self.size] = data
+    
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class _DiffScheduler(object):
+    def __init__(self, images, images_ref, store, jobs, memory_limit, threshold,
+                 cache=None, codec=CODEC_PNG):
+        self.images = sorted(images)
+        self.image_set = set(self.images)
+        self.images_ref = images_ref
+        self.store = store
+        self.jobs = jobs
+        self.memory_limit = memory_limit
+        self.threshold = threshold
+        self.cache = cache
+        self.codec = codec
+        
+        self.decided = {}   # {image: root reference or None}
+        self.results = {}   # {image: (ref, buf or None)}
+        self.waiting = {}   # {candidate: [images wait for candidate]}
+        self.backlog = deque()
+        self.ready = deque()    # [(image, ref, buf or None)] found in cache
+        self.running = {}   # {future: (image, ref)}
+        self.shared = {}    # {ref: _SharedBuffer}
+        self.memory = 0
+    
+    def run(self):
+        self.executor = ProcessPoolExecutor(self.jobs)
+        try:
+            for image in self.images:
+                candidate = self.images_ref.get(image)
+                
+                if not candidate:
+                    self.decided[image] = None
+                elif candidate not in self.image_set:
+                    # Already in the archive, reference is decided
+                    self.submit(image, candidate.ref or candidate)
+                elif candidate in self.decided:
+                    self.submit(image, self.decided[candidate] or candidate)
+                else:
+                    self.waiting.setdefault(candidate, []).append(image)
+            
+            applied = 0
+            while self.running or self.backlog or self.ready:
+                while self.ready:
+                    self.decide(*self.ready.popleft())
+                
+                self.submit_backlog()
+                
+                if self.running:
+                    done, not_done = wait(list(self.running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.complete(future)
+                
+                # Apply results in image order
+                while applied < len(self.images) and self.images[applied] in self.decided:
+                    self.apply(self.images[applied])
+                    applied += 1
+        finally:
+            self.executor.shutdown(wait=True)
+            for shared in self.shared.values():
+                shared.release()
+            self.shared.clear()
+    
+    def submit(self, image, ref):
+        if self.cache is not None:
+            result = _load_diff(self.cache, image, ref, self.threshold, self.codec)
+            if result is not None:
+                self.ready.append((image, ref, result[1]))
+                return
+        
+        self.backlog.append((image, ref))
+        self.submit_backlog()
+    
+    def submit_backlog(self):
+        while self.backlog:
+            image, ref = self.backlog[0]
+            
+            shared = self.shared.get(ref)
+            if shared:
+                need = shared.size
+            else:
+                # Reference buffer and image buffer, they are in the same
+                # group so they have the same size
+                width, height, mode = image.group
+                need = width * height * len(mode) * 2
+            
+            if self.running and self.memory + need > self.memory_limit:
+                return
+            
+            self.backlog.popleft()
+            
+            if not shared:
+                shared = self.shared[ref] = _SharedBuffer(ref)
+                self.memory += shared.size
+            
+            shared.users += 1
+            self.memory += shared.size
+            
+            future = self.executor.submit(_encode_diff, image.filename,
+                                          shared.shm.name, image.origin_size,
+                                          self.threshold, image.threads, self.codec)
+            self.running[future] = (image, ref)
+    
+    def complete(self, future):
+        image, ref = self.running.pop(future)
+        length, buf = future.result()
+        
+        shared = self.shared[ref]
+        shared.users -= 1
+        self.memory -= shared.size
+        
+        if shared.users == 0:
+            del self.shared[ref]
+            self.memory -= shared.size
+            shared.release()
+        
+        if self.cache is not None:
+            _save_diff(self.cache, image, ref, length, buf, self.threshold, self.codec)
+        
+        self.decide(image, ref, buf)
+    
+    def decide(self, image, ref, buf):
+        self.results[image] = (ref, buf)
+        self.decided[image] = buf and ref or None
+        
+        for dependent in self.waiting.pop(image, ()):
+            self.submit(dependent, self.decided[image] or image)
+    
+    def apply(self, image):
+        result = self.results.pop(image, None)
+        if result:
+            ref, buf = result
+            if buf:
+                image.set_diff(ref, buf, self.store, self.codec)
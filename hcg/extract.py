@@ -0,0 +1,127 @@
+
+import os
+from multiprocessing import Pool
+
+from hcg.archive import HCGArchive
+from hcg.cache import ImageCache, DEFAULT_CACHE_SIZE
+
+__all__ = ["extract_archive", "plan_extraction"]
+
+# Usage sample:
+#
+# def progress(key, ref_key):
+#     print("%s (ref %s)" % (key, ref_key))
+#
+# stats = extract_archive("cg.hcg", "output", jobs=8, callback=progress)
+# print("%(hits)i hits, %(misses)i misses" % stats)
+#
+# Images are scheduled by reference tree: a task holds images diffed with the
+# same root image, so the root is decoded once by the worker which extracts
+# them.
+#
+# Each worker has its own reference cache of cache_size bytes, the returned
+# stats are the sum of ImageCache.stats() of all workers.
+
+_worker_archive = None
+_worker_cache = None
+
+def plan_extraction(images, jobs=1):
+    # Return a list of tasks, each task is a list of image keys which share
+    # the same root reference image.
+    trees = {}
+    roots = []
+    
+    for img in sorted(images):
+        root = img
+        while root.ref:
+            root = root.ref
+        
+        if root.key not in trees:
+            trees[root.key] = [root.key]
+            roots.append(root.key)
+        if root is not img:
+            trees[root.key].append(img.key)
+    
+    # A tree bigger than its share of work is split to keep all workers busy,
+    # each part decodes the root again.
+    share = max(1, -(-len(images) // max(jobs, 1)))
+    
+    tasks = []
+    for key in roots:
+        tree = trees[key]
+        for i in range(0, len(tree), share):
+            tasks.append(tree[i:i + share])
+    
+    # Longest tasks first
+    tasks.sort(key=len, reverse=True)
+    return tasks
+
+def extract_archive(filename, basepath, jobs=1, use_mmap=False,
+                    cache_size=DEFAULT_CACHE_SIZE, callback=None):
+    # Extract all images in archive to basepath with `jobs` processes,
+    # callback(key, ref_key) is called in this process after each image is
+    # extracted. Return the reference cache stats summed over workers.
+    archive = HCGArchive(filename, use_mmap=use_mmap, cache=False)
+    try:
+        tasks = plan_extraction(archive.get_images(), jobs)
+    finally:
+        archive.close()
+    
+    initargs = (filename, use_mmap, cache_size)
+    worker_stats = {}
+    
+    if jobs > 1:
+        pool = Pool(jobs, _init_worker, initargs)
+        try:
+            for result in pool.imap_unordered(_extract_task, [(t, basepath) for t in tasks]):
+                _report(result, callback, worker_stats)
+        finally:
+            # All results are collected (or failed) here
+            pool.terminate()
+            pool.join()
+    else:
+        _init_worker(*initargs)
+        try:
+            for task in tasks:
+                _report(_extract_task((task, basepath)), callback, worker_stats)
+        finally:
+            _close_worker()
+    
+    total = dict((name, 0) for name in ("hits", "misses", "evictions", "items",
+                                        "current_bytes", "max_bytes"))
+    for cache_stats in worker_stats.values():
+        for name in total:
+            total[name] += cache_stats[name]
+    return total
+
+def _report(result, callback, worker_stats):
+    # Stats of a worker cache only grow, so the last ones of a worker are kept
+    pid, cache_stats, extracted = result
+    worker_stats[pid] = cache_stats
+    
+    if callback:
+        for key, ref_key in extracted:
+            callback(key, ref_key)
+
+def _init_worker(filename, use_mmap, cache_size):
+    global _worker_archive, _worker_cache
+    _worker_cache = ImageCache(cache_size)
+    _worker_archive = HCGArchive(filename, use_mmap=use_mmap,
+                                 cache=_worker_cache)
+
+def _close_worker():
+    global _worker_archive, _worker_cache
+    _worker_archive.close()
+    _worker_archive = _worker_cache = None
+_worker_cache = None
+
+def _extract_task(args):
+    keys, basepath = args
+    
+    result = []
+    for key in keys:
+        image = _worker_archive.get(key)
+        image.extract_to(basepath)
+        result.append((key, image.ref and image.ref.key or None))
+    
+    return os.getpid(), _worker_cache.stats(), result
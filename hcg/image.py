@@ -1,31 +1,63 @@
 
 import os
-from threading import Event, Lock
 
+from concurrent.futures import Future
 from PIL import Image
 
-from hcg import _sampling
-from hcg import _compress
-from hcg.compress import diff_buffer, merge_buffer
-from hcg.sampling import sampling_bbox, split_rect
-from hcg.threading_pool import ThreadPool
-from hcg.utils import BytesIO
+from hcg import stats
+from hcg.codec import (CODEC_PNG, CODEC_DELTA, CODEC_TILED, encode_delta, encode_tiles,
+                       decode_delta, decode_region, crop_data)
+from hcg.kernels import kernels
+from hcg.threading_pool import Executor
+from hcg.utils import BufferReader, BytesIO
 
-__all__ = ["HCGImage"]
+__all__ = ["HCGImage", "encode_diff_image"]
+
+def encode_diff_image(mode, size, data, ref_data, threads=1, codec=CODEC_PNG):
+    # Return PNG encoded diff of image data (bytes) and reference image data,
+    # or a delta payload if codec is CODEC_DELTA or CODEC_TILED, data is
+    # modified in place.
+    if codec == CODEC_DELTA:
+        return encode_delta(mode, size, data, ref_data, threads)
+    if codec == CODEC_TILED:
+        return encode_tiles(mode, size, data, ref_data, threads)
+    
+    with stats.stage("kernel.diff"):
+        data = kernels.diff_data(data, ref_data, threads)
+    img = Image.frombytes(mode, size, data)
+    
+    with stats.stage("encode.png"):
+        f = BytesIO()
+        img.save(f, "png")
+        buf = f.getvalue()
+        f.close()
+    
+    stats.incr("encode.bytes", len(buf))
+    return buf
+
+def _sampling_grid(data, width, height, bands, threads):
+    with stats.stage("kernel.sampling"):
+        return kernels.sampling_grid(data, width, height, bands, threads)
 
 class HCGImage(object):
     _ref = None
     _size = None
     _crc32 = None
-    _sample = None
-    _sample_ttl = None
-    _sample_event = None
-    _sample_lock = None
+    _digest = None
+    _sample_future = None
+    
+    # Codec of the diff image (see hcg.codec)
+    codec = CODEC_PNG
     
+    # Number of threads used by kernels to diff, merge and sample this image,
+    # jobs running in parallel should keep it low to pin their cores.
+    threads = 1
     
-    def __init__(self, key):
+    def __init__(self, key, threads=None):
         self.key = key
-
+        if threads:
+            self.threads = threads
+    
     @property
     def group(self):
         # This field is to evaluate if two images can be diff
@@ -46,6 +78,11 @@ class HCGImage(object):
         # contents crc32
         return self._crc32
     
+    @property
+    def digest(self):
+        # Return sha1 hex digest of the source file, None if it is unknown
+        return self._digest
+    
     @property
     def ref(self):
         # Retuen reference HCGImage object
@@ -60,13 +97,17 @@ class HCGImage(object):
     
     @property
     def sample(self):
-        if not self._sample:
+        if self._sample_future is None:
             self.make_sample()
         
-        while self._sample_event.wait(0.5) == False:
-            pass
-        
-        return self._sample
+        # Raise the exception if sampling is failed
+        return self._sample_future.result()
+    
+    def set_sample(self, sample):
+        # Use a sample made before (e.g. loaded from a DiskCache)
+        future = Future()
+        future.set_result(sample)
+        self._sample_future = future
     
     def make_sample(self):
         # This method create features for image, if two image has same group
@@ -83,45 +124,20 @@ class HCGImage(object):
         else:
             raise RuntimeError("Sampling only work for 8-bits depth image")
         
-        if self._sample_event and self._sample_event.is_set() == False:
+        if self._sample_future is not None and not self._sample_future.done():
             # Another sampling task is running
             return
-        else:
-            self._sample_event = Event()
-            self._sample_lock = Lock()
         
         w, h = img.size
         
-        regions = []
-        self._sample = []
-        self._sample_ttl = 0
-        
-        for bbox in split_rect(w, h):
-            self._sample.append(None)
-            regions.append((self._sample_ttl, bbox))
-            self._sample_ttl += 1
-        
-        pool = ThreadPool.default_pool()
+        # All regions are sampled by one task in a single pass over the
+        # buffer, so the executor runs one task per image instead of one task
+        # per region.
+        executor = Executor.default_executor()
         
-        # @CYTHON
-        data = img.tobytes()
-        
-        for index, bbox in regions:
-            pool.assign_task((_sampling.sampling_bbox, (data, w, h, bands, bbox, self._make_sample_cb, index), {}))
-        # @NATIVE
-        # data = bytearray(img.tobytes())
-        # 
-        # for index, bbox in regions:
-        #     pool.assign_task((sampling_bbox, (data, w, h, bands, bbox, self._make_sample_cb, index), {}))
-        # @END
-    
-    def _make_sample_cb(self, index, result):
-        self._sample[index] = result
-        
-        with self._sample_lock:
-            self._sample_ttl -= 1
-            if self._sample_ttl == 0:
-                self._sample_event.set()
+        self._sample_future = executor.submit(_sampling_grid,
+                                              img.tobytes(), w, h, bands,
+                                              self.threads)
     
     def get_image(self):
         # return PIL Image object, if image is compressed
@@ -130,62 +146,83 @@ class HCGImage(object):
     def get_image_data(self):
         return self.get_image().tobytes()
     
+    def get_image_buffer(self):
+        # Return decoded image as (mode, size, data), subclass may cache it
+        img = self.get_image()
+        return img.mode, img.size, img.tobytes()
+    
     def get_origin_image(self):
         if self.has_diff:
-            ref_img = self._ref.get_image()
-            diff_img = self.get_image()
-            
-            # @CYTHON
-            ref_data = ref_img.tobytes()
-            data = diff_img.tobytes()
-            _compress.merge_buffer(data, ref_data, len(data))
-            return Image.frombytes(ref_img.mode, ref_img.size, data)
-            
-            # @NATIVE
-            # ref_data = bytearray(ref_img.tobytes())
-            # data = bytearray(diff_img.tobytes())
-            # 
-            # merge_buffer(data, ref_data, len(data))
-            # 
-            # return Image.frombytes(ref_img.mode, ref_img.size, bytes(data))
-            # @END
+            return Image.frombytes(*self.merge_buffer(self._ref.get_image_buffer()))
         else:
             return self.get_image()
-
+    
+    def merge_buffer(self, ref_buffer):
+        # Return decoded (mode, size, data) of this diffed image, ref_buffer
+        # is the decoded reference image as returned by get_image_buffer
+        if self.codec != CODEC_PNG:
+            return decode_delta(self.get_data(), ref_buffer, self.threads)
+        
+        ref_mode, ref_size, ref_data = ref_buffer
+        diff_img = self.get_image()
+        
+        with stats.stage("decode.image"):
+            data = diff_img.tobytes()
+        with stats.stage("kernel.merge"):
+            data = kernels.merge_data(data, ref_data, self.threads)
+        return ref_mode, ref_size, data
+    
+    def get_region(self, bbox):
+        # Return the (x0, y0, x1, y1) region of the origin image as a PIL
+        # Image, tiled diffs only decode the tiles overlapping bbox
+        return Image.frombytes(*self.get_region_buffer(bbox))
+    
+    def get_region_buffer(self, bbox):
+        # Return (mode, size, data) of the bbox region of the origin image
+        if self.has_diff and self.codec == CODEC_TILED:
+            ref_buffer = self._ref.get_region_buffer(bbox)
+            return decode_region(self.get_data(), bbox, ref_buffer, self.threads)
+        
+        if self.has_diff:
+            mode, size, data = self.merge_buffer(self._ref.get_image_buffer())
+        else:
+            mode, size, data = self.get_image_buffer()
+        
+        x0, y0, x1, y1 = bbox
+        if not (0 <= x0 < x1 <= size[0] and 0 <= y0 < y1 <= size[1]):
+            raise RuntimeError("Region %r is out of image %ix%i" % (bbox, size[0], size[1]))
+        return mode, (x1 - x0, y1 - y0), crop_data(data, size[0], size[1], bbox)
+    
     def get_data(self):
         # return bytes data
         raise RuntimeError("Override this method.")
     
-    def create_diff_image(self, ref_image):
+    def open_data(self):
+        # return a readable file object of the data, subclass should return a
+        # real file if possible so the data can be copied by kernel
+        return BytesIO(self.get_data())
+    
+    def create_diff_image(self, ref_image, codec=CODEC_PNG):
         img = self.get_image()
-
-        # @CYTHON
-        data = img.tobytes()
-        ref_data = ref_image.get_image_data()
-        _compress.diff_buffer(data, ref_data, len(data))
-        
-        img = Image.frombytes(img.mode, img.size, data)
-        # @NATIVE
-        # data = bytearray(img.tobytes())
-        # ref_data = bytearray(ref_image.get_image_data())
-        # 
-        # diff_buffer(data, ref_data, len(data))
-        # 
-        # img = Image.frombytes(img.mode, img.size, bytes(data))
-        # @END
-        
-        f = BytesIO()
-        img.save(f, "png")
-        buf = f.getvalue()
-        f.close()
-        return buf
-
+        return encode_diff_image(img.mode, img.size, img.tobytes(),
+                                 ref_image.get_image_data(), self.threads, codec)
+    
+    def get_diff_image(self, buf):
+        # Return diff image of payload buf as a PIL Image
+        if self.codec != CODEC_PNG:
+            return Image.frombytes(*decode_delta(buf, threads=self.threads))
+        return Image.open(BufferReader(buf))
+    
     def extract_to(self, basepath):
         path = os.path.join(basepath, self.key)
         base = os.path.dirname(path)
         
         if not os.path.isdir(base):
-            os.makedirs(base)
+            try:
+                os.makedirs(base)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(base): raise
         
         if self.has_diff:
             img = self.get_origin_image()
@@ -197,16 +234,16 @@ class HCGImage(object):
             buf = self.get_data()
             with open(path, "wb") as f:
                 f.write(buf)
-                
+    
     def __lt__(self, other):
         return self.__cmp__(other) < 0
-        
+    
     def __le__(self, other):
         return self.__cmp__(other) <= 0
-        
+    
     def __eq__(self, other):
         return self.__cmp__(other) == 0
-
+    
     def __ne__(self, other):
         return self.__cmp__(other) != 0
     
@@ -215,16 +252,16 @@ class HCGImage(object):
     
     def __ge__(self, other):
         return self.__cmp__(other) >= 0
-
+    
     def __str__(self):
         return "<%s: %s>" % (self.__class__.__name__, self.key, )
-        
+    
     def __repr__(self):
         return self.__str__()
     
     def __hash__(self):
         return id(self.key)
-        
+    
     def __cmp__(self, other):
         s, o = len(self.key), len(other.key)
         if s == o:
@@ -0,0 +1,133 @@
+
+import os
+
+__all__ = ["BACKENDS", "Kernels", "available_backends", "get_kernels", "kernels"]
+
+BACKENDS = ("cython", "numpy", "python")
+ENV_BACKEND = "HCG_KERNELS"
+
+# Usage sample:
+#
+# from hcg.kernels import kernels
+#
+# data = kernels.diff_data(data, ref_data)
+# data = kernels.merge_data(data, ref_data, threads=4)
+# samples = kernels.sampling_grid(data, width, height, bands, threads=4)
+#
+# The first available backend of BACKENDS is used, set HCG_KERNELS=numpy (or
+# cython, python) to choose one. get_kernels(name) return a given backend.
+#
+# diff_data and merge_data return the result as a bytes like object, data
+# passed in may be modified in place so the caller must own it. `threads` is
+# the number of OpenMP threads of Cython kernels, other backends ignore it.
+
+class Kernels(object):
+    def __init__(self, name, diff_data, merge_data, sampling_grid):
+        self.name = name
+        self.diff_data = diff_data
+        self.merge_data = merge_data
+        self.sampling_grid = sampling_grid
+    
+    def __repr__(self):
+        return "<Kernels: %s>" % self.name
+
+
+def _load_cython():
+    from hcg import _compress
+    from hcg import _sampling
+    
+    def diff_data(data, ref_data, threads=1):
+        _compress.diff_buffer(data, ref_data, len(data), threads)
+        return data
+    
+    def merge_data(data, ref_data, threads=1):
+        _compress.merge_buffer(data, ref_data, len(data), threads)
+        return data
+    
+    return Kernels("cython", diff_data, merge_data, _sampling.sampling_grid)
+
+def _load_numpy():
+    import numpy
+    from hcg.sampling import split_line
+    
+    def diff_data(data, ref_data, threads=1):
+        # uint8 arithmetic wraps around like the byte loops
+        length = len(data)
+        a = numpy.frombuffer(data, numpy.uint8, length)
+        b = numpy.frombuffer(ref_data, numpy.uint8, length)
+        return (a - b).tobytes()
+    
+    def merge_data(data, ref_data, threads=1):
+        length = len(data)
+        a = numpy.frombuffer(data, numpy.uint8, length)
+        b = numpy.frombuffer(ref_data, numpy.uint8, length)
+        return (a + b).tobytes()
+    
+    def sampling_grid(data, width, height, bands, threads=1):
+        pixels = numpy.frombuffer(data, numpy.uint8, width * height * bands)
+        pixels = pixels.reshape(height, width, bands)
+        
+        tops = [top for top, bottom in split_line(height)]
+        lefts = [left for left, right in split_line(width)]
+        
+        rows = numpy.add.reduceat(pixels, tops, axis=0, dtype=numpy.uint64)
+        regions = numpy.add.reduceat(rows, lefts, axis=1)
+        return regions.reshape(-1, bands).tolist()
+    
+    return Kernels("numpy", diff_data, merge_data, sampling_grid)
+
+def _load_python():
+    from hcg import compress
+    from hcg import sampling
+    
+    def diff_data(data, ref_data, threads=1):
+        data = bytearray(data)
+        compress.diff_buffer(data, bytearray(ref_data), len(data))
+        return data
+    
+    def merge_data(data, ref_data, threads=1):
+        data = bytearray(data)
+        compress.merge_buffer(data, bytearray(ref_data), len(data))
+        return data
+    
+    def sampling_grid(data, width, height, bands, threads=1):
+        return sampling.sampling_grid(bytearray(data), width, height, bands)
+    
+    return Kernels("python", diff_data, merge_data, sampling_grid)
+
+_LOADERS = {
+    "cython": _load_cython,
+    "numpy": _load_numpy,
+    "python": _load_python,
+}
+_loaded = {}
+
+def _load(name):
+    if name not in _loaded:
+        try:
+            _loaded[name] = _LOADERS[name]()
+        except ImportError:
+            _loaded[name] = None
+    return _loaded[name]
+
+def available_backends():
+    return [name for name in BACKENDS if _load(name)]
+
+def get_kernels(name=None):
+    # Return kernels of backend `name`, or of HCG_KERNELS if name is None, or
+    # of the fastest available backend.
+    name = name or os.environ.get(ENV_BACKEND)
+    
+    if not name:
+        return _load(available_backends()[0])
+    
+    if name not in _LOADERS:
+        raise RuntimeError("Unknown kernel backend '%s', should be one of %s" %
+                           (name, ", ".join(BACKENDS)))
+    
+    k = _load(name)
+    if not k:
+        raise RuntimeError("Kernel backend '%s' is not available" % name)
+    return k
+
+kernels = get_kernels()
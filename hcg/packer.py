@@ -1,17 +1,28 @@
 
 import os
 import struct
-from hashlib import md5
 from binascii import crc32
+from hashlib import sha1
 
 from PIL import Image
 
+from hcg import stats
+from hcg.archive import HCGArchive
+from hcg.cache import ImagePool, load_image
+from hcg.codec import CODEC_PNG
 from hcg.image import HCGImage
-from hcg.utils import BytesIO
+from hcg.spool import PayloadStore
+from hcg.utils import BytesIO, copy_file_data, COPY_CHUNK_SIZE
 
 P_UINT64 = struct.Struct("<Q")
 P_CRC32 = struct.Struct("<I")
 P_HEADER = struct.Struct("<HQQII")
+P_RECORDS_HEADER = struct.Struct("<II")
+P_RECORD = struct.Struct("<IHHQIII")
+
+FORMAT_VERSIONS = (1, 2)
+
+__all__ = ["HCHPacker", "HCGPackImage", "rewrite_archive"]
 
 PACKAGE_COMMENT = """This file is create via personal package tool.
 If you got this file and want to expend it, please visit https://github.com/yagami-cerberus"""
@@ -22,115 +33,214 @@ class HCHPacker(object):
     _offset_head_index = None
     _offset_data = None
     _offset_tail_index = None
+    archive = None
+    bytes_copied = 0
     
-    def __init__(self, filepath):
+    def __init__(self, filepath, version=1, append=False):
+        # version 1 write HCG001 archive, version 2 write HCG002 archive which
+        # has fixed-size index records (see doc/formats).
+        # If append is True, filepath is an existing archive and images are
+        # added to it by write_append, version is the version of the archive.
+        if append:
+            self.archive = HCGArchive(filepath, cache=False)
+            self.version = self.archive.version
+            self.f = open(filepath, "r+b")
+            return
+        
+        assert version in FORMAT_VERSIONS, "Unknown format version %s" % version
+        
+        self.version = version
         self.f = open(filepath, "wb")
-        self.f.write(b"HCG001\r\n")
+        self.f.write(("HCG%03i\r\n" % version).encode())
     
     def write_comment_header(self, message=PACKAGE_COMMENT):
+        # Comment length is in bytes, message is a str or encoded bytes
+        if not isinstance(message, bytes):
+            message = message.encode()
         comment_length = len(message)
         self.f.write(("%06x\r\n" % comment_length).encode())
-        self.f.write(message.encode())
+        self.f.write(message)
         
         self._offset_head_index = self._offset_magic + comment_length
     
     def write_body(self, images):
+        with stats.stage("packer.write_body"):
+            self._write_body(images)
+    
+    def _write_body(self, images):
         assert self._offset_head_index, "Write archive comment first"
-
+        assert self._offset_data == None, "Its gone..."
+        
         images.sort()
-        images_meta = self._write_header_index(images)
         
+        # 8 is image_index_length, 4 is header CRC32
+        self._offset_data = self._offset_head_index + 8 + \
+            self._index_length(images) + 4
+        
+        positions = {}
+        data_size = 0
         for i in images:
-            self.f.write(i.get_data())
+            positions[i] = self._offset_data + data_size
+            data_size += i.size
         
-        self.f.write(b"\x00\x00\x00\x00\x00\x00\x00\x00")
+        self._offset_tail_index = self._offset_data + data_size + 8 # 8 is ZERO-padding
+        
+        self._write_index(self._build_index(images, positions, self._offset_head_index))
         
-        self._write_tail_index(images, images_meta)
+        for i in images:
+            self._write_data(i)
         
+        self.f.write(b"\x00\x00\x00\x00\x00\x00\x00\x00")
+        self._write_index(self._build_index(images, positions, self._offset_tail_index))
         self.f.write(P_UINT64.pack(self._offset_tail_index))
     
-    def _write_header_index(self, images):
-        assert self._offset_head_index, "Write archive comment first"
-        assert self._offset_data == None, "Its gone..."
+    def write_append(self, images):
+        # Write data of images after the end of archive, then a new tail index
+        # of all images and the trailer. Existing data and the head index are
+        # not touched, readers use the tail index when it is longer than the
+        # head index (see doc/formats). Images may refer to images of
+        # self.archive.
+        with stats.stage("packer.write_append"):
+            self._write_append(images)
+    
+    def _write_append(self, images):
+        assert self.archive, "Packer is not opened in append mode"
         
-        index_offset = 8 # 8 is image_index_length
-        data_size = 0
+        existing = self.archive.get_images()
         
-        images_meta = {}
+        keys = set(i.key for i in existing)
+        for i in images:
+            if i.key in keys:
+                raise RuntimeError("%s is already in the archive" % i.key)
         
+        images = sorted(images)
+        all_images = sorted(existing + images)
+        
+        positions = dict((i, i.position) for i in existing)
+        new_images = set(images)
         for i in images:
-            key = i.key.encode() # To bytes
-            keylen = len(key)
-            
-            meta = images_meta[i] = {
-                "key": key,
-                "keylen": keylen,
-                "index_offset": self._offset_head_index + index_offset,
-                "data_heap": data_size,
-            }
+            if i.ref and i.ref not in positions and i.ref not in new_images:
+                raise RuntimeError("Reference of %s is not in the archive" % i.key)
+        
+        self.f.seek(0, 2)
+        archive_size = self.f.tell()
+        
+        try:
+            for i in images:
+                positions[i] = self.f.tell()
+                self._write_data(i)
             
-            if i.ref:
-                meta["ref_index_offset"] = images_meta[i.ref]["index_offset"]
-            else:
-                meta["ref_index_offset"] = 0
+            self.f.write(b"\x00\x00\x00\x00\x00\x00\x00\x00")
+            self._offset_tail_index = self.f.tell()
             
-            index_offset += (26 + keylen)
-            data_size += i.size
+            self._write_index(self._build_index(all_images, positions, self._offset_tail_index))
+            self.f.write(P_UINT64.pack(self._offset_tail_index))
+            self.f.flush()
+        except BaseException:
+            # Leave archive as it was
+            self.f.truncate(archive_size)
+            raise
+    
+    def _write_data(self, image):
+        # Stream image data into archive, without loading it into memory
+        with image.open_data() as f:
+            copied = copy_file_data(f, self.f, image.size)
         
-        self._offset_data = self._offset_head_index + index_offset + 4 # 4 is header CRC32
-        self._offset_tail_index = self._offset_data + data_size + 8 # 8 is ZERO-padding
+        if copied != image.size:
+            raise RuntimeError("%s is changed while packing" % image.key)
+        
+        self.bytes_copied += copied
+        stats.incr("packer.bytes_written", copied)
+    
+    def _index_length(self, images):
+        keys_length = sum(len(i.key.encode()) for i in images)
+        
+        if self.version == 2:
+            return P_RECORDS_HEADER.size + P_RECORD.size * len(images) + keys_length
+        else:
+            return P_HEADER.size * len(images) + keys_length
+    
+    def _build_index(self, images, positions, index_offset):
+        # Return image index of images, positions is {image: data offset} and
+        # index_offset is where the index (image_index_length) is written to.
+        if self.version == 2:
+            return self._build_records_index(images, positions)
+        else:
+            return self._build_header_index(images, positions, index_offset)
+    
+    def _build_header_index(self, images, positions, index_offset):
+        # References are offsets of image headers in this index
+        for i in images:
+            if i.codec != CODEC_PNG:
+                raise RuntimeError("%s can not be stored in a version 1 archive, "
+                                   "it is not a PNG diff image" % i.key)
+        
+        offset = index_offset + 8 # 8 is image_index_length
+        header_offsets = {}
+        for i in images:
+            header_offsets[i] = offset
+            offset += P_HEADER.size + len(i.key.encode())
         
         header_buffer = BytesIO()
         
         for i in images:
-            meta = images_meta[i]
+            key = i.key.encode() # To bytes
+            
+            if i.ref:
+                ref_index_offset = header_offsets[i.ref]
+            else:
+                ref_index_offset = 0
+            
             header_buffer.write(
                 P_HEADER.pack(
-                    meta["keylen"],
-                    self._offset_data + meta["data_heap"],
-                    meta["ref_index_offset"],
+                    len(key),
+                    positions[i],
+                    ref_index_offset,
                     i.size,
                     i.crc32
                 )
             )
-            header_buffer.write(meta["key"])
+            header_buffer.write(key)
         
-        self._write_index(header_buffer.getvalue())
-        return images_meta
+        return header_buffer.getvalue()
     
-    def _write_tail_index(self, images, images_meta):
-        assert self._offset_data
-
-        index_offset = 8
+    def _build_records_index(self, images, positions):
+        # References are record numbers, so the index does not depend on
+        # where it is written to
+        records = sorted(images, key=lambda i: i.key.encode())
+        keys = [i.key.encode() for i in records]
+        key_table_length = sum(len(key) for key in keys)
         
-        for i in images:
-            meta = images_meta[i]
-            meta["index_offset"] = self._offset_tail_index + index_offset
-
-            if i.ref:
-                meta["ref_index_offset"] = images_meta[i.ref]["index_offset"]
-            else:
-                meta["ref_index_offset"] = 0
+        record_ids = dict((i, n) for n, i in enumerate(records))
         
-            index_offset += (26 + meta["keylen"])
-    
         index_buffer = BytesIO()
+        index_buffer.write(P_RECORDS_HEADER.pack(len(records), key_table_length))
         
-        for i in images:
-            meta = images_meta[i]
+        key_offset = 0
+        for i, key in zip(records, keys):
+            if i.ref:
+                ref_record = record_ids[i.ref] + 1
+            else:
+                ref_record = 0
+            
             index_buffer.write(
-                P_HEADER.pack(
-                    meta["keylen"],
-                    self._offset_data + meta["data_heap"],
-                    meta["ref_index_offset"],
+                P_RECORD.pack(
+                    key_offset,
+                    len(key),
+                    i.codec,
+                    positions[i],
+                    ref_record,
                     i.size,
                     i.crc32
                 )
             )
-            index_buffer.write(meta["key"])
-
-        self._write_index(index_buffer.getvalue())
-
+            key_offset += len(key)
+        
+        for key in keys:
+            index_buffer.write(key)
+        
+        return index_buffer.getvalue()
+    
     def _write_index(self, header_data):
         h_length = len(header_data)
         h_crc32 = crc32(header_data) & 0xffffffff
@@ -138,61 +248,139 @@ class HCHPacker(object):
         self.f.write(P_UINT64.pack(h_length))
         self.f.write(header_data)
         self.f.write(P_CRC32.pack(h_crc32))
+        stats.incr("packer.bytes_written", h_length + 12)
     
     def close(self):
         self.f.close()
+        if self.archive:
+            self.archive.close()
+
+def rewrite_archive(filename, target, version=None):
+    # Copy all images of archive filename to a new archive target, without
+    # diffing them again. Space left by appends is dropped and the head index
+    # is up to date again. version is the version of the archive if None.
+    archive = HCGArchive(filename, cache=False)
+    
+    try:
+        packer = HCHPacker(target, version=version or archive.version)
+        packer.write_comment_header(archive.comments)
+        packer.write_body(archive.get_images())
+        packer.close()
+    finally:
+        archive.close()
+    
+    return packer
 
 class HCGPackImage(HCGImage):
-    def __init__(self, key, filename):
-        super(HCGPackImage, self).__init__(key)
+    _payload = None
+    
+    def __init__(self, key, filename, pool=None, threads=None):
+        # Only image header is read here, file crc32 is calculated when it is
+        # used and decoded images are kept in pool (an ImagePool, the default
+        # pool is used if None).
+        super(HCGPackImage, self).__init__(key, threads)
         
-        with open(filename, "rb") as f:
-            buf = f.read()
+        with Image.open(filename) as img:
+            self._image_size = img.size
+            self._image_mode = img.mode
         
-        self._img = Image.open(filename)
+        self._pool = pool or ImagePool.default_pool()
         
         self._orig_filename = filename
-        self._orig_size = len(buf)
+        self._orig_size = os.path.getsize(filename)
         
-        self._size = len(buf)
-        self._crc32 = crc32(buf) & 0xffffffff
+        self._size = self._orig_size
+    
+    @property
+    def group(self):
+        return self._image_size + (self._image_mode, )
+    
+    @property
+    def filename(self):
+        return self._orig_filename
+    
+    @property
+    def origin_size(self):
+        # Return size of the source file
+        return self._orig_size
+    
+    @property
+    def crc32(self):
+        if self._crc32 is None:
+            self._scan_file()
+        return self._crc32
+    
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._scan_file()
+        return self._digest
+    
+    def _scan_file(self):
+        # crc32 and sha1 of source file are calculated in one pass, crc32 of
+        # a diffed image is the one of its diff image
+        value = 0
+        digest = sha1()
+        with open(self._orig_filename, "rb") as f, stats.stage("packer.hash"):
+            while True:
+                buf = f.read(COPY_CHUNK_SIZE)
+                if not buf: break
+                value = crc32(buf, value)
+                digest.update(buf)
+                stats.incr("packer.bytes_read", len(buf))
+        
+        if self._crc32 is None:
+            self._crc32 = value & 0xffffffff
+        self._digest = digest.hexdigest()
     
     def get_data(self):
-        fn = self.has_diff and self._rdu_filename or self._orig_filename
-        with open(fn, "rb") as f:
+        if self.has_diff:
+            return self._payload.get_data()
+        
+        with self.open_data() as f:
             buf = f.read()
         return buf
     
+    def open_data(self):
+        if self.has_diff:
+            return self._payload.open()
+        else:
+            return open(self._orig_filename, "rb")
+    
     def get_image(self):
         if self.has_diff:
-            return Image.open(self._rdu_filename)
+            if self.codec != CODEC_PNG:
+                return self.get_diff_image(self._payload.get_data())
+            return load_image(self._payload.open())
         else:
-            return self._img
+            return self._pool.open(self._orig_filename)
     
     def get_origin_image(self):
-        return self._img
+        return self._pool.open(self._orig_filename)
     
-    def make_ref(self, ref_image, tempfolder, threshold=0.5):
-        buf = self.create_diff_image(ref_image)
+    def make_ref(self, ref_image, store, threshold=0.5, codec=CODEC_PNG):
+        # store is a PayloadStore shared by all images, or a folder to write
+        # diff image to.
+        buf = self.create_diff_image(ref_image, codec)
         
         if float(len(buf)) / self._orig_size < threshold:
-            tempfile = os.path.join(
-                tempfolder,
-                "%s.png" % md5(self.key.encode()).hexdigest()
-            )
-            
-            with open(tempfile, "wb") as f:
-                f.write(buf)
-            
-            self._ref = ref_image
-            self._crc32 = crc32(buf) & 0xffffffff
-            self._size = os.path.getsize(tempfile)
-            
-            self._rdu_filename = tempfile
-            
+            self.set_diff(ref_image, buf, store, codec)
             return True
         else:
             # import IPython
             # IPython.embed()
             return False
-    
\ No newline at end of file
+    
+    def set_diff(self, ref_image, buf, store, codec=CODEC_PNG):
+        if not isinstance(store, PayloadStore):
+            store = PayloadStore(store, memory_limit=0)
+        
+        if self._payload:
+            self._payload.discard()
+        
+        self._payload = store.put(self.key, buf)
+        
+        self._ref = ref_image
+        self.codec = codec
+        self._crc32 = crc32(buf) & 0xffffffff
+        self._size = len(buf)
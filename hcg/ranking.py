@@ -0,0 +1,259 @@
+
+import os
+from binascii import hexlify
+from collections import Counter
+
+from hcg import stats
+from hcg.sampling import evaluate_image_diff
+
+try:
+    from math import dist
+except ImportError:
+    def dist(p, q):
+        return sum((a - b)**2 for a, b in zip(p, q))**0.5
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+__all__ = ["rank_images", "VPTree"]
+
+# Usage sample:
+#
+# ranked = rank_images(images)              # VP-tree index
+# ranked = rank_images(images, exact=True)  # brute force, same as before
+#
+# for image, (ref, score) in ranked.items():
+#     print(image, ref, score)
+#
+# Both modes return {HCGImage: (best candidate, score)}. Candidates of an image
+# are all images ordered before it (by HCGImage.__cmp__), when more than one
+# candidate get the same score, the greatest one wins. The last image has no
+# candidate and is ranked as (None, inf).
+#
+# bases are candidates of every image (e.g. images already in an archive),
+# they are not ranked.
+#
+# If cache (a DiskCache) is given, the reference and score of each image are
+# stored to it by key and digest, with a token of the run that ranked them.
+# On the next run, an image with the same key, digest and run token keeps its
+# reference if the reference is unchanged, and is only compared with new or
+# changed images. Other images are ranked against the whole group.
+
+def rank_images(images, exact=False, bases=(), cache=None):
+    bases = sorted(bases)
+    images = bases + sorted(images)
+
+    if cache is None or any(img.digest is None for img in images):
+        ranked_image = _rank_all(images, exact)
+    else:
+        ranked_image = _rank_cached(images, len(bases), exact, cache)
+
+    for img in bases:
+        ranked_image.pop(img, None)
+    return ranked_image
+
+def _rank_all(images, exact):
+    if exact:
+        return _rank_exact(images)
+    return _rank_indexed(images)
+
+def _rank_cached(images, bases_count, exact, cache):
+    # Images ranked in the same run (same token) were ranked against each
+    # other, so only images of the most common run are reused.
+    entries = [cache.get_rank(exact, img.key, img.digest) for img in images]
+    runs = Counter(entry[0] for entry in entries if entry is not None)
+    run = runs and runs.most_common(1)[0][0]
+
+    order = dict((img, i) for i, img in enumerate(images))
+    by_key = dict((img.key, img) for img in images)
+
+    old = set()
+    for i, entry in enumerate(entries):
+        if entry is not None and entry[0] == run and \
+           entry[1] == (i < bases_count):
+            old.add(images[i])
+    new = [img for img in images if img not in old]
+
+    ranked_image, kept, redo = {}, [], []
+    for i in range(bases_count, len(images)):
+        img = images[i]
+        if img not in old:
+            redo.append(img)
+            continue
+
+        ref_key, ref_digest, score = entries[i][2:]
+        ref = ref_key and by_key.get(ref_key)
+        if ref_key is None or (ref in old and ref.digest == ref_digest and
+                               order[ref] < i):
+            ranked_image[img] = (ref, score)
+            kept.append(img)
+        else:
+            redo.append(img)
+
+    if not new and not redo:
+        return ranked_image
+
+    stats.incr("ranking.reranked", len(redo))
+    if len(redo) * 2 > len(images) - bases_count:
+        ranked_image = _rank_all(images, exact)
+    else:
+        metric = _image_metric(exact)
+
+        # A kept image can only find a better candidate in new images
+        for img in kept:
+            ref, score = ranked_image[img]
+            for cand in new:
+                if order[cand] >= order[img]:
+                    continue
+                s = metric(img, cand)
+                if s < score or (s == score and order[cand] > order[ref]):
+                    ref, score = cand, s
+            ranked_image[img] = (ref, score)
+
+        for img in redo:
+            ref, score = None, float("inf")
+            for j in range(order[img] - 1, -1, -1):
+                s = metric(img, images[j])
+                if s < score:
+                    ref, score = images[j], s
+            ranked_image[img] = (ref, score)
+
+    run = hexlify(os.urandom(8)).decode()
+    for i, img in enumerate(images):
+        ref, score = ranked_image.get(img, (None, None))
+        cache.put_rank(exact, img.key, img.digest,
+                       (run, i < bases_count, ref and ref.key,
+                        ref and ref.digest, score))
+    return ranked_image
+
+def _image_metric(exact):
+    if exact:
+        return evaluate_image_diff
+
+    vectors = {}
+    def metric(img, cand):
+        for x in (img, cand):
+            if x not in vectors:
+                vectors[x] = sample_vector(x.sample)
+        return dist(vectors[img], vectors[cand])
+    return metric
+
+def _rank_exact(images):
+    images = list(images)
+    images.reverse()
+
+    ranked_image = {}
+
+    T = len(images)
+    i, j = 0, 0
+    while i < T:
+        this, j = images[i], (i + 1)
+        that, score = None, float("inf")
+        while j < T:
+            s = evaluate_image_diff(this, images[j])
+            if s < score:
+                that, score = images[j], s
+            j += 1
+        ranked_image[this] = (that, score)
+        i += 1
+
+    return ranked_image
+
+def _rank_indexed(images):
+    vectors = [sample_vector(img.sample) for img in images]
+    tree = VPTree(vectors)
+
+    ranked_image = {}
+    for order, img in enumerate(images):
+        found, score = tree.nearest(vectors[order], order)
+        if found is None:
+            ranked_image[img] = (None, float("inf"))
+        else:
+            ranked_image[img] = (images[found], score)
+
+    return ranked_image
+
+def sample_vector(sample):
+    # evaluate_image_diff is the standard deviation of element differences.
+    # After each vector is mean-centered and scaled by 1/sqrt(n), the same
+    # value is the euclidean distance of two vectors, so a metric tree can
+    # answer the query.
+    elements = [e for s in sample for e in s]
+    total = float(len(elements))
+    average = sum(elements) / total
+    scale = total**-0.5
+    return tuple((e - average) * scale for e in elements)
+
+
+class VPTree(object):
+    # Vantage point tree over vectors, each vector is identify by its position
+    # in the input list (it's order).
+
+    def __init__(self, vectors):
+        self._vectors = vectors
+        self._root = self._build(list(range(len(vectors))))
+
+    def _build(self, orders):
+        if not orders:
+            return None
+
+        vantage, rest = orders[0], orders[1:]
+
+        if not rest:
+            return _VPNode(vantage, 0.0, None, None, vantage)
+
+        v = self._vectors[vantage]
+        distances = sorted((dist(v, self._vectors[o]), o) for o in rest)
+
+        # Split by position rather than by value, so duplicated vectors can
+        # not unbalance the tree. Inside points are <= radius and outside
+        # points are >= radius.
+        middle = (len(distances) + 1) // 2
+        radius = distances[middle - 1][0]
+
+        inside = self._build([o for d, o in distances[:middle]])
+        outside = self._build([o for d, o in distances[middle:]])
+
+        return _VPNode(vantage, radius, inside, outside, min(orders))
+
+    def nearest(self, vector, before):
+        # Return (order, distance) of the nearest vector with order less than
+        # `before`, tie broken by the greatest order.
+        best = [None, float("inf")]
+
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.min_order >= before:
+                continue
+
+            d = dist(vector, self._vectors[node.vantage])
+
+            if node.vantage < before:
+                if d < best[1] or (d == best[1] and node.vantage > best[0]):
+                    best[0], best[1] = node.vantage, d
+
+            tau = best[1]
+
+            # Visit the closer side last so it is popped first
+            if d <= node.radius:
+                if d + tau >= node.radius: stack.append(node.outside)
+                stack.append(node.inside)
+            else:
+                if d - tau <= node.radius: stack.append(node.inside)
+                stack.append(node.outside)
+
+        return best[0], best[1]
+
+
+class _VPNode(object):
+    __slots__ = ("vantage", "radius", "inside", "outside", "min_order")
+
+    def __init__(self, vantage, radius, inside, outside, min_order):
+        self.vantage = vantage
+        self.radius = radius
+        self.inside = inside
+        self.outside = outside
+        self.min_order = min_order
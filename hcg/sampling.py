@@ -6,7 +6,7 @@ try:
 except NameError:
     pass
 
-__all__ = ["evaluate_image_diff", "sampling_bbox", "split_rect"]
+__all__ = ["evaluate_image_diff", "sampling_bbox", "sampling_grid", "split_rect"]
 
 
 def evaluate_image_diff(image1, image2):
@@ -46,6 +46,29 @@ def sampling_bbox(data, width, height, bands, bbox, cb, index):
 
     cb(index, output)
 
+def sampling_grid(data, width, height, bands):
+    # Sum every band of every split_rect region in one pass over the pixel
+    # buffer, output layout is same as calling sampling_bbox for each region.
+    x_bounds = list(split_line(width))
+    
+    output = []
+    for top, bottom in split_line(height):
+        row = [[0 for i in range(bands)] for x_bound in x_bounds]
+        
+        for y in range(top, bottom):
+            row_offset = y * width * bands
+            
+            for sums, (left, right) in zip(row, x_bounds):
+                start = row_offset + left * bands
+                end = row_offset + right * bands
+                
+                for i in range(bands):
+                    sums[i] += sum(data[start + i:end:bands])
+        
+        output.extend(row)
+    
+    return output
+
 def split_rect(width, height):
     for y_bound in split_line(height):
         for x_bound in split_line(width):
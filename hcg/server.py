@@ -0,0 +1,255 @@
+
+import os
+import json
+import errno
+import mimetypes
+from collections import deque
+from threading import Lock
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+
+from hcg.archive import HCGArchive
+from hcg.cache import ImageCache, DEFAULT_CACHE_SIZE
+from hcg.stats import Stats, timer
+from hcg.utils import BytesIO
+
+__all__ = ["ArchiveServer"]
+
+METRICS_PATH = "/_metrics"
+LATENCY_SAMPLES = 4096
+
+# Usage sample:
+#
+# server = ArchiveServer(["cg.hcg", "bg.hcg"], ("127.0.0.1", 8080))
+# server.serve_forever()
+#
+# GET /cg/ev/001.png   image "ev/001.png" of cg.hcg
+# GET /                names of mounted archives (JSON)
+# GET /_metrics        latency, caches and status counters (JSON)
+#
+# Images without reference are sent as stored, with sendfile if possible.
+# Diffed images are rebuilt and encoded to PNG once, then kept in an
+# ImageCache. cache_size is split between this cache and the cache of
+# decoded reference images shared by the archives. ETag of an image is its
+# stored crc32.
+
+class ArchiveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, filenames, address=("127.0.0.1", 8080), cache_size=DEFAULT_CACHE_SIZE,
+                 use_mmap=False, log=True):
+        # Archives are mounted by file name without extension
+        self.cache = ImageCache(cache_size // 2)
+        self.reference_cache = ImageCache(cache_size - cache_size // 2)
+        self.archives = {}
+        for filename in filenames:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            if name in self.archives:
+                raise RuntimeError("Archive name '%s' is mounted twice" % name)
+            self.archives[name] = HCGArchive(filename, use_mmap=use_mmap,
+                                             cache=self.reference_cache)
+        
+        self.stats = Stats()
+        self.use_mmap = use_mmap
+        self.log = log
+        
+        self._latency = deque(maxlen=LATENCY_SAMPLES)
+        self._latency_lock = Lock()
+        
+        try:
+            HTTPServer.__init__(self, address, ArchiveRequestHandler)
+        except BaseException:
+            self.close_archives()
+            raise
+    
+    def add_latency(self, seconds):
+        with self._latency_lock:
+            self._latency.append(seconds)
+        self.stats.add_time("request", seconds, 0.0)
+    
+    def metrics(self):
+        with self._latency_lock:
+            latency = sorted(self._latency)
+        
+        snapshot = self.stats.snapshot()
+        request = snapshot["stages"].get("request", {"calls": 0, "wall": 0.0})
+        
+        return {
+            "requests": request["calls"],
+            "latency": {
+                "mean": request["calls"] and request["wall"] / request["calls"] or 0.0,
+                "p50": _percentile(latency, 0.5),
+                "p95": _percentile(latency, 0.95),
+                "p99": _percentile(latency, 0.99),
+                "max": latency and latency[-1] or 0.0,
+                "samples": len(latency),
+            },
+            "cache": _cache_stats(self.cache),
+            "reference_cache": _cache_stats(self.reference_cache),
+            "counters": snapshot["counters"],
+        }
+    
+    def close_archives(self):
+        for archive in self.archives.values():
+            archive.close()
+    
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.close_archives()
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    server_version = "hcg"
+    protocol_version = "HTTP/1.1"
+    
+    def do_GET(self):
+        self._handle(True)
+    
+    def do_HEAD(self):
+        self._handle(False)
+    
+    def _handle(self, send_body):
+        started = timer()
+        try:
+            self._route(send_body)
+        finally:
+            self.server.add_latency(timer() - started)
+    
+    def _route(self, send_body):
+        path = unquote(self.path.split("?", 1)[0])
+        
+        if path == METRICS_PATH:
+            return self._send_json(self.server.metrics(), send_body)
+        if path == "/":
+            return self._send_json(sorted(self.server.archives), send_body)
+        
+        name, _, key = path.lstrip("/").partition("/")
+        archive = self.server.archives.get(name)
+        if archive is None or not key:
+            return self._send_error(404)
+        
+        try:
+            img = archive.get(key)
+        except KeyError:
+            return self._send_error(404)
+        
+        etag = '"%08x"' % img.crc32
+        if _etag_matches(self.headers.get("If-None-Match"), etag):
+            self.server.stats.incr("status.304")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        
+        if img.has_diff:
+            self._send_diffed(archive, img, etag, send_body)
+        else:
+            self._send_stored(archive, img, etag, send_body)
+    
+    def _send_stored(self, archive, img, etag, send_body):
+        content_type = mimetypes.guess_type(img.key)[0] or "application/octet-stream"
+        self._send_headers(200, content_type, img.size, etag)
+        if not send_body:
+            return
+        
+        self.wfile.flush()
+        if not self._sendfile(archive, img):
+            self.wfile.write(img.get_data())
+        self.server.stats.incr("bytes_sent", img.size)
+    
+    def _sendfile(self, archive, img):
+        # Send data with sendfile from the archive file, return False if it
+        # can not be used
+        if not hasattr(os, "sendfile") or self.server.use_mmap:
+            return False
+        
+        out_fd, in_fd = self.connection.fileno(), archive.f.fileno()
+        position, sent = img.position, 0
+        try:
+            while sent < img.size:
+                n = os.sendfile(out_fd, in_fd, position + sent, img.size - sent)
+                if n == 0:
+                    raise RuntimeError("HCG archive is truncated")
+                sent += n
+        except OSError as e:
+            if sent or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            return False
+        
+        self.server.stats.incr("sendfile")
+        return True
+    
+    def _send_diffed(self, archive, img, etag, send_body):
+        # Cached values are (content type, etag, body), ImageCache counts the
+        # size of the third item
+        cache_key = (id(archive), img.key)
+        value = self.server.cache.get(cache_key)
+        
+        if value is None:
+            f = BytesIO()
+            img.get_origin_image().save(f, "png")
+            value = ("image/png", etag, f.getvalue())
+            self.server.cache.put(cache_key, value)
+            self.server.stats.incr("rebuilt")
+        
+        content_type, etag, body = value
+        self._send_headers(200, content_type, len(body), etag)
+        if send_body:
+            self.wfile.write(body)
+            self.server.stats.incr("bytes_sent", len(body))
+    
+    def _send_headers(self, status, content_type, length, etag=None):
+        self.server.stats.incr("status.%i" % status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+    
+    def _send_json(self, data, send_body):
+        body = json.dumps(data, indent=2, sort_keys=True).encode()
+        self._send_headers(200, "application/json", len(body))
+        if send_body:
+            self.wfile.write(body)
+    
+    def _send_error(self, status):
+        body = ("%i %s\n" % (status, self.responses[status][0])).encode()
+        self._send_headers(status, "text/plain", len(body))
+        if self.command != "HEAD":
+            self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        if self.server.log:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def _etag_matches(header, etag):
+    # If-None-Match is a comma separated list of ETags, or "*". ETags are
+    # compared with the weak comparison (RFC 7232), W/ prefix is ignored.
+    if not header:
+        return False
+    values = [value.strip() for value in header.split(",")]
+    values = [value[2:] if value.startswith("W/") else value for value in values]
+    return "*" in values or etag in values
+
+def _cache_stats(cache):
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = lookups and float(stats["hits"]) / lookups or 0.0
+    return stats
+
+def _percentile(values, q):
+    # values is sorted
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
@@ -0,0 +1,120 @@
+
+import os
+from hashlib import md5
+from threading import Lock
+
+from hcg.utils import BytesIO
+
+__all__ = ["PayloadStore", "Payload"]
+
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+
+# Usage sample:
+#
+# store = PayloadStore(tempfolder, memory_limit=64 * 1024 * 1024)
+#
+# payload = store.put("a.png", buf)
+# with payload.open() as f:
+#     f.read()
+#
+# print(store.spilled_bytes) # total bytes ever written to disk
+# store.close()
+#
+# Payloads are kept in memory while total size of payloads in memory is less
+# than memory_limit, the others are written to files in tempfolder.
+
+class PayloadStore(object):
+    def __init__(self, tempfolder, memory_limit=DEFAULT_MEMORY_LIMIT):
+        self.tempfolder = tempfolder
+        self.memory_limit = memory_limit
+        
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.spilled_count = 0
+        
+        self._lock = Lock()
+        self._payloads = set()
+    
+    def put(self, name, buf):
+        size = len(buf)
+        
+        with self._lock:
+            in_memory = self.memory_bytes + size <= self.memory_limit
+            if in_memory:
+                self.memory_bytes += size
+            else:
+                self.spilled_bytes += size
+                self.spilled_count += 1
+        
+        if in_memory:
+            payload = Payload(self, size, buf=bytes(buf))
+        else:
+            # Payloads are PNG, delta or tiled diffs, the suffix is neutral
+            filename = os.path.join(
+                self.tempfolder,
+                "%s.bin" % md5(name.encode()).hexdigest()
+            )
+            
+            with open(filename, "wb") as f:
+                f.write(buf)
+            
+            payload = Payload(self, size, filename=filename)
+        
+        with self._lock:
+            self._payloads.add(payload)
+        return payload
+    
+    def discard(self, payload):
+        with self._lock:
+            if payload not in self._payloads:
+                return
+            
+            self._payloads.remove(payload)
+            if not payload.filename:
+                self.memory_bytes -= payload.size
+        
+        if payload.filename:
+            os.remove(payload.filename)
+    
+    def close(self):
+        for payload in list(self._payloads):
+            self.discard(payload)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "payloads": len(self._payloads),
+                "memory_bytes": self.memory_bytes,
+                "memory_limit": self.memory_limit,
+                "spilled_bytes": self.spilled_bytes,
+                "spilled_count": self.spilled_count,
+            }
+
+
+class Payload(object):
+    def __init__(self, store, size, buf=None, filename=None):
+        self.store = store
+        self.size = size
+        self.filename = filename
+        self._buf = buf
+    
+    @property
+    def in_memory(self):
+        return self.filename is None
+    
+    def open(self):
+        # Return a readable file object of payload
+        if self.filename:
+            return open(self.filename, "rb")
+        else:
+            return BytesIO(self._buf)
+    
+    def get_data(self):
+        if self.filename:
+            with self.open() as f:
+                return f.read()
+        else:
+            return self._buf
+    
+    def discard(self):
+        self.store.discard(self)
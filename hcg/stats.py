@@ -0,0 +1,161 @@
+
+import json
+import time
+from threading import Lock
+
+__all__ = ["Stats", "stage", "incr", "gauge", "add_hook", "remove_hook"]
+
+try:
+    timer = time.perf_counter
+    cpu_timer = time.process_time
+except AttributeError:
+    timer = time.time
+    cpu_timer = time.clock
+
+# Usage sample:
+#
+# from hcg import stats
+#
+# with stats.stage("sampling"):
+#     ...
+# stats.incr("archive.bytes_read", len(buf))
+# stats.gauge("executor.queue_depth", depth)
+#
+# def hook(kind, name, value):
+#     # kind is "stage" (value is (wall, cpu) seconds), "counter" or "gauge"
+#     print(kind, name, value)
+# stats.add_hook(hook)
+#
+# print(Stats.default_stats().format_table())
+# Stats.default_stats().snapshot()  # a dict, see Stats.snapshot
+#
+# CPU time of a stage is the CPU time of the whole process while the stage
+# runs, so it includes worker threads.
+
+class Stats(object):
+    __default_stats = None
+    
+    @classmethod
+    def default_stats(cls):
+        if not cls.__default_stats:
+            cls.__default_stats = cls()
+        return cls.__default_stats
+    
+    def __init__(self):
+        self._lock = Lock()
+        self._hooks = []
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self._stages = {}   # {name: [calls, wall, cpu]}
+            self._counters = {} # {name: value}
+            self._gauges = {}   # {name: [last, max]}
+    
+    def add_hook(self, hook):
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+    
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h != hook]
+    
+    def add_time(self, name, wall, cpu):
+        with self._lock:
+            item = self._stages.get(name)
+            if item is None:
+                item = self._stages[name] = [0, 0.0, 0.0]
+            item[0] += 1
+            item[1] += wall
+            item[2] += cpu
+            hooks = self._hooks
+        
+        for hook in hooks:
+            hook("stage", name, (wall, cpu))
+    
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            hooks = self._hooks
+        
+        for hook in hooks:
+            hook("counter", name, value)
+    
+    def gauge(self, name, value):
+        with self._lock:
+            item = self._gauges.get(name)
+            if item is None:
+                self._gauges[name] = [value, value]
+            else:
+                item[0] = value
+                item[1] = max(item[1], value)
+            hooks = self._hooks
+        
+        for hook in hooks:
+            hook("gauge", name, value)
+    
+    def stage(self, name):
+        return _Stage(self, name)
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": dict((name, {"calls": calls, "wall": wall, "cpu": cpu})
+                               for name, (calls, wall, cpu) in self._stages.items()),
+                "counters": dict(self._counters),
+                "gauges": dict((name, {"last": last, "max": max_value})
+                               for name, (last, max_value) in self._gauges.items()),
+            }
+    
+    def format_table(self):
+        data = self.snapshot()
+        lines = ["%-32s %8s %12s %12s" % ("stage", "calls", "wall (s)", "cpu (s)")]
+        for name, item in sorted(data["stages"].items()):
+            lines.append("%-32s %8i %12.3f %12.3f" % (name, item["calls"], item["wall"], item["cpu"]))
+        
+        if data["counters"]:
+            lines.append("")
+            lines.append("%-32s %21s" % ("counter", "value"))
+            for name, value in sorted(data["counters"].items()):
+                lines.append("%-32s %21i" % (name, value))
+        
+        if data["gauges"]:
+            lines.append("")
+            lines.append("%-32s %8s %12s" % ("gauge", "last", "max"))
+            for name, item in sorted(data["gauges"].items()):
+                lines.append("%-32s %8s %12s" % (name, item["last"], item["max"]))
+        
+        return "\n".join(lines)
+    
+    def format_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+
+class _Stage(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+    
+    def __enter__(self):
+        self._wall = timer()
+        self._cpu = cpu_timer()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_time(self.name, timer() - self._wall, cpu_timer() - self._cpu)
+
+
+def stage(name):
+    return Stats.default_stats().stage(name)
+
+def incr(name, value=1):
+    Stats.default_stats().incr(name, value)
+
+def gauge(name, value):
+    Stats.default_stats().gauge(name, value)
+
+def add_hook(hook):
+    Stats.default_stats().add_hook(hook)
+
+def remove_hook(hook):
+    Stats.default_stats().remove_hook(hook)
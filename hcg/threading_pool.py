@@ -1,33 +1,156 @@
 
-import sys
 import threading
-from time import sleep
 from collections import deque
-from traceback import print_exception
 from multiprocessing import cpu_count
 
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from concurrent.futures import Future
+
+from hcg import stats
+
 try:
     range = xrange
 except NameError:
     pass
 
-__all__ = ["ThreadPool", "DynamicThreadPool", "ThreadPoolWorker"]
+__all__ = ["Executor", "ThreadPool", "DynamicThreadPool", "ThreadPoolWorker"]
+
+# Usage sample:
+#
+# executor = Executor(4)
+#
+# future = executor.submit(pow, 2, 10)
+# print(future.result())
+#
+# futures = executor.submit_batch([(pow, (2, i), {}) for i in range(10)])
+# print([f.result() for f in futures])
+#
+# executor.shutdown()
+#
+class Executor(object):
+    # Workers wait on a blocking queue, a task is picked up as soon as a
+    # worker is free. Results and exceptions are returned through futures.
+    __default_executor = None
+    
+    @classmethod
+    def default_executor(cls):
+        if not cls.__default_executor:
+            cls.__default_executor = cls()
+        return cls.__default_executor
+    
+    def __init__(self, max_workers=cpu_count(), threads_name="Executor"):
+        # If max_workers is None, a new thread is launched whenever all
+        # threads are busy.
+        self.max_workers = max_workers
+        self.threads_name = threads_name
+        
+        self._queue = Queue()
+        self._threads = []
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._running = True
+    
+    def submit(self, fn, *args, **kw):
+        future = Future()
+        
+        with self._lock:
+            if self._running == False: raise ThreadPoolException("Executor is going down.")
+            
+            self._queue.put((future, fn, args, kw))
+            self._adjust_threads()
+        
+        stats.gauge("executor.queue_depth", self._queue.qsize())
+        return future
+    
+    def submit_batch(self, tasks):
+        # tasks is a list of (fn, args, kw), return a list of futures in same
+        # order.
+        futures = []
+        
+        with self._lock:
+            if self._running == False: raise ThreadPoolException("Executor is going down.")
+            
+            for fn, args, kw in tasks:
+                future = Future()
+                self._queue.put((future, fn, args, kw))
+                self._adjust_threads()
+                futures.append(future)
+        
+        stats.gauge("executor.queue_depth", self._queue.qsize())
+        return futures
+    
+    def _adjust_threads(self):
+        if self._idle.acquire(False):
+            return
+        
+        if self.max_workers is None or len(self._threads) < self.max_workers:
+            t = threading.Thread(target=self._work,
+                                 name="%s-%i" % (self.threads_name, len(self._threads)))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+    
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            future, fn, args, kw = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kw)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            
+            del item, future
+            self._idle.release()
+    
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._running = False
+            for t in self._threads:
+                self._queue.put(None)
+        
+        if wait:
+            for t in list(self._threads):
+                t.join()
+    
+    @property
+    def total_threads(self):
+        return len(self._threads)
+    
+    @property
+    def queue_depth(self):
+        # Number of tasks waiting for a worker
+        return self._queue.qsize()
+
 
+# ThreadPool, DynamicThreadPool and ThreadPoolWorker are kept for
+# compatibility, tasks are run by an Executor.
+#
 # Usage sample:
-# 
+#
 # class MyWorker(ThreadPoolWorker):
 #     def on_task(self, task):
 #         print(task)
-#     
+#
 #     def on_error(self, task, error):
 #         print("Something is wrong with error: %s"%(", ".join(error.args))
-# 
+#
 # pool = ThreadPool(MyTask)
-# 
+#
 # pool.assign_task(1)
 # pool.assign_task(2)
-# pool.assign_task(3)
-# 
+# future = pool.assign_task(3)
+# future.result()
+#
 # pool.shutdown()
 #
 class ThreadPool(object):
@@ -38,40 +161,49 @@ class ThreadPool(object):
         if not cls.__default_pool:
             cls.__default_pool = cls()
         return cls.__default_pool
-        
+    
     def __init__(self, task_handler=None, pool_size=cpu_count(), threads_name="ThreadPools"):
         self._pool_size = pool_size
         self._thread_pool = []
         self._padding_pool = deque()
-        self._semaphore = threading.Semaphore(pool_size)
         self._running = True
         self.threads_name = threads_name
         self.task_handler = task_handler or Worker
-
+        self._executor = self._create_executor()
+        
         for i in range(pool_size):
             self._padding_pool.append( self._launch_thread() )
-        
+    
+    def _create_executor(self):
+        return Executor(self._pool_size, self.threads_name)
+    
     def _launch_thread(self):
         if self._running == False: raise ThreadPoolException("ThreadPool is going down.")
         
         t = self.task_handler(self)
         self._thread_pool.append(t)
-        t.start()
         return t
-        
+    
     def assign_task(self, task):
+        # Return a future of the task result
         if self._running == False: raise ThreadPoolException("ThreadPool is going down.")
-        
-        while self._semaphore.acquire(False) == False:
-            sleep(0.05)
-        
+        return self._executor.submit(self._run_task, task)
+    
+    def assign_tasks(self, tasks):
+        if self._running == False: raise ThreadPoolException("ThreadPool is going down.")
+        return self._executor.submit_batch([(self._run_task, (task, ), {}) for task in tasks])
+    
+    def _run_task(self, task):
+        # Executor never run more tasks than handlers at the same time
         t = self._padding_pool.pop()
-        t.assign_task(task)
+        try:
+            return t.run_task(task)
+        finally:
+            self.thread_back(t)
     
     def thread_back(self, _thread):
         if _thread in self._thread_pool:
             self._padding_pool.append(_thread)
-            self._semaphore.release()
         else:
             raise ThreadPoolException("%s is not blongs to ThreadPool"%_thread)
     
@@ -86,12 +218,10 @@ class ThreadPool(object):
         l = list(self._thread_pool)
         for t in l:
             t.shutdown()
+        self._executor.shutdown(wait=False)
     
     def wait(self):
-        l = list(self._thread_pool)
-        for t in l:
-            while t.isAlive():
-                t.join(0.5)
+        self._executor.shutdown(wait=True)
     
     @property
     def total_threads(self):
@@ -100,22 +230,32 @@ class ThreadPool(object):
     @property
     def padding_threads(self):
         return len(self._padding_pool)
+    
+    @property
+    def queue_depth(self):
+        return self._executor.queue_depth
 
 
 class DynamicThreadPool(ThreadPool):
-    def assign_task(self, task):
-        if self._running == False: raise ThreadPoolException("ThreadPool is going down.")
+    # Launch a new handler (and thread) when all handlers are busy
+    def _create_executor(self):
+        return Executor(None, self.threads_name)
+    
+    def _run_task(self, task):
         try:
             t = self._padding_pool.pop()
-            t.assign_task(task)
         except IndexError:
             t = self._launch_thread()
-            t.assign_task(task)
+        
+        try:
+            return t.run_task(task)
+        finally:
+            self.thread_back(t)
     
     def thread_back(self, _thread):
         if _thread in self._thread_pool:
             if len(self._padding_pool) > self._pool_size:
-                _thread.shutdown()
+                self.unregist_thread(_thread)
             else:
                 self._padding_pool.append(_thread)
         else:
@@ -123,38 +263,47 @@ class DynamicThreadPool(ThreadPool):
 
 
 class ThreadPoolWorker(threading.Thread):
+    # Task handler of ThreadPool, exceptions raised by on_task are passed to
+    # on_error and then to the future of the task. Pools call run_task from
+    # their executor and never start the thread; a started worker runs the
+    # tasks given to assign_task until shutdown, as before.
     def __init__(self, pool):
         self.pool = pool
         self._event = threading.Event()
-        self._event.clear()
+        self._task = None
         self._padding = True
         self._running = True
         
         super(ThreadPoolWorker, self).__init__()
-        self.setDaemon(True)
-        
-        
+        self.daemon = True
+    
     @property
     def name(self):
         return (self._padding and "%s-Idle" or "%s-Execute") % \
             self.pool.threads_name
     
+    def run_task(self, task):
+        self._padding = False
+        try:
+            return self.on_task(task)
+        except Exception as e:
+            self.on_error(task, e)
+            raise
+        finally:
+            self._padding = True
+    
     def run(self):
         while self._running:
             self._event.wait()
             self._event.clear()
-            if self._running:
-                self._padding = False
+            
+            task, self._task = self._task, None
+            if self._running and task is not None:
                 try:
-                    self.on_task(self._task)
-                except Exception as e:
-                    self.on_error(self._task, e)
-                
-                self._task = None
-                self._padding = True
-                self.pool.thread_back(self)
-        
-        self.pool.unregist_thread(self)
+                    self.run_task(task)
+                except Exception:
+                    # Passed to on_error already
+                    pass
     
     def assign_task(self, task):
         self._task = task
@@ -162,10 +311,9 @@ class ThreadPoolWorker(threading.Thread):
     
     def on_task(self, task):
         pass
-        
+    
     def on_error(self, task, exception):
-        exc_info = sys.exc_info()
-        print_exception(*exc_info)
+        pass
     
     def is_padding(self):
         return self._padding
@@ -177,8 +325,8 @@ class ThreadPoolWorker(threading.Thread):
 class Worker(ThreadPoolWorker):
     def on_task(self, task):
         callback, args, kw = task
-        callback(*args, **kw)
-    
+        return callback(*args, **kw)
+
 
 class ThreadPoolException(Exception):
     pass
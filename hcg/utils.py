@@ -1,8 +1,168 @@
 
-__all__ = ["BytesIO"]
+import io
+import os
+import errno
+from threading import Lock
+
+__all__ = ["BytesIO", "BufferReader", "copy_file_data", "read_at"]
+
+COPY_CHUNK_SIZE = 1024 * 1024
 
 try:
     from io import BytesIO
 except ImportError:
     from StringIO import StringIO as BytesIO
 
+
+class BufferReader(io.RawIOBase):
+    # Read-only file object over a buffer (bytes, memoryview, mmap...). Unlike
+    # BytesIO it does not copy the whole buffer, only the bytes being read.
+    
+    def __init__(self, buf):
+        self._buf = memoryview(buf)
+        self._pos = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, b):
+        data = self._buf[self._pos:self._pos + len(b)]
+        size = len(data)
+        b[:size] = data
+        self._pos += size
+        return size
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._buf)
+        else:
+            end = self._pos + size
+        
+        data = self._buf[self._pos:end].tobytes()
+        self._pos += len(data)
+        return data
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._buf) + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        
+        if pos < 0:
+            raise ValueError("negative seek position %r" % pos)
+        
+        self._pos = pos
+        return pos
+    
+    def tell(self):
+        return self._pos
+    
+    def close(self):
+        if not self.closed:
+            self._buf.release()
+        super(BufferReader, self).close()
+
+
+_seek_lock = Lock()
+
+def read_at(f, position, size):
+    # Read `size` bytes at `position` of file object f without moving its
+    # file position, so threads can share f. Return less than size bytes
+    # only at EOF. os.pread is used if available, otherwise seek and read
+    # are serialized by a lock.
+    if not hasattr(os, "pread"):
+        with _seek_lock:
+            f.seek(position)
+            return f.read(size)
+    
+    fd = f.fileno()
+    buf = os.pread(fd, size, position)
+    if len(buf) == size or not buf:
+        return buf
+    
+    # Short read, large reads are split by the kernel
+    chunks = [buf]
+    read = len(buf)
+    while read < size:
+        buf = os.pread(fd, size - read, position + read)
+        if not buf:
+            break
+        chunks.append(buf)
+        read += len(buf)
+    return b"".join(chunks)
+
+def copy_file_data(src, dst, size, chunk_size=COPY_CHUNK_SIZE):
+    # Copy `size` bytes from the current position of file object src to the
+    # current position of file object dst, return bytes copied (less than
+    # size only if src reach EOF). If both are real files, data is copied by
+    # kernel (copy_file_range or sendfile), otherwise it is copied through a
+    # buffer of chunk_size bytes.
+    dst.flush()
+    src_pos, dst_pos = src.tell(), dst.tell()
+    
+    copied = 0
+    try:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        pass
+    else:
+        copied = _copy_fd(src_fd, dst_fd, src_pos, dst_pos, size)
+    
+    if copied < size:
+        src.seek(src_pos + copied)
+        dst.seek(dst_pos + copied)
+        copied += _copy_chunks(src, dst, size - copied, chunk_size)
+    
+    src.seek(src_pos + copied)
+    dst.seek(dst_pos + copied)
+    return copied
+
+def _copy_fd(src_fd, dst_fd, src_pos, dst_pos, size):
+    copied = 0
+    
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - copied,
+                                       src_pos + copied, dst_pos + copied)
+                if n == 0: return copied
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    
+    if hasattr(os, "sendfile"):
+        # sendfile write to the current offset of dst_fd
+        os.lseek(dst_fd, dst_pos + copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                n = os.sendfile(dst_fd, src_fd, src_pos + copied, size - copied)
+                if n == 0: return copied
+                copied += n
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    
+    return copied
+
+def _copy_chunks(src, dst, size, chunk_size):
+    chunk = memoryview(bytearray(min(size, chunk_size)))
+    copied = 0
+    
+    while copied < size:
+        n = src.readinto(chunk[:min(size - copied, len(chunk))])
+        if not n:
+            break
+        dst.write(chunk[:n])
+        copied += n
+    
+    return copied
@@ -0,0 +1,209 @@
+
+import mmap
+import threading
+from time import time
+from binascii import crc32
+from multiprocessing import cpu_count
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from hcg.archive import HCGArchive
+
+__all__ = ["verify_archive", "VerifyResult"]
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Usage sample:
+#
+# def progress(key, expected_crc32, real_crc32):
+#     print("%s %s" % (key, expected_crc32 == real_crc32 and "OK" or "FAILED"))
+#
+# result = verify_archive("cg.hcg", threads=4, callback=progress)
+# print("%.1f MB/s" % result.throughput)
+#
+# Images are checked by `threads` threads, each thread reads image data in
+# chunks of `chunk_size` bytes into its own buffer and updates the CRC32 after
+# each chunk, so memory usage is bounded by threads * chunk_size. zlib
+# releases the GIL while checksumming, so reading and checksumming overlap
+# between threads. Header and tail indexes are checked by the same threads.
+
+class VerifyResult(object):
+    def __init__(self):
+        self.images = 0
+        self.expected_images = 0 # images listed by the index
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failed = [] # [(key, expected_crc32, real_crc32), ...]
+        self.errors = [] # [(task name, exception), ...]
+    
+    @property
+    def ok(self):
+        # Images left unchecked (e.g. no worker could open the archive) are
+        # a failure too
+        return not self.failed and not self.errors and self.images == self.expected_images
+    
+    @property
+    def throughput(self):
+        # MB/s of image data
+        if self.seconds:
+            return self.bytes / 1048576.0 / self.seconds
+        else:
+            return 0.0
+
+def verify_archive(filename, threads=cpu_count(), chunk_size=DEFAULT_CHUNK_SIZE,
+                   use_mmap=False, callback=None):
+    # callback(key, expected_crc32, real_crc32) is called after each image is
+    # checked, calls are serialized.
+    result = VerifyResult()
+    started = time()
+    
+    # A broken index is reported as an error, header and tail indexes are
+    # still checked by the workers
+    try:
+        archive = HCGArchive(filename, cache=False)
+        try:
+            images = archive.get_images()
+        finally:
+            archive.close()
+    except Exception as e:
+        result.errors.append(("index", e))
+        images = []
+    
+    # Read data in file order
+    images.sort(key=lambda img: img.position)
+    result.expected_images = len(images)
+    
+    tasks = Queue()
+    tasks.put(("header index", None))
+    tasks.put(("tail index", None))
+    for img in images:
+        tasks.put((img.key, img))
+    
+    lock = threading.Lock()
+    workers = []
+    for i in range(max(threads, 1)):
+        tasks.put(None)
+        
+        w = _VerifyWorker(filename, tasks, chunk_size, use_mmap,
+                          result, lock, callback)
+        w.start()
+        workers.append(w)
+    
+    for w in workers:
+        w.join()
+    
+    result.seconds = time() - started
+    return result
+
+
+class _VerifyWorker(threading.Thread):
+    def __init__(self, filename, tasks, chunk_size, use_mmap, result, lock, callback):
+        super(_VerifyWorker, self).__init__()
+        self.daemon = True
+        
+        self.filename = filename
+        self.tasks = tasks
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap
+        self.result = result
+        self.lock = lock
+        self.callback = callback
+    
+    def run(self):
+        # A worker which can not open the archive leaves its tasks to the
+        # others, unchecked images make the result fail
+        try:
+            f = open(self.filename, "rb")
+        except Exception as e:
+            with self.lock:
+                self.result.errors.append(("open", e))
+            return
+        
+        with f:
+            try:
+                if self.use_mmap:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._buffer = memoryview(self._mmap)
+                else:
+                    self._f = f
+                    self._chunk = bytearray(self.chunk_size)
+            except Exception as e:
+                with self.lock:
+                    self.result.errors.append(("open", e))
+                return
+            
+            try:
+                while True:
+                    task = self.tasks.get()
+                    if task is None:
+                        break
+                    
+                    name, img = task
+                    try:
+                        if img is None:
+                            self.verify_index(name)
+                        else:
+                            self.verify_image(img)
+                    except Exception as e:
+                        with self.lock:
+                            self.result.errors.append((name, e))
+            finally:
+                if self.use_mmap:
+                    self._buffer.release()
+                    self._mmap.close()
+    
+    def verify_index(self, name):
+        archive = HCGArchive(self.filename, cache=False)
+        try:
+            if name == "header index":
+                archive.validate_header_index()
+            else:
+                archive.validate_tail_index()
+        finally:
+            archive.close()
+    
+    def verify_image(self, img):
+        if self.use_mmap:
+            real_crc32 = self._crc32_buffer(img.position, img.size)
+        else:
+            real_crc32 = self._crc32_file(img.position, img.size)
+        
+        with self.lock:
+            self.result.images += 1
+            self.result.bytes += img.size
+            if real_crc32 != img.crc32:
+                self.result.failed.append((img.key, img.crc32, real_crc32))
+            
+            if self.callback:
+                self.callback(img.key, img.crc32, real_crc32)
+    
+    def _crc32_file(self, position, size):
+        f, chunk = self._f, memoryview(self._chunk)
+        f.seek(position)
+        
+        value = 0
+        while size > 0:
+            length = f.readinto(chunk[:min(size, self.chunk_size)])
+            if not length:
+                raise RuntimeError("HCG archive is truncated")
+            
+            value = crc32(chunk[:length], value)
+            size -= length
+        
+        return value & 0xffffffff
+    
+    def _crc32_buffer(self, position, size):
+        end = position + size
+        if end > len(self._buffer):
+            raise RuntimeError("HCG archive is truncated")
+        
+        value = 0
+        while position < end:
+            chunk_end = min(position + self.chunk_size, end)
+            value = crc32(self._buffer[position:chunk_end], value)
+            position = chunk_end
+        
+        return value & 0xffffffff
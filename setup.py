@@ -9,6 +9,15 @@ from Cython.Distutils import build_ext
 
 VERSION = __import__("hcg").VERSION
 
+# Kernels are parallelized with OpenMP, set HCG_NO_OPENMP=1 to build them
+# without it (prange loops run on one thread).
+if os.environ.get("HCG_NO_OPENMP"):
+    OPENMP_FLAGS = []
+elif sys.platform == "win32":
+    OPENMP_FLAGS = ["/openmp"]
+else:
+    OPENMP_FLAGS = ["-fopenmp"]
+
 setup(
     name='hcg',
     version="0.0.1",
@@ -20,10 +29,12 @@ setup(
     packages=['hcg'],
     ext_modules=[
         Extension(
-            'hcg._compress', sources = ["src/compress.pyx"]
+            'hcg._compress', sources = ["src/compress.pyx"],
+            extra_compile_args=OPENMP_FLAGS, extra_link_args=OPENMP_FLAGS
         ),
         Extension(
-            'hcg._sampling', sources = ["src/sampling.pyx"]
+            'hcg._sampling', sources = ["src/sampling.pyx"],
+            extra_compile_args=OPENMP_FLAGS, extra_link_args=OPENMP_FLAGS
         )
     ],
 )
@@ -1,17 +1,30 @@
-
 ctypedef unsigned long long uint64_t
+from cython.parallel cimport prange
 
 __all__ = ("diff_buffer", "merge_buffer")
 
-cpdef diff_buffer(unsigned char* data, const unsigned char* ref_data, uint64_t length):
-    cdef uint64_t i
-    with nogil:
-        for i from 0 <= i < length:
+# Buffers shorter than this are always processed by one thread, starting
+# OpenMP threads costs more than the loop
+cdef uint64_t PARALLEL_MIN_LENGTH = 1 << 16
+
+cpdef diff_buffer(unsigned char* data, const unsigned char* ref_data, uint64_t length, int threads=1):
+    cdef Py_ssize_t i, n = length
+    
+    if threads > 1 and length >= PARALLEL_MIN_LENGTH:
+        for i in prange(n, nogil=True, num_threads=threads, schedule="static"):
             data[i] = data[i] - ref_data[i]
+    else:
+        with nogil:
+            for i from 0 <= i < n:
+                data[i] = data[i] - ref_data[i]
 
-cpdef merge_buffer(unsigned char* data, const unsigned char* ref_data, uint64_t length):
-    cdef uint64_t i
-    with nogil:
-        for i from 0 <= i < length:
-            data[i] = data[i] + ref_data[i]
+cpdef merge_buffer(unsigned char* data, const unsigned char* ref_data, uint64_t length, int threads=1):
+    cdef Py_ssize_t i, n = length
     
+    if threads > 1 and length >= PARALLEL_MIN_LENGTH:
+        for i in prange(n, nogil=True, num_threads=threads, schedule="static"):
+            data[i] = data[i] + ref_data[i]
+    else:
+        with nogil:
+            for i from 0 <= i < n:
+                data[i] = data[i] + ref_data[i]
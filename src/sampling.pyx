@@ -1,8 +1,11 @@
 
 ctypedef unsigned long long uint64_t
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, free
+from cython.parallel cimport prange
 
-__all__ = ("sampling_bbox", )
+from hcg.sampling import split_line
+
+__all__ = ("sampling_bbox", "sampling_grid")
 
 cpdef sampling_bbox(unsigned char* data, uint64_t width, uint64_t height, uint64_t bands, bbox, cb, index):
     cdef uint64_t b_left, b_top, b_width, b_height
@@ -10,7 +13,9 @@ cpdef sampling_bbox(unsigned char* data, uint64_t width, uint64_t height, uint64
     b_left, b_top, b_width, b_height = bbox
     
     cdef uint64_t offset_base, offset_row, offset_x, offset_y, offset, i
-    cdef uint64_t* output = <uint64_t*>malloc(bands * sizeof(uint64_t *))
+    cdef uint64_t* output = <uint64_t*>malloc(bands * sizeof(uint64_t))
+    if output == NULL:
+        raise MemoryError()
     
     for i from 0 <= i < bands:
         output[i] = 0
@@ -31,3 +36,93 @@ cpdef sampling_bbox(unsigned char* data, uint64_t width, uint64_t height, uint64
     py_output = [output[i] for i in range(bands)]
     free(output)
     cb(index, py_output)
+
+cdef inline void _sampling_rows(const unsigned char* data, uint64_t width, uint64_t bands,
+                                uint64_t top, uint64_t bottom, const uint64_t* x_segment,
+                                uint64_t* row_output) noexcept nogil:
+    # Add rows [top, bottom) to the band sums of a row of regions, band loops
+    # of L, RGB and RGBA are unrolled
+    cdef uint64_t x, y, i
+    cdef uint64_t offset = top * width * bands
+    cdef uint64_t* pixel_output
+    
+    if bands == 1:
+        for y from top <= y < bottom:
+            for x from 0 <= x < width:
+                row_output[x_segment[x]] += data[offset]
+                offset += 1
+    elif bands == 3:
+        for y from top <= y < bottom:
+            for x from 0 <= x < width:
+                pixel_output = row_output + x_segment[x] * 3
+                pixel_output[0] += data[offset]
+                pixel_output[1] += data[offset + 1]
+                pixel_output[2] += data[offset + 2]
+                offset += 3
+    elif bands == 4:
+        for y from top <= y < bottom:
+            for x from 0 <= x < width:
+                pixel_output = row_output + x_segment[x] * 4
+                pixel_output[0] += data[offset]
+                pixel_output[1] += data[offset + 1]
+                pixel_output[2] += data[offset + 2]
+                pixel_output[3] += data[offset + 3]
+                offset += 4
+    else:
+        for y from top <= y < bottom:
+            for x from 0 <= x < width:
+                pixel_output = row_output + x_segment[x] * bands
+                for i from 0 <= i < bands:
+                    pixel_output[i] += data[offset + i]
+                offset += bands
+
+cpdef sampling_grid(const unsigned char* data, uint64_t width, uint64_t height, uint64_t bands, int threads=1):
+    # Band sums of every split_rect region, rows of regions are summed by
+    # OpenMP threads if threads > 1
+    x_bounds = list(split_line(width))
+    y_bounds = list(split_line(height))
+    
+    cdef uint64_t columns = len(x_bounds), rows = len(y_bounds)
+    cdef uint64_t x, segment
+    cdef Py_ssize_t row, n_rows = rows
+    
+    # Map every column to its region, then walk the buffer once
+    cdef uint64_t* x_segment = <uint64_t*>malloc(width * sizeof(uint64_t))
+    cdef uint64_t* y_top = <uint64_t*>malloc(rows * sizeof(uint64_t))
+    cdef uint64_t* y_bottom = <uint64_t*>malloc(rows * sizeof(uint64_t))
+    cdef uint64_t* output = <uint64_t*>calloc(columns * rows * bands, sizeof(uint64_t))
+    
+    if x_segment == NULL or y_top == NULL or y_bottom == NULL or output == NULL:
+        # free(NULL) does nothing
+        free(x_segment)
+        free(y_top)
+        free(y_bottom)
+        free(output)
+        raise MemoryError()
+    
+    for segment, (left, right) in enumerate(x_bounds):
+        for x from left <= x < right:
+            x_segment[x] = segment
+    
+    for segment, (top, bottom) in enumerate(y_bounds):
+        y_top[segment] = top
+        y_bottom[segment] = bottom
+    
+    if threads > 1 and rows > 1:
+        for row in prange(n_rows, nogil=True, num_threads=threads, schedule="dynamic"):
+            _sampling_rows(data, width, bands, y_top[row], y_bottom[row], x_segment,
+                           output + row * columns * bands)
+    else:
+        with nogil:
+            for row from 0 <= row < n_rows:
+                _sampling_rows(data, width, bands, y_top[row], y_bottom[row], x_segment,
+                               output + row * columns * bands)
+    
+    py_output = [[output[segment * bands + i] for i in range(bands)]
+                 for segment in range(columns * rows)]
+    
+    free(x_segment)
+    free(y_top)
+    free(y_bottom)
+    free(output)
+    return py_output
@@ -5,13 +5,34 @@ import unittest
 def main():
     from testcase import test_sampling
     from testcase import test_compress
+    from testcase import test_ranking
+    from testcase import test_archive
+    from testcase import test_cache
+    from testcase import test_spool
+    from testcase import test_threading_pool
+    from testcase import test_diskcache
+    from testcase import test_stats
+    from testcase import test_aio
+    from testcase import test_server
+    from testcase import test_codec
     
     suite1 = unittest.TestLoader().loadTestsFromModule(test_sampling)
     suite2 = unittest.TestLoader().loadTestsFromModule(test_compress)
-
-    all_suite = unittest.TestSuite([suite1, suite2])
-    unittest.TextTestRunner(verbosity=2).run(all_suite)
-    
+    suite3 = unittest.TestLoader().loadTestsFromModule(test_ranking)
+    suite4 = unittest.TestLoader().loadTestsFromModule(test_archive)
+    suite5 = unittest.TestLoader().loadTestsFromModule(test_cache)
+    suite6 = unittest.TestLoader().loadTestsFromModule(test_spool)
+    suite7 = unittest.TestLoader().loadTestsFromModule(test_threading_pool)
+    suite8 = unittest.TestLoader().loadTestsFromModule(test_diskcache)
+    suite9 = unittest.TestLoader().loadTestsFromModule(test_stats)
+    suite10 = unittest.TestLoader().loadTestsFromModule(test_aio)
+    suite11 = unittest.TestLoader().loadTestsFromModule(test_server)
+    suite12 = unittest.TestLoader().loadTestsFromModule(test_codec)
     
+    all_suite = unittest.TestSuite([suite1, suite2, suite3, suite4, suite5, suite6,
+                                    suite7, suite8, suite9, suite10, suite11, suite12])
+    unittest.TextTestRunner(verbosity=2).run(all_suite)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
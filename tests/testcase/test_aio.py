@@ -0,0 +1,83 @@
+import asyncio
+
+from hcg import stats
+from hcg.aio import AsyncHCGArchive
+from hcg.archive import HCGArchive
+from hcg.threading_pool import Executor
+
+from testcase.test_archive import ArchiveTestCase
+
+class TestAsyncArchive(ArchiveTestCase):
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+    
+    def testRead(self):
+        archive = HCGArchive(self.filename)
+        expected = dict((key, bytes(archive.get(key).get_data())) for key in self.keys)
+        archive.close()
+        
+        async def read():
+            archive = await AsyncHCGArchive.open(self.filename, max_workers=2)
+            async with archive:
+                data = await asyncio.gather(*[archive.get_data(key) for key in self.keys])
+                images = await asyncio.gather(*[archive.get_origin_image(key)
+                                                for key in self.keys])
+                
+                with self.assertRaises(KeyError):
+                    await archive.get_data("missing.png")
+                
+                self.assertTrue(archive.executor.total_threads <= 2)
+                return data, images
+        
+        data, images = self.run_async(read())
+        self.assertEqual([expected[key] for key in self.keys], [bytes(d) for d in data])
+        self.assertEqual([self.origin_data(key) for key in self.keys],
+                         [img.tobytes() for img in images])
+    
+    def testSharedLoad(self):
+        key = self.keys[1]
+        reads = []
+        
+        archive = HCGArchive(self.filename)
+        img = archive.get(key)
+        sizes = (img.size, img.ref.size)
+        archive.close()
+        
+        def hook(kind, name, value):
+            # Reads of image data, version 2 archives read index records too
+            if name == "archive.bytes_read" and value in sizes:
+                reads.append(value)
+        
+        async def read():
+            executor = Executor(4)
+            archive = await AsyncHCGArchive.open(self.filename, executor=executor, cache=False)
+            
+            stats.add_hook(hook)
+            try:
+                data = await asyncio.gather(*[archive.get_data(key) for i in range(20)])
+                images = await asyncio.gather(*[archive.get_origin_image(key) for i in range(20)])
+            finally:
+                stats.remove_hook(hook)
+            
+            self.assertEqual({}, archive._inflight)
+            await archive.close()
+            
+            # Given executor is not shut down
+            self.assertEqual(4, executor.submit(pow, 2, 2).result())
+            executor.shutdown()
+            return data, images
+        
+        data, images = self.run_async(read())
+        self.assertTrue(all(d is data[0] for d in data))
+        self.assertTrue(all(img is images[0] for img in images))
+        
+        # One read of data, then one of the image and one of its reference
+        self.assertEqual(sorted([sizes[0], sizes[0], sizes[1]]), sorted(reads))
+        self.assertEqual(self.origin_data(key), images[0].tobytes())
+
+class TestAsyncArchiveV2(TestAsyncArchive):
+    version = 2
@@ -0,0 +1,745 @@
+import os
+import random
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from binascii import crc32
+
+from PIL import Image, ImageDraw
+
+from hcg import stats
+from hcg.archive import HCGArchive
+from hcg.cache import ImageCache, ImagePool
+from hcg.codec import CODEC_PNG, CODEC_DELTA, CODEC_TILED
+from hcg.encoder import encode_diffs
+from hcg.extract import extract_archive, plan_extraction
+from hcg.packer import HCHPacker, HCGPackImage, rewrite_archive
+from hcg.spool import PayloadStore
+from hcg.utils import BufferReader, BytesIO, copy_file_data, read_at
+from hcg import verify
+from hcg.verify import verify_archive
+
+def make_images(path, count=4, size=(120, 90), mode="RGB"):
+    # Write `count` variants of a base image to path and return their keys
+    base = Image.new(mode, size)
+    draw = ImageDraw.Draw(base)
+    for i in range(8):
+        draw.ellipse((i * 13, i * 7, i * 13 + 40, i * 7 + 30),
+                     fill=(i * 30, 255 - i * 30, i * 11)[:len(mode)])
+    
+    keys = []
+    for i in range(count):
+        img = base.copy()
+        ImageDraw.Draw(img).rectangle((i * 10, i * 5, i * 10 + 12, i * 5 + 12),
+                                      fill=(255, i * 40, 0)[:len(mode)])
+        key = "img%02i.png" % i
+        img.save(os.path.join(path, key))
+        keys.append(key)
+    return keys
+
+def pack_archive(source, keys, target, tempfolder, version=1, codec=CODEC_PNG):
+    images = dict((key, HCGPackImage(key, os.path.join(source, key)))
+                  for key in keys)
+    
+    # Every image but the first one is diffed against the first one
+    base = images[keys[0]]
+    for key in keys[1:]:
+        images[key].make_ref(base, tempfolder, threshold=1.0, codec=codec)
+    
+    packer = HCHPacker(target, version=version)
+    packer.write_comment_header()
+    packer.write_body(list(images.values()))
+    packer.close()
+    
+    assert packer.bytes_copied == sum(i.size for i in images.values())
+
+class ArchiveTestCase(unittest.TestCase):
+    version = 1
+    codec = CODEC_PNG
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, "source")
+        self.temp = os.path.join(self.path, "temp")
+        os.mkdir(self.source)
+        os.mkdir(self.temp)
+        
+        self.keys = make_images(self.source)
+        self.filename = os.path.join(self.path, "test.hcg")
+        pack_archive(self.source, self.keys, self.filename, self.temp,
+                     self.version, self.codec)
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def origin_data(self, key):
+        return Image.open(os.path.join(self.source, key)).tobytes()
+
+class TestArchive(ArchiveTestCase):
+    def validate(self, archive):
+        archive.validate_header_index()
+        archive.validate_tail_index()
+        
+        images = archive.get_images()
+        self.assertEqual(sorted(self.keys), sorted(i.key for i in images))
+        
+        for img in images:
+            self.assertEqual(img.crc32, img.calculate_crc32())
+            self.assertEqual(img.crc32, crc32(bytes(img.get_data())) & 0xffffffff)
+            self.assertEqual(self.origin_data(img.key),
+                             img.get_origin_image().tobytes())
+            self.assertEqual(img.key != self.keys[0], img.has_diff)
+    
+    def testRead(self):
+        archive = HCGArchive(self.filename)
+        self.validate(archive)
+        archive.close()
+    
+    def testReadMmap(self):
+        archive = HCGArchive(self.filename, use_mmap=True)
+        self.validate(archive)
+        
+        img = archive.get_images()[0]
+        self.assertIsInstance(img.get_data(), memoryview)
+        archive.close()
+    
+    def testExtract(self):
+        target = os.path.join(self.path, "extract")
+        
+        archive = HCGArchive(self.filename, use_mmap=True)
+        for img in archive.get_images():
+            img.extract_to(target)
+        archive.close()
+        
+        for key in self.keys:
+            self.assertEqual(self.origin_data(key),
+                             Image.open(os.path.join(target, key)).tobytes())
+    
+    def testReferenceCache(self):
+        cache = ImageCache()
+        archive = HCGArchive(self.filename, cache=cache)
+        
+        for img in archive.get_images():
+            self.assertEqual(self.origin_data(img.key),
+                             img.get_origin_image().tobytes())
+        archive.close()
+        
+        # All diffed images share the same reference
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(len(self.keys) - 2, cache.hits)
+    
+    def testGet(self):
+        for use_mmap in (False, True):
+            archive = HCGArchive(self.filename, use_mmap=use_mmap)
+            self.assertEqual(self.version, archive.version)
+            
+            for key in reversed(self.keys):
+                img = archive.get(key)
+                self.assertEqual(key, img.key)
+                self.assertEqual(img.crc32, img.calculate_crc32())
+                self.assertEqual(self.origin_data(key),
+                                 img.get_origin_image().tobytes())
+            
+            self.assertRaises(KeyError, archive.get, "missing.png")
+            self.assertRaises(KeyError, archive.get, "")
+            archive.close()
+    
+    def testIterDecoded(self):
+        archive = HCGArchive(self.filename, cache=False)
+        
+        keys = [img.key for img in archive.iter_images()]
+        self.assertEqual(self.keys, keys)
+        
+        decoded = list(archive.iter_decoded())
+        self.assertEqual(self.keys, [key for key, img in decoded])
+        for key, img in decoded:
+            self.assertEqual(self.origin_data(key), img.tobytes())
+        
+        for key, (mode, size, data) in archive.iter_decoded(raw=True):
+            self.assertEqual(self.origin_data(key), data)
+        archive.close()
+    
+    def testGetRegion(self):
+        archive = HCGArchive(self.filename)
+        for key in self.keys:
+            origin = Image.open(os.path.join(self.source, key))
+            self.assertEqual(origin.crop((10, 20, 70, 50)).tobytes(),
+                             archive.get_region(key, (10, 20, 70, 50)).tobytes())
+        archive.close()
+    
+    def testDecodeStage(self):
+        decodes = []
+        hook = lambda kind, name, value: name == "decode.image" and decodes.append(value)
+        
+        archive = HCGArchive(self.filename, cache=False)
+        stats.add_hook(hook)
+        try:
+            archive.get(self.keys[1]).get_origin_image()
+        finally:
+            stats.remove_hook(hook)
+        
+        # Reference and PNG diff image are decoded once each
+        self.assertEqual(self.codec == CODEC_PNG and 2 or 1, len(decodes))
+        archive.close()
+    
+    def testIndexSingleRead(self):
+        reads = []
+        hook = lambda kind, name, value: name == "archive.bytes_read" and reads.append(value)
+        
+        archive = HCGArchive(self.filename, cache=False)
+        stats.add_hook(hook)
+        try:
+            images = archive.get_images()
+        finally:
+            stats.remove_hook(hook)
+        
+        self.assertEqual(1, len(reads))
+        self.assertEqual(sorted(self.keys), sorted(i.key for i in images))
+        
+        # CRC32 is checked by get_images
+        archive.validate_header_index()
+        archive.close()
+    
+    def testGetCreateImagesOnDemand(self):
+        archive = HCGArchive(self.filename)
+        img = archive.get(self.keys[1])
+        
+        self.assertEqual(None, archive._images)
+        self.assertIs(img, archive.get(self.keys[1]))
+        self.assertIs(img.ref, archive.get(self.keys[0]))
+        self.assertIs(img, [i for i in archive.get_images() if i.key == self.keys[1]][0])
+        archive.close()
+    
+    def testBrokenHeaderIndex(self):
+        archive = HCGArchive(self.filename)
+        position = archive._head_index_offset + 8 + archive._index_length
+        archive.close()
+        
+        with open(self.filename, "r+b") as f:
+            f.seek(position)
+            f.write(b"\x00\x00\x00\x00")
+        
+        archive = HCGArchive(self.filename)
+        self.assertRaises(RuntimeError, archive.get_images)
+        self.assertRaises(RuntimeError, archive.validate_header_index)
+        archive.close()
+
+class TestArchiveV2(TestArchive):
+    version = 2
+    
+    def testGetLoadRecordsOnDemand(self):
+        archive = HCGArchive(self.filename)
+        img = archive.get(self.keys[1])
+        
+        self.assertEqual(self.keys[0], img.ref.key)
+        self.assertIs(img.ref, archive.get(self.keys[0]))
+        self.assertEqual(None, archive._images)
+        
+        images = archive.get_images()
+        self.assertTrue(img in images)
+        self.assertIs(img, archive.get(self.keys[1]))
+        archive.close()
+
+class TestArchiveDelta(TestArchiveV2):
+    codec = CODEC_DELTA
+    
+    def testCodec(self):
+        archive = HCGArchive(self.filename)
+        for img in archive.get_images():
+            self.assertEqual(img.has_diff and CODEC_DELTA or CODEC_PNG, img.codec)
+        archive.close()
+    
+    def testVersion1(self):
+        target = os.path.join(self.path, "v1.hcg")
+        self.assertRaises(RuntimeError, pack_archive, self.source, self.keys, target,
+                          self.temp, 1, CODEC_DELTA)
+
+class TestArchiveTiled(TestArchiveDelta):
+    codec = CODEC_TILED
+    
+    def testCodec(self):
+        archive = HCGArchive(self.filename)
+        for img in archive.get_images():
+            self.assertEqual(img.has_diff and CODEC_TILED or CODEC_PNG, img.codec)
+        archive.close()
+    
+    def testGetRegion(self):
+        archive = HCGArchive(self.filename)
+        for key in self.keys:
+            origin = Image.open(os.path.join(self.source, key))
+            for bbox in ((5, 5, 40, 30), (0, 0, 120, 90), (100, 80, 120, 90)):
+                self.assertEqual(origin.crop(bbox).tobytes(),
+                                 archive.get_region(key, bbox).tobytes())
+        
+        self.assertRaises(RuntimeError, archive.get_region, self.keys[1], (0, 0, 121, 90))
+        self.assertRaises(KeyError, archive.get_region, "missing.png", (0, 0, 1, 1))
+        archive.close()
+
+class TestAppend(ArchiveTestCase):
+    def append(self):
+        path = os.path.join(self.source, "new")
+        os.mkdir(path)
+        keys = ["new/%s" % key for key in make_images(path, 3)]
+        images = [HCGPackImage(key, os.path.join(self.source, key))
+                  for key in keys]
+        
+        packer = HCHPacker(self.filename, append=True)
+        
+        # Diffed with an image in the archive, and with a new image
+        images[0].make_ref(packer.archive.get(self.keys[0]), self.temp, threshold=10,
+                           codec=self.codec)
+        images[2].make_ref(images[1], self.temp, threshold=10, codec=self.codec)
+        
+        packer.write_append(images)
+        packer.close()
+        
+        self.assertEqual(sum(i.size for i in images), packer.bytes_copied)
+        return keys
+    
+    def validate(self, filename, keys, appended):
+        archive = HCGArchive(filename)
+        self.assertEqual(appended, archive.appended)
+        
+        archive.validate_header_index()
+        archive.validate_tail_index()
+        
+        for key in keys:
+            self.assertEqual(self.origin_data(key),
+                             archive.get(key).get_origin_image().tobytes())
+        
+        images = archive.get_images()
+        self.assertEqual(sorted(keys), sorted(i.key for i in images))
+        self.assertEqual(self.keys[0], archive.get(keys[-3]).ref.key)
+        self.assertEqual(None, archive.get(keys[-2]).ref)
+        self.assertEqual(keys[-2], archive.get(keys[-1]).ref.key)
+        archive.close()
+    
+    def testAppend(self):
+        size = os.path.getsize(self.filename)
+        new_keys = self.append()
+        
+        self.validate(self.filename, self.keys + new_keys, True)
+        
+        # Existing data is not rewritten
+        with open(self.filename, "rb") as f:
+            head = f.read(size - 8)
+        copy = os.path.join(self.path, "copy.hcg")
+        pack_archive(self.source, self.keys, copy, self.temp, self.version,
+                     self.codec)
+        with open(copy, "rb") as f:
+            self.assertEqual(f.read(size - 8), head)
+    
+    def testIterDecodedPrefix(self):
+        new_keys = self.append()
+        archive = HCGArchive(self.filename, cache=False)
+        
+        # References out of prefix are decoded but not yielded
+        keys = [key for key, img in archive.iter_decoded(prefix="new/")]
+        self.assertEqual(new_keys, keys)
+        self.assertEqual(keys, [img.key for img in archive.iter_images("new/")])
+        
+        seen = set()
+        for key, img in archive.iter_decoded():
+            ref = archive.get(key).ref
+            self.assertTrue(ref is None or ref.key in seen)
+            self.assertEqual(self.origin_data(key), img.tobytes())
+            seen.add(key)
+        self.assertEqual(set(self.keys + new_keys), seen)
+        
+        self.assertEqual([], list(archive.iter_decoded(prefix="missing/")))
+        archive.close()
+    
+    def testRewrite(self):
+        new_keys = self.append()
+        
+        target = os.path.join(self.path, "rewrite.hcg")
+        rewrite_archive(self.filename, target)
+        self.validate(target, self.keys + new_keys, False)
+        self.assertTrue(os.path.getsize(target) < os.path.getsize(self.filename))
+    
+    def testRewriteComment(self):
+        # Comment length is counted in bytes
+        comment = u"\u30b3\u30e1\u30f3\u30c8 comment"
+        source = os.path.join(self.path, "comment.hcg")
+        packer = HCHPacker(source, version=self.version)
+        packer.write_comment_header(comment)
+        packer.write_body([HCGPackImage(key, os.path.join(self.source, key))
+                           for key in self.keys])
+        packer.close()
+        
+        target = os.path.join(self.path, "rewrite.hcg")
+        rewrite_archive(source, target)
+        
+        for filename in (source, target):
+            archive = HCGArchive(filename)
+            self.assertEqual(comment.encode("utf-8"), archive.comments)
+            archive.validate_header_index()
+            for key in self.keys:
+                self.assertEqual(self.origin_data(key),
+                                 archive.get(key).get_origin_image().tobytes())
+            archive.close()
+    
+    def testDuplicatedKey(self):
+        size = os.path.getsize(self.filename)
+        
+        packer = HCHPacker(self.filename, append=True)
+        image = HCGPackImage(self.keys[1], os.path.join(self.source, self.keys[1]))
+        self.assertRaises(RuntimeError, packer.write_append, [image])
+        packer.close()
+        
+        self.assertEqual(size, os.path.getsize(self.filename))
+
+class TestAppendV2(TestAppend):
+    version = 2
+
+class TestAppendDelta(TestAppend):
+    version = 2
+    codec = CODEC_DELTA
+
+class TestAppendTiled(TestAppend):
+    version = 2
+    codec = CODEC_TILED
+
+class TestPackImage(ArchiveTestCase):
+    def testLazyMetadata(self):
+        pool = ImagePool(2)
+        filename = os.path.join(self.source, self.keys[0])
+        img = HCGPackImage(self.keys[0], filename, pool)
+        
+        self.assertEqual(None, img._crc32)
+        self.assertEqual(((120, 90, "RGB"), os.path.getsize(filename)),
+                         (img.group, img.size))
+        self.assertEqual((0, 0), (pool.hits, pool.misses))
+        
+        with open(filename, "rb") as f:
+            self.assertEqual(crc32(f.read()) & 0xffffffff, img.crc32)
+    
+    def testPool(self):
+        pool = ImagePool(2)
+        images = [HCGPackImage(key, os.path.join(self.source, key), pool)
+                  for key in self.keys]
+        
+        for img in images:
+            self.assertEqual(self.origin_data(img.key),
+                             img.get_origin_image().tobytes())
+        images[-1].get_image()
+        
+        self.assertEqual((1, len(self.keys)), (pool.hits, pool.misses))
+        self.assertEqual(2, len(pool._items))
+    
+    def testPoolBytes(self):
+        # Images are 120x90 RGB, 32400 bytes each
+        pool = ImagePool(max_bytes=70000)
+        for key in self.keys:
+            pool.open(os.path.join(self.source, key))
+        self.assertEqual((2, 64800), (len(pool._items), pool.current_bytes))
+        
+        pool = ImagePool(max_bytes=1000)
+        img = pool.open(os.path.join(self.source, self.keys[0]))
+        self.assertEqual(self.origin_data(self.keys[0]), img.tobytes())
+        self.assertEqual((0, 0), (len(pool._items), pool.current_bytes))
+
+class TestExtractArchive(ArchiveTestCase):
+    def testPlan(self):
+        archive = HCGArchive(self.filename)
+        images = archive.get_images()
+        
+        self.assertEqual([self.keys], plan_extraction(images, 1))
+        
+        tasks = plan_extraction(images, 2)
+        self.assertEqual([self.keys[:2], self.keys[2:]], tasks)
+        archive.close()
+    
+    def validate(self, jobs):
+        target = os.path.join(self.path, "extract%i" % jobs)
+        extracted = []
+        
+        cache_stats = extract_archive(
+            self.filename, target, jobs=jobs,
+            callback=lambda key, ref: extracted.append((key, ref)))
+        
+        # The root reference is decoded once by each worker which uses it
+        self.assertTrue(1 <= cache_stats["misses"] <= jobs)
+        self.assertEqual(len(self.keys) - 1,
+                         cache_stats["hits"] + cache_stats["misses"])
+        
+        self.assertEqual([(self.keys[0], None)] +
+                         [(key, self.keys[0]) for key in self.keys[1:]],
+                         sorted(extracted))
+        for key in self.keys:
+            self.assertEqual(self.origin_data(key),
+                             Image.open(os.path.join(target, key)).tobytes())
+    
+    def testExtract(self):
+        self.validate(1)
+    
+    def testParallelExtract(self):
+        self.validate(3)
+
+class TestEncodeDiffs(ArchiveTestCase):
+    def encode(self, name, version=1, **kw):
+        images = [HCGPackImage(key, os.path.join(self.source, key))
+                  for key in self.keys]
+        
+        # Every image is a candidate of the next one
+        images_ref = dict(zip(images[1:], images[:-1]))
+        
+        store = PayloadStore(self.temp)
+        encode_diffs(images, images_ref, store, **kw)
+        
+        target = os.path.join(self.path, name)
+        packer = HCHPacker(target, version=version)
+        packer.write_comment_header()
+        packer.write_body(images)
+        packer.close()
+        store.close()
+        
+        with open(target, "rb") as f:
+            return [(i.key, i.ref and i.ref.key) for i in images], f.read()
+    
+    def testSameAsSerial(self):
+        refs, data = self.encode("serial.hcg", jobs=1, threshold=1.0)
+        
+        # Candidates are replaced by their root
+        self.assertEqual([(self.keys[0], None)] +
+                         [(key, self.keys[0]) for key in self.keys[1:]], refs)
+        
+        self.assertEqual((refs, data), self.encode("parallel.hcg", jobs=2,
+                                                   threshold=1.0))
+        # Trials are run one by one
+        self.assertEqual((refs, data), self.encode("bounded.hcg", jobs=2,
+                                                   memory_limit=1,
+                                                   threshold=1.0))
+    
+    def testRejected(self):
+        refs, data = self.encode("rejected.hcg", jobs=2, threshold=0.0)
+        self.assertEqual([(key, None) for key in self.keys], refs)
+    
+    def testDelta(self):
+        refs, data = self.encode("serial.hcg", 2, jobs=1, threshold=1.0, codec=CODEC_DELTA)
+        self.assertEqual((refs, data), self.encode("parallel.hcg", 2, jobs=2, threshold=1.0,
+                                                   codec=CODEC_DELTA))
+        self.assertNotEqual(data, self.encode("png.hcg", 2, jobs=1, threshold=1.0)[1])
+
+class TestVerifyArchive(ArchiveTestCase):
+    def testVerify(self):
+        for use_mmap in (False, True):
+            checked = []
+            result = verify_archive(self.filename, threads=2, chunk_size=1000,
+                                    use_mmap=use_mmap,
+                                    callback=lambda *args: checked.append(args))
+            
+            self.assertTrue(result.ok)
+            self.assertEqual(len(self.keys), result.images)
+            self.assertEqual(sorted(self.keys), sorted(c[0] for c in checked))
+            self.assertTrue(all(c[1] == c[2] for c in checked))
+    
+    def testBrokenImage(self):
+        archive = HCGArchive(self.filename)
+        img = archive.get(self.keys[2])
+        archive.close()
+        
+        with open(self.filename, "r+b") as f:
+            f.seek(img.position + img.size - 1)
+            last = f.read(1)
+            f.seek(-1, 1)
+            f.write(b"\x00" if last == b"\xff" else b"\xff")
+        
+        result = verify_archive(self.filename, threads=3, chunk_size=100)
+        self.assertFalse(result.ok)
+        self.assertEqual([self.keys[2]], [f[0] for f in result.failed])
+        self.assertEqual([], result.errors)
+    
+    def testBrokenIndex(self):
+        with open(self.filename, "r+b") as f:
+            f.seek(-12, 2)
+            f.write(b"\x00\x00\x00\x00")
+        
+        result = verify_archive(self.filename, threads=2)
+        self.assertEqual(["tail index"], [e[0] for e in result.errors])
+    
+    def testBrokenHeaderIndex(self):
+        archive = HCGArchive(self.filename, cache=False)
+        position = archive._head_index_offset + 8
+        archive.close()
+        
+        with open(self.filename, "r+b") as f:
+            f.seek(position)
+            byte = f.read(1)
+            f.seek(position)
+            f.write(bytes(bytearray([ord(byte) ^ 0xff])))
+        
+        result = verify_archive(self.filename, threads=2)
+        self.assertEqual(["header index", "index"], sorted(e[0] for e in result.errors))
+        self.assertEqual(0, result.images)
+        self.assertFalse(result.ok)
+    
+    def testOpenFailure(self):
+        def broken_mmap(*args, **kw):
+            raise OSError(12, "Cannot allocate memory")
+        
+        mmap = verify.mmap.mmap
+        verify.mmap.mmap = broken_mmap
+        try:
+            result = verify_archive(self.filename, threads=2, use_mmap=True)
+        finally:
+            verify.mmap.mmap = mmap
+        
+        self.assertEqual(["open", "open"], [e[0] for e in result.errors])
+        self.assertEqual((0, len(self.keys)), (result.images, result.expected_images))
+        self.assertFalse(result.ok)
+    
+    def testUncheckedImages(self):
+        result = verify_archive(self.filename, threads=2)
+        self.assertTrue(result.ok)
+        
+        result.images -= 1
+        self.assertFalse(result.ok)
+
+class TestConcurrentReads(ArchiveTestCase):
+    threads = 8
+    reads = 1000
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, "source")
+        self.temp = os.path.join(self.path, "temp")
+        os.mkdir(self.source)
+        os.mkdir(self.temp)
+        
+        # Noise does not compress, so reads are large enough to be
+        # interleaved between threads
+        rnd = random.Random(0)
+        base = Image.frombytes("RGB", (160, 120),
+                               bytes(bytearray(rnd.randrange(256) for i in range(160 * 120 * 3))))
+        self.keys = []
+        for i in range(8):
+            img = base.copy()
+            ImageDraw.Draw(img).rectangle((i * 10, i * 5, i * 10 + 12, i * 5 + 12),
+                                          fill=(255, i * 30, 0))
+            key = "noise%02i.png" % i
+            img.save(os.path.join(self.source, key))
+            self.keys.append(key)
+        
+        self.filename = os.path.join(self.path, "test.hcg")
+        pack_archive(self.source, self.keys, self.filename, self.temp, self.version)
+    
+    def hammer(self, archive, expected):
+        # Threads read random images of one archive, return failures
+        errors = []
+        
+        def worker(seed):
+            rnd = random.Random(seed)
+            try:
+                for i in range(self.reads):
+                    key = rnd.choice(self.keys)
+                    img = archive.get(key)
+                    
+                    if img.crc32 != crc32(bytes(img.get_data())) & 0xffffffff:
+                        errors.append((key, "crc32"))
+                    if i % 50 == 0 and img.get_origin_image().tobytes() != expected[key]:
+                        errors.append((key, "image"))
+            except Exception as e:
+                errors.append((seed, e))
+        
+        workers = [threading.Thread(target=worker, args=(i, ))
+                   for i in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return errors
+    
+    def testConcurrentReads(self):
+        expected = dict((key, self.origin_data(key)) for key in self.keys)
+        
+        # Switch threads as often as possible
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for use_mmap in (False, True):
+                # Index is loaded by the threads too
+                archive = HCGArchive(self.filename, use_mmap=use_mmap, cache=ImageCache())
+                self.assertEqual([], self.hammer(archive, expected))
+                archive.close()
+        finally:
+            sys.setswitchinterval(interval)
+
+class TestConcurrentReadsV2(TestConcurrentReads):
+    version = 2
+
+class TestReadAt(unittest.TestCase):
+    def testReadAt(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            f.seek(3)
+            
+            self.assertEqual(b"2345", read_at(f, 2, 4))
+            self.assertEqual(b"89", read_at(f, 8, 10))
+            self.assertEqual(b"", read_at(f, 20, 1))
+            self.assertEqual(3, f.tell())
+
+class TestBufferReader(unittest.TestCase):
+    def testRead(self):
+        f = BufferReader(memoryview(b"0123456789"))
+        self.assertEqual(b"012", f.read(3))
+        self.assertEqual(3, f.tell())
+        self.assertEqual(b"3456789", f.read())
+        self.assertEqual(b"", f.read(1))
+    
+    def testSeek(self):
+        f = BufferReader(b"0123456789")
+        f.seek(-2, 2)
+        self.assertEqual(b"89", f.read(5))
+        f.seek(4)
+        f.seek(2, 1)
+        self.assertEqual(b"67", f.read(2))
+
+class TestCopyFileData(unittest.TestCase):
+    DATA = bytes(bytearray(i % 251 for i in range(10000)))
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.src = os.path.join(self.path, "src")
+        with open(self.src, "wb") as f:
+            f.write(self.DATA)
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def validate(self, src, dst):
+        dst.write(b"head")
+        src.seek(100)
+        
+        self.assertEqual(5000, copy_file_data(src, dst, 5000, chunk_size=999))
+        self.assertEqual(5100, src.tell())
+        
+        dst.write(b"tail")
+        self.assertEqual(5008, dst.tell())
+        
+        # Copy until EOF
+        self.assertEqual(4900, copy_file_data(src, dst, 8000, chunk_size=999))
+    
+    def expected(self):
+        return b"head" + self.DATA[100:5100] + b"tail" + self.DATA[5100:]
+    
+    def testFile(self):
+        dst = os.path.join(self.path, "dst")
+        with open(self.src, "rb") as src, open(dst, "wb") as f:
+            self.validate(src, f)
+        
+        with open(dst, "rb") as f:
+            self.assertEqual(self.expected(), f.read())
+    
+    def testBuffer(self):
+        dst = BytesIO()
+        self.validate(BytesIO(self.DATA), dst)
+        self.assertEqual(self.expected(), dst.getvalue())
+        
+        dst = BytesIO()
+        with open(self.src, "rb") as src:
+            self.validate(src, dst)
+        self.assertEqual(self.expected(), dst.getvalue())
@@ -0,0 +1,60 @@
+import unittest
+
+from hcg.cache import ImageCache
+
+def buffer(size):
+    return ("L", (size, 1), b"\x00" * size)
+
+class TestImageCache(unittest.TestCase):
+    def testHitMiss(self):
+        cache = ImageCache(100)
+        self.assertEqual(None, cache.get("a"))
+        
+        cache.put("a", buffer(10))
+        self.assertEqual(buffer(10), cache.get("a"))
+        
+        stats = cache.stats()
+        self.assertEqual((1, 1, 1, 10), (stats["hits"], stats["misses"],
+                                         stats["items"], stats["current_bytes"]))
+    
+    def testEvictLeastRecentlyUsed(self):
+        cache = ImageCache(100)
+        cache.put("a", buffer(40))
+        cache.put("b", buffer(40))
+        cache.get("a")
+        cache.put("c", buffer(40))
+        
+        self.assertEqual(None, cache.get("b"))
+        self.assertNotEqual(None, cache.get("a"))
+        self.assertNotEqual(None, cache.get("c"))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(80, cache.current_bytes)
+    
+    def testTooLarge(self):
+        cache = ImageCache(100)
+        cache.put("a", buffer(40))
+        cache.put("b", buffer(101))
+        
+        self.assertEqual(None, cache.get("b"))
+        self.assertNotEqual(None, cache.get("a"))
+    
+    def testGetOrLoad(self):
+        cache = ImageCache(100)
+        loaded = []
+        
+        def loader():
+            loaded.append(1)
+            return buffer(10)
+        
+        cache.get_or_load("a", loader)
+        cache.get_or_load("a", loader)
+        self.assertEqual(1, len(loaded))
+    
+    def testResize(self):
+        cache = ImageCache(100)
+        cache.put("a", buffer(40))
+        cache.put("b", buffer(40))
+        cache.resize(50)
+        
+        self.assertEqual(40, cache.current_bytes)
+        self.assertEqual(None, cache.get("a"))
@@ -0,0 +1,126 @@
+import threading
+import unittest
+
+from hcg import codec
+from hcg import stats
+from hcg.kernels import kernels
+
+class TestDeltaCodec(unittest.TestCase):
+    def image_data(self, size=(64, 48)):
+        width, height = size
+        data = bytes(bytearray((i * 31 + i // 7) % 256 for i in range(width * height * 3)))
+        ref_data = bytes(bytearray((i * 31 + i // 9) % 256 for i in range(width * height * 3)))
+        return size, data, ref_data
+    
+    def testRoundTrip(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        self.assertEqual(("RGB", size, data),
+                         codec.decode_delta(buf, ("RGB", size, ref_data)))
+    
+    def testChunks(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data,
+                                 chunk_size=1000)
+        
+        mode, size, chunk_size, chunks = codec.read_delta_header(buf)
+        self.assertEqual(("RGB", (64, 48), 1000, 10), (mode, size, chunk_size, len(chunks)))
+        self.assertEqual(len(buf), chunks[-1][0] + chunks[-1][1])
+        
+        # Chunks decoded in parallel give the same data
+        for threads in (1, 4):
+            self.assertEqual(("RGB", size, data),
+                             codec.decode_delta(buf, ("RGB", size, ref_data), threads))
+    
+    def testThreads(self):
+        size, data, ref_data = self.image_data()
+        expected = codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data,
+                                      chunk_size=1000)
+        self.assertEqual(expected,
+                         codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data,
+                                            threads=4, chunk_size=1000))
+    
+    def testSharedExecutor(self):
+        executors = []
+        
+        def worker():
+            executors.append(codec._get_executor())
+        
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(set(id(e) for e in executors)))
+    
+    def testDiffData(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        diffed = kernels.diff_data(bytes(bytearray(data)), ref_data)
+        self.assertEqual(("RGB", size, bytes(diffed)), codec.decode_delta(buf))
+    
+    def testBrokenPayload(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        self.assertRaises(RuntimeError, codec.decode_delta, b"HCGX" + buf[4:])
+        self.assertRaises(RuntimeError, codec.decode_delta, buf[:-1])
+        self.assertRaises(RuntimeError, codec.decode_delta, buf, ("L", size, ref_data))
+        self.assertRaises(RuntimeError, codec.decode_delta, buf, ("RGB", size, ref_data[:-3]))
+
+class TestTiledCodec(unittest.TestCase):
+    def image_data(self, size=(250, 130)):
+        width, height = size
+        data = bytes(bytearray((i * 31 + i // 7) % 256 for i in range(width * height * 3)))
+        ref_data = bytes(bytearray((i * 31 + i // 9) % 256 for i in range(width * height * 3)))
+        return size, data, ref_data
+    
+    def testRoundTrip(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_tiles("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        mode, size, chunk_size, chunks = codec.read_delta_header(buf)
+        self.assertEqual((0, 2), (chunk_size, len(chunks)))
+        for threads in (1, 4):
+            self.assertEqual(("RGB", size, data),
+                             codec.decode_delta(buf, ("RGB", size, ref_data), threads))
+    
+    def testRegion(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_tiles("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        # Inside a tile, across tiles and the whole image
+        for bbox in ((10, 20, 30, 25), (100, 0, 200, 130), (0, 0, 250, 130)):
+            ref_region = codec.crop_data(ref_data, 250, 130, bbox)
+            expected = codec.crop_data(data, 250, 130, bbox)
+            region_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+            self.assertEqual(("RGB", region_size, expected),
+                             codec.decode_region(buf, bbox, ("RGB", region_size, ref_region)))
+    
+    def testRegionDecodesOverlappingTiles(self):
+        size, data, ref_data = self.image_data((400, 300))
+        buf = codec.encode_tiles("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        tiles = []
+        hook = lambda kind, name, value: name == "decode.tiles" and tiles.append(value)
+        
+        stats.add_hook(hook)
+        try:
+            codec.decode_region(buf, (150, 50, 250, 150))
+        finally:
+            stats.remove_hook(hook)
+        
+        # 4x3 tiles of 100x100 pixels
+        self.assertEqual([4], tiles)
+    
+    def testBadRegion(self):
+        size, data, ref_data = self.image_data()
+        buf = codec.encode_tiles("RGB", size, bytes(bytearray(data)), ref_data)
+        
+        self.assertRaises(RuntimeError, codec.decode_region, buf, (0, 0, 251, 10))
+        self.assertRaises(RuntimeError, codec.decode_region, buf, (10, 10, 10, 20))
+        
+        delta = codec.encode_delta("RGB", size, bytes(bytearray(data)), ref_data)
+        self.assertRaises(RuntimeError, codec.decode_region, delta, (0, 0, 10, 10))
@@ -2,13 +2,13 @@
 import unittest
 
 from hcg import compress
-from hcg import _compress
+from hcg import kernels
 
 class TestCompress(unittest.TestCase):
     def diff_data(self):
-        data = b"".join(chr(i) for i in range(256))
+        data = bytes(bytearray(range(256)))
         ref_data = (data*2)[100:356]
-        diffed = "\x9c"*256
+        diffed = b"\x9c"*256
         return data, ref_data, diffed
     
     def testDiff(self):
@@ -18,10 +18,6 @@ class TestCompress(unittest.TestCase):
         compress.diff_buffer(b_data, b_ref_data, len(data))
         self.assertEqual(b_data, diffed)
     
-        data, ref_data, answer = self.diff_data()
-        _compress.diff_buffer(data, ref_data, len(data))
-        self.assertEqual(b_data, diffed)
-    
     def testMerge(self):
         data, ref_data, diffed = self.diff_data()
         b_diffed, b_ref_data = bytearray(diffed), bytearray(ref_data)
@@ -29,7 +25,48 @@ class TestCompress(unittest.TestCase):
         compress.merge_buffer(b_diffed, b_ref_data, len(diffed))
         self.assertEqual(b_diffed, data)
 
-        data, ref_data, diffed = self.diff_data()
-        _compress.merge_buffer(diffed, ref_data, len(diffed))
-        self.assertEqual(diffed, data)
+class TestKernels(unittest.TestCase):
+    def diff_data(self):
+        data = bytes(bytearray((i * 31 + 7) % 256 for i in range(4096)))
+        ref_data = bytes(bytearray((i * 17 + i // 5) % 256 for i in range(4096)))
+        return data, ref_data
+    
+    def testBackends(self):
+        self.assertEqual("python", kernels.available_backends()[-1])
+        self.assertIn(kernels.kernels.name, kernels.available_backends())
+    
+    def testUnknownBackend(self):
+        self.assertRaises(RuntimeError, kernels.get_kernels, "fortran")
+    
+    def testDiff(self):
+        data, ref_data = self.diff_data()
+        expected = bytearray(data)
+        compress.diff_buffer(expected, bytearray(ref_data), len(data))
+        
+        for name in kernels.available_backends():
+            k = kernels.get_kernels(name)
+            self.assertEqual((name, bytes(expected)),
+                             (name, bytes(k.diff_data(bytes(bytearray(data)), ref_data))))
+    
+    def testMerge(self):
+        data, ref_data = self.diff_data()
+        
+        for name in kernels.available_backends():
+            k = kernels.get_kernels(name)
+            diffed = k.diff_data(bytes(bytearray(data)), ref_data)
+            self.assertEqual((name, data),
+                             (name, bytes(k.merge_data(diffed, ref_data))))
+    
+    def testThreads(self):
+        # Long enough to be split between threads
+        data, ref_data = self.diff_data()
+        data, ref_data = data * 64, ref_data * 64
+        
+        expected = kernels.get_kernels("python").diff_data(data, ref_data)
         
+        for name in kernels.available_backends():
+            k = kernels.get_kernels(name)
+            diffed = k.diff_data(bytes(bytearray(data)), ref_data, threads=4)
+            self.assertEqual((name, bytes(expected)), (name, bytes(diffed)))
+            self.assertEqual((name, data),
+                             (name, bytes(k.merge_data(diffed, ref_data, threads=4))))
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, ImageDraw
+
+from hcg.codec import CODEC_DELTA
+from hcg.diskcache import DiskCache
+from hcg.encoder import encode_diffs
+from hcg.packer import HCGPackImage
+from hcg import ranking
+from hcg.ranking import rank_images
+from hcg.spool import PayloadStore
+
+from testcase.test_archive import make_images
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, "cache.db")
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def testPersistent(self):
+        cache = DiskCache(self.filename)
+        cache.put_sample("a", [[1, 2, 3], [4, 5, 6]])
+        cache.put_diff("a", "b", 4, b"diff")
+        cache.put_diff("a", "c", 400)
+        cache.close()
+        
+        cache = DiskCache(self.filename)
+        self.assertEqual([[1, 2, 3], [4, 5, 6]], cache.get_sample("a"))
+        self.assertEqual(None, cache.get_sample("b"))
+        self.assertEqual((4, b"diff"), cache.get_diff("a", "b"))
+        self.assertEqual((400, None), cache.get_diff("a", "c"))
+        self.assertEqual(None, cache.get_diff("b", "a"))
+        self.assertEqual((3, 2), (cache.hits, cache.misses))
+        cache.close()
+    
+    def testCodec(self):
+        cache = DiskCache(self.filename)
+        cache.put_diff("a", "b", 4, b"diff")
+        cache.put_diff("a", "b", 5, b"delta", codec=CODEC_DELTA)
+        
+        self.assertEqual((4, b"diff"), cache.get_diff("a", "b"))
+        self.assertEqual((5, b"delta"), cache.get_diff("a", "b", CODEC_DELTA))
+        cache.close()
+    
+    def testEvict(self):
+        cache = DiskCache(self.filename, max_bytes=100)
+        cache.put_diff("a", "r", 40, b"a" * 24)
+        cache.put_diff("b", "r", 40, b"b" * 24)
+        
+        # "a" is used recently, "b" is evicted
+        cache.get_diff("a", "r")
+        cache.put_diff("c", "r", 40, b"c" * 24)
+        
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(80, cache.current_bytes)
+        self.assertEqual(None, cache.get_diff("b", "r"))
+        self.assertEqual((40, b"a" * 24), cache.get_diff("a", "r"))
+        cache.close()
+        
+        self.assertEqual(80, DiskCache(self.filename).current_bytes)
+
+class TestRepack(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.keys = make_images(self.path, count=8)
+        self.cache = DiskCache(os.path.join(self.path, "cache.db"))
+    
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.path)
+    
+    def load_images(self):
+        return [HCGPackImage(key, os.path.join(self.path, key))
+                for key in self.keys]
+    
+    def ranked_keys(self, ranked):
+        return sorted((img.key, ref and ref.key, score)
+                      for img, (ref, score) in ranked.items())
+    
+    def pack(self, jobs=1, exact=False):
+        images = self.load_images()
+        for img in images:
+            sample = self.cache.get_sample(img.digest)
+            if sample is None:
+                self.cache.put_sample(img.digest, img.sample)
+            else:
+                img.set_sample(sample)
+        
+        ranked = rank_images(images, exact=exact, cache=self.cache)
+        self.ranked = self.ranked_keys(ranked)
+        images_ref = dict((img, ref) for img, (ref, score) in ranked.items())
+        
+        store = PayloadStore(self.path)
+        encode_diffs(images, images_ref, store, jobs=jobs, threshold=1.0,
+                     cache=self.cache)
+        
+        result = [(img.key, img.ref and img.ref.key, img.crc32) for img in images]
+        store.close()
+        return result
+    
+    def testRepack(self):
+        expected = self.pack()
+        misses = self.cache.misses
+        
+        for jobs in (1, 2):
+            self.assertEqual(expected, self.pack(jobs))
+            self.assertEqual(misses, self.cache.misses)
+    
+    def assertPartialRepack(self, exact=False):
+        # Only changed images are ranked again, the result is the same as
+        # ranking the whole group
+        def rank_all(images, exact):
+            raise AssertionError("the whole group is ranked again")
+        
+        rank_all_saved = ranking._rank_all
+        ranking._rank_all = rank_all
+        try:
+            self.pack(exact=exact)
+        finally:
+            ranking._rank_all = rank_all_saved
+        
+        expected = rank_images(self.load_images(), exact=exact)
+        self.assertEqual(self.ranked_keys(expected), self.ranked)
+    
+    def testChangedImage(self):
+        self.pack()
+        
+        # Same content with another name is still a hit
+        os.rename(os.path.join(self.path, self.keys[1]),
+                  os.path.join(self.path, "moved.png"))
+        self.keys[1] = "moved.png"
+        misses = self.cache.misses
+        
+        self.assertPartialRepack()
+        self.assertEqual(misses + 1, self.cache.misses) # ranking of moved.png
+    
+    def testModifiedImage(self):
+        for exact in (False, True):
+            self.pack(exact=exact)
+            
+            img = Image.open(os.path.join(self.path, self.keys[5]))
+            ImageDraw.Draw(img).rectangle((60, 40, 80, 60), fill=(0, 0, 255))
+            img.save(os.path.join(self.path, self.keys[5]))
+            
+            self.assertPartialRepack(exact)
+    
+    def testRemovedImage(self):
+        self.pack()
+        misses = self.cache.misses
+        
+        del self.keys[3]
+        self.assertPartialRepack()
+        self.assertEqual(misses, self.cache.misses)
@@ -0,0 +1,100 @@
+import random
+import unittest
+
+from hcg import ranking
+from hcg.image import HCGImage
+from hcg.sampling import evaluate_image_diff
+
+class SampleImage(HCGImage):
+    def __init__(self, key, sample):
+        super(SampleImage, self).__init__(key)
+        self._sample = sample
+    
+    @property
+    def sample(self):
+        return self._sample
+
+class TestSampleVector(unittest.TestCase):
+    def testDistance(self):
+        rnd = random.Random(0)
+        for i in range(20):
+            s1 = [[rnd.randrange(100000) for b in range(3)] for r in range(12)]
+            s2 = [[rnd.randrange(100000) for b in range(3)] for r in range(12)]
+            
+            expected = evaluate_image_diff(SampleImage("a", s1), SampleImage("b", s2))
+            v1, v2 = ranking.sample_vector(s1), ranking.sample_vector(s2)
+            self.assertAlmostEqual(expected, ranking.dist(v1, v2), places=6)
+
+class TestRankImages(unittest.TestCase):
+    def make_images(self, count, seed, duplicated=False):
+        rnd = random.Random(seed)
+        bases = [[[rnd.randrange(200000) for b in range(3)] for r in range(16)]
+                 for i in range(4)]
+        
+        images = []
+        for i in range(count):
+            base = rnd.choice(bases)
+            if duplicated and rnd.random() < 0.5:
+                sample = base
+            else:
+                sample = [[e + rnd.randrange(3000) for e in s] for s in base]
+            images.append(SampleImage("img%03i.png" % i, sample))
+        
+        rnd.shuffle(images)
+        return images
+    
+    def validate(self, images):
+        exact = ranking.rank_images(images, exact=True)
+        indexed = ranking.rank_images(images)
+        
+        self.assertEqual(len(exact), len(images))
+        for img in images:
+            e_ref, e_score = exact[img]
+            i_ref, i_score = indexed[img]
+            
+            self.assertEqual((img.key, e_ref and e_ref.key),
+                             (img.key, i_ref and i_ref.key))
+            self.assertAlmostEqual(e_score, i_score, places=6)
+    
+    def testEmpty(self):
+        self.assertEqual({}, ranking.rank_images([]))
+    
+    def testSingle(self):
+        img = SampleImage("a.png", [[1, 2, 3]])
+        self.assertEqual({img: (None, float("inf"))}, ranking.rank_images([img]))
+    
+    def testCandidateOrder(self):
+        # Candidates of an image are the images ordered before it
+        images = self.make_images(10, 1)
+        ranked = ranking.rank_images(images)
+        
+        for img, (ref, score) in ranked.items():
+            if ref is None:
+                self.assertEqual(img, min(images))
+            else:
+                self.assertTrue(ref < img)
+    
+    def testIndexedMatchExact(self):
+        self.validate(self.make_images(120, 2))
+    
+    def testTieBreak(self):
+        self.validate(self.make_images(120, 3, duplicated=True))
+    
+    def testBases(self):
+        # Bases are candidates of every image, whatever their order
+        images = self.make_images(40, 4)
+        images.sort()
+        bases, images = images[20:], images[:20]
+        
+        exact = ranking.rank_images(images, exact=True, bases=bases)
+        indexed = ranking.rank_images(images, bases=bases)
+        
+        self.assertEqual(set(images), set(exact))
+        for img in images:
+            e_ref, e_score = exact[img]
+            i_ref, i_score = indexed[img]
+            self.assertEqual(e_ref.key, i_ref.key)
+            self.assertAlmostEqual(e_score, i_score, places=6)
+            self.assertTrue(e_ref in bases or e_ref < img)
+        
+        self.assertTrue(any(ref in bases for ref, score in exact.values()))
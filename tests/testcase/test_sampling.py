@@ -2,7 +2,7 @@
 import unittest
 
 from hcg import sampling
-from hcg import _sampling
+from hcg import kernels
 
 class TestLineSegement(unittest.TestCase):
     def test50(self):
@@ -56,14 +56,7 @@ class TestSamplingBbox(unittest.TestCase):
     B1 = []
     for y in range(60):
         for x in range(y, 80 + y):
-            B1.append(chr(x))
-    
-    B3 = []
-    for y in range(60):
-        for x in range(y, 80 + y):
-            B3.append(chr(x))
-            B3.append(chr(x + 1))
-            B3.append(chr(x + 2))
+            B1.append(x)
     
     ANSWER = {
         0: [(0, 0, 80, 60), [331200]],
@@ -80,16 +73,61 @@ class TestSamplingBbox(unittest.TestCase):
         self.assertEqual((index, self.ANSWER[index][1]), (index, result))
     
     def testNativeSampling(self):
-        data = bytearray(b"".join(self.B1))
+        data = bytearray(self.B1)
         
         for index, item in self.ANSWER.items():
             sampling.sampling_bbox(data, 80, 60, 1, item[0],
                 self.validateCb, index)
     
     def testCythonSampling(self):
-        data = b"".join(self.B1)
+        if "cython" not in kernels.available_backends():
+            self.skipTest("Cython extensions are not built")
+        
+        from hcg import _sampling
+        data = bytes(bytearray(self.B1))
         
         for index, item in self.ANSWER.items():
             _sampling.sampling_bbox(data, 80, 60, 1, item[0],
                 self.validateCb, index)
+
+class TestSamplingGrid(unittest.TestCase):
+    def make_data(self, width, height, bands):
+        return bytes(bytearray((i * 7 + i // 13) % 256
+                               for i in range(width * height * bands)))
+    
+    def expected(self, data, width, height, bands):
+        regions = list(sampling.split_rect(width, height))
+        output = [None for r in regions]
         
+        def cb(index, result):
+            output[index] = result
+        
+        for index, bbox in enumerate(regions):
+            sampling.sampling_bbox(bytearray(data), width, height, bands,
+                bbox, cb, index)
+        return output
+    
+    def validate(self, sampler, width, height, bands, **kw):
+        data = self.make_data(width, height, bands)
+        self.assertEqual(self.expected(data, width, height, bands),
+                         sampler(data, width, height, bands, **kw))
+    
+    def testNativeSampling(self):
+        for bands in (1, 3, 4):
+            self.validate(sampling.sampling_grid, 80, 60, bands)
+            self.validate(sampling.sampling_grid, 150, 305, bands)
+    
+    def testKernels(self):
+        for name in kernels.available_backends():
+            sampler = kernels.get_kernels(name).sampling_grid
+            for bands in (1, 3, 4):
+                self.validate(sampler, 80, 60, bands)
+                self.validate(sampler, 150, 305, bands)
+                self.validate(sampler, 251, 149, bands)
+    
+    def testThreads(self):
+        for name in kernels.available_backends():
+            sampler = kernels.get_kernels(name).sampling_grid
+            for bands in (1, 2, 3, 4):
+                self.validate(sampler, 150, 305, bands, threads=3)
+                self.validate(sampler, 420, 330, bands, threads=4)
@@ -0,0 +1,100 @@
+import io
+import json
+import threading
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+from PIL import Image
+
+from hcg.archive import HCGArchive
+from hcg.server import ArchiveServer
+
+from testcase.test_archive import ArchiveTestCase
+
+class TestArchiveServer(ArchiveTestCase):
+    def setUp(self):
+        super(TestArchiveServer, self).setUp()
+        
+        self.server = ArchiveServer([self.filename], ("127.0.0.1", 0), log=False)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%i" % self.server.server_address[1]
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(TestArchiveServer, self).tearDown()
+    
+    def fetch(self, path, headers={}):
+        response = urlopen(Request(self.url + path, headers=headers))
+        try:
+            return response.getcode(), dict(response.headers.items()), response.read()
+        finally:
+            response.close()
+    
+    def testServe(self):
+        archive = HCGArchive(self.filename)
+        root = archive.get(self.keys[0])
+        root_data = bytes(root.get_data())
+        archive.close()
+        
+        status, headers, body = self.fetch("/test/" + self.keys[0])
+        self.assertEqual(200, status)
+        self.assertEqual(root_data, body)
+        self.assertEqual("image/png", headers["Content-Type"])
+        self.assertEqual('"%08x"' % root.crc32, headers["ETag"])
+        
+        for key in self.keys[1:]:
+            for i in range(2):
+                status, headers, body = self.fetch("/test/" + key)
+                self.assertEqual(self.origin_data(key), Image.open(io.BytesIO(body)).tobytes())
+        
+        status, headers, body = self.fetch("/")
+        self.assertEqual(["test"], json.loads(body.decode()))
+        
+        metrics = json.loads(self.fetch("/_metrics")[2].decode())
+        # Root image, diffed images twice and the archive list
+        self.assertEqual(len(self.keys) * 2, metrics["requests"])
+        self.assertEqual(len(self.keys) - 1, metrics["cache"]["hits"])
+        self.assertEqual(len(self.keys) - 1, metrics["cache"]["misses"])
+        self.assertEqual(0.5, metrics["cache"]["hit_rate"])
+        # The root reference is decoded once for all diffed images
+        self.assertEqual(1, metrics["reference_cache"]["misses"])
+        self.assertEqual(len(self.keys) - 2, metrics["reference_cache"]["hits"])
+        self.assertTrue(metrics["latency"]["max"] > 0)
+    
+    def testConditional(self):
+        for key in self.keys[:2]:
+            status, headers, body = self.fetch("/test/" + key)
+            etag = headers["ETag"]
+            
+            for value in (etag, '"0", %s' % etag, "*", "W/%s" % etag):
+                try:
+                    self.fetch("/test/" + key, {"If-None-Match": value})
+                except HTTPError as e:
+                    self.assertEqual(304, e.code)
+                else:
+                    self.fail("Not modified image is sent for %s" % value)
+            
+            # ETags containing the image ETag are different ETags
+            for value in ('"0"', '"x%s"' % etag, 'W/"x%s"' % etag):
+                status, headers, body = self.fetch("/test/" + key, {"If-None-Match": value})
+                self.assertEqual(200, status)
+    
+    def testNotFound(self):
+        for path in ("/test/missing.png", "/missing/" + self.keys[0], "/test/", "/test"):
+            try:
+                self.fetch(path)
+            except HTTPError as e:
+                self.assertEqual(404, e.code)
+            else:
+                self.fail("%s is found" % path)
+
+class TestArchiveServerV2(TestArchiveServer):
+    version = 2
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from hcg.spool import PayloadStore
+
+class TestPayloadStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def testSpill(self):
+        store = PayloadStore(self.path, memory_limit=100)
+        
+        p1 = store.put("a.png", b"a" * 60)
+        p2 = store.put("b.png", b"b" * 60)
+        p3 = store.put("c.png", b"c" * 40)
+        
+        self.assertEqual((True, False, True),
+                         (p1.in_memory, p2.in_memory, p3.in_memory))
+        self.assertEqual(100, store.memory_bytes)
+        self.assertEqual((60, 1), (store.spilled_bytes, store.spilled_count))
+        self.assertEqual([os.path.basename(p2.filename)], os.listdir(self.path))
+        self.assertTrue(p2.filename.endswith(".bin"))
+        
+        for payload, data in ((p1, b"a" * 60), (p2, b"b" * 60), (p3, b"c" * 40)):
+            self.assertEqual(data, payload.get_data())
+            with payload.open() as f:
+                self.assertEqual(data, f.read())
+        
+        store.close()
+        self.assertEqual(0, store.memory_bytes)
+        self.assertEqual([], os.listdir(self.path))
+    
+    def testDiscard(self):
+        store = PayloadStore(self.path, memory_limit=100)
+        
+        p1 = store.put("a.png", b"a" * 60)
+        p1.discard()
+        p1.discard()
+        self.assertEqual(0, store.memory_bytes)
+        
+        p2 = store.put("b.png", b"b" * 60)
+        self.assertTrue(p2.in_memory)
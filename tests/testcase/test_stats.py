@@ -0,0 +1,83 @@
+import json
+import unittest
+
+from hcg import stats
+from hcg.stats import Stats
+from hcg.image import encode_diff_image
+
+class TestStats(unittest.TestCase):
+    def testStage(self):
+        s = Stats()
+        with s.stage("a"):
+            sum(range(1000))
+        with s.stage("a"):
+            pass
+        
+        item = s.snapshot()["stages"]["a"]
+        self.assertEqual(2, item["calls"])
+        self.assertTrue(item["wall"] >= 0)
+        self.assertTrue(item["cpu"] >= 0)
+    
+    def testStageRaise(self):
+        s = Stats()
+        try:
+            with s.stage("a"):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(1, s.snapshot()["stages"]["a"]["calls"])
+    
+    def testCounterGauge(self):
+        s = Stats()
+        s.incr("bytes", 10)
+        s.incr("bytes", 5)
+        s.incr("calls")
+        s.gauge("depth", 3)
+        s.gauge("depth", 1)
+        
+        data = s.snapshot()
+        self.assertEqual({"bytes": 15, "calls": 1}, data["counters"])
+        self.assertEqual({"depth": {"last": 1, "max": 3}}, data["gauges"])
+        
+        s.reset()
+        self.assertEqual({"stages": {}, "counters": {}, "gauges": {}}, s.snapshot())
+    
+    def testHooks(self):
+        s = Stats()
+        events = []
+        hook = lambda kind, name, value: events.append((kind, name))
+        
+        s.add_hook(hook)
+        s.incr("a")
+        s.gauge("b", 1)
+        with s.stage("c"):
+            pass
+        s.remove_hook(hook)
+        s.incr("a")
+        
+        self.assertEqual([("counter", "a"), ("gauge", "b"), ("stage", "c")], events)
+    
+    def testFormat(self):
+        s = Stats()
+        s.incr("archive.bytes_read", 42)
+        with s.stage("write"):
+            pass
+        
+        table = s.format_table()
+        self.assertIn("write", table)
+        self.assertIn("archive.bytes_read", table)
+        self.assertEqual(42, json.loads(s.format_json())["counters"]["archive.bytes_read"])
+    
+    def testInstrumented(self):
+        events = []
+        hook = lambda kind, name, value: events.append(name)
+        
+        stats.add_hook(hook)
+        try:
+            encode_diff_image("L", (4, 4), bytes(bytearray(16)), bytes(bytearray(16)))
+        finally:
+            stats.remove_hook(hook)
+        
+        self.assertIn("kernel.diff", events)
+        self.assertIn("encode.png", events)
+        self.assertIn("encode.bytes", events)
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from hcg.threading_pool import Executor, ThreadPool, DynamicThreadPool, ThreadPoolWorker
+
+def fail(message):
+    raise ValueError(message)
+
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = Executor(3)
+    
+    def tearDown(self):
+        self.executor.shutdown()
+    
+    def testResult(self):
+        self.assertEqual(1024, self.executor.submit(pow, 2, 10).result())
+    
+    def testException(self):
+        future = self.executor.submit(fail, "broken")
+        self.assertRaises(ValueError, future.result)
+        
+        # Worker is still alive
+        self.assertEqual(4, self.executor.submit(pow, 2, 2).result(timeout=5))
+    
+    def testBatch(self):
+        futures = self.executor.submit_batch([(pow, (2, i), {}) for i in range(50)])
+        self.assertEqual([2 ** i for i in range(50)], [f.result() for f in futures])
+        self.assertTrue(self.executor.total_threads <= 3)
+    
+    def testConcurrency(self):
+        barrier = threading.Barrier(3, timeout=5)
+        futures = [self.executor.submit(barrier.wait) for i in range(3)]
+        self.assertEqual([0, 1, 2], sorted(f.result() for f in futures))
+
+class RecordWorker(ThreadPoolWorker):
+    errors = []
+    
+    def on_task(self, task):
+        if task < 0:
+            raise ValueError(task)
+        return task * 2
+    
+    def on_error(self, task, exception):
+        self.errors.append(task)
+
+class TestThreadPool(unittest.TestCase):
+    def setUp(self):
+        RecordWorker.errors = []
+    
+    def testWorker(self):
+        pool = ThreadPool(pool_size=2)
+        future = pool.assign_task((pow, (3, 2), {}))
+        self.assertEqual(9, future.result())
+        
+        future = pool.assign_task((fail, ("broken", ), {}))
+        self.assertRaises(ValueError, future.result)
+        
+        pool.shutdown()
+        pool.wait()
+    
+    def testTaskHandler(self):
+        pool = ThreadPool(RecordWorker, pool_size=2)
+        futures = pool.assign_tasks([1, 2, -1, 3])
+        
+        self.assertEqual([2, 4], [f.result() for f in futures[:2]])
+        self.assertRaises(ValueError, futures[2].result)
+        self.assertEqual(6, futures[3].result())
+        self.assertEqual([-1], RecordWorker.errors)
+        self.assertEqual(2, pool.padding_threads)
+        
+        pool.shutdown()
+    
+    def testWorkerThread(self):
+        # Workers can still be run as threads
+        worker = RecordWorker(ThreadPool(pool_size=1))
+        self.assertIsInstance(worker, threading.Thread)
+        
+        worker.start()
+        worker.assign_task(-5)
+        for i in range(500):
+            if RecordWorker.errors:
+                break
+            time.sleep(0.01)
+        worker.shutdown()
+        worker.join(5)
+        
+        self.assertFalse(worker.is_alive())
+        self.assertEqual([-5], RecordWorker.errors)
+    
+    def testDynamicThreadPool(self):
+        pool = DynamicThreadPool(pool_size=1)
+        barrier = threading.Barrier(3, timeout=5)
+        futures = [pool.assign_task((barrier.wait, (), {})) for i in range(3)]
+        
+        self.assertEqual([0, 1, 2], sorted(f.result() for f in futures))
+        self.assertEqual(2, pool.padding_threads)
+        pool.shutdown()